@@ -1,10 +1,239 @@
 # server.py
-from asyncua import ua, Server
+from asyncua import ua, Server, uamethod
+from asyncua.common.callback import CallbackType
+from datetime import timedelta
+from historian import Historian, HistorianManager
+from kpi import StationKpis
 import asyncio
+import sys
 
-async def main():
+#Kleinstes Abtastintervall (ms), das der Server fuer Monitored Items zusagt
+MINIMUM_SAMPLING_INTERVAL = 100.0
+#Historie: Werte je Variable im Ringpuffer und maximales Alter der Werte
+HISTORY_CAPACITY = 10000
+HISTORY_RETENTION = timedelta(days=1)
+
+#Stationen (WorkstationModule.identifier), fuer die der Server Objekte anlegt
+STATIONS = ["B4"]
+#Variablen je Station: Kurzname der NodeId (<identifier>.<Kurzname>), BrowseName, Startwert, Datentyp
+STATION_VARIABLES = [
+    ("TB", "Total_blocks", 0, ua.VariantType.Int64),
+    ("DIB", "Drilled_blocks", 0, ua.VariantType.Int64),
+    ("DMB", "Damaged_blocks", 0, ua.VariantType.Int64),
+    ("DRILL", "MotorOn_time", 0.0, ua.VariantType.Double),
+    ("RUN", "Workstation_running", False, ua.VariantType.Boolean),
+]
+#KPI-Variablen je Station (<identifier>.KPI.<Kurzname>), in der Reihenfolge von KpiValues
+STATION_KPIS = [
+    ("BPM1", "Blocks_per_minute_1min"),
+    ("BPM15", "Blocks_per_minute_15min"),
+    ("DMR", "Damage_ratio"),
+    ("UTIL", "Drill_utilization"),
+]
+#Zaehler, aus denen die KPIs berechnet werden
+KPI_COUNTERS = {"TB": "total", "DIB": "drilled", "DMB": "damaged", "DRILL": "drilling_time"}
+#Prioritaet des PostWrite-Listeners der KPIs (der Historian nutzt eine andere)
+KPI_CALLBACK_PRIORITY = 20
+
+def station_node_id(identifier, short_name, idx):
+    """
+    Returns the NodeId of a variable of a station
+    :param identifier identifier of the station (WorkstationModule.identifier)
+    :param short_name short name of the variable, e.g. "TB"
+    :param idx namespace index
+    :returns NodeId "<identifier>.<short_name>" in the namespace
+    :rtype ua.NodeId
+    """
+    return ua.NodeId(f"{identifier}.{short_name}", idx)
+
+async def advertise_subscriptions(server, variables):
+    """
+    Set the minimum sampling interval on the given variables and the server capabilities so
+    that clients can create monitored items with sampling interval and deadband instead of
+    polling the values with Read requests
+    :param server the running asyncua server
+    :param variables the variables which change with every workpiece
+    """
+    sampling_interval = ua.DataValue(ua.Variant(MINIMUM_SAMPLING_INTERVAL, ua.VariantType.Double))
+    for variable in variables:
+        await variable.write_attribute(ua.AttributeIds.MinimumSamplingInterval, sampling_interval)
+    min_sample_rate = server.get_node(ua.ObjectIds.Server_ServerCapabilities_MinSupportedSampleRate)
+    await min_sample_rate.write_value(ua.Variant(MINIMUM_SAMPLING_INTERVAL, ua.VariantType.Double))
+
+async def add_workstation_type(server, idx):
+    """
+    Adds the ObjectType shared by all stations with one mandatory variable per entry of STATION_VARIABLES
+    :param server the asyncua server
+    :param idx namespace index
+    :returns the WorkstationType node
+    """
+    base_object_type = server.get_node(ua.ObjectIds.BaseObjectType)
+    workstation_type = await base_object_type.add_object_type(idx, "WorkstationType")
+    variables = []
+    for short_name, name, value, variant_type in STATION_VARIABLES:
+        variable = await workstation_type.add_variable(idx, name, ua.Variant(value, variant_type))
+        await variable.set_modelling_rule(True)
+        variables.append(variable)
+    kpi_object = await workstation_type.add_object(idx, "KPI")
+    await kpi_object.set_modelling_rule(True)
+    for short_name, name in STATION_KPIS:
+        variable = await kpi_object.add_variable(idx, name, ua.Variant(0.0, ua.VariantType.Double))
+        await variable.set_modelling_rule(True)
+        variables.append(variable)
+    await advertise_subscriptions(server, variables)
+    return workstation_type
+
+def _station_items(identifier, parent, workstation_type, idx, historizing = False):
+    """
+    Builds the AddNodesItems of one station: the object and its typed, writable variables
+    :param identifier identifier of the station
+    :param parent NodeId of the folder the object is added to
+    :param workstation_type NodeId of the WorkstationType
+    :param idx namespace index
+    :param historizing True if the variables are historized and readable with HistoryRead
+    :returns list of AddNodesItems, the object first
+    :rtype list
+    """
+    station = ua.AddNodesItem()
+    station.RequestedNewNodeId = ua.NodeId(identifier, idx)
+    station.BrowseName = ua.QualifiedName(identifier, idx)
+    station.NodeClass = ua.NodeClass.Object
+    station.ParentNodeId = parent
+    station.ReferenceTypeId = ua.NodeId(ua.ObjectIds.Organizes)
+    station.TypeDefinition = workstation_type
+    attrs = ua.ObjectAttributes()
+    attrs.DisplayName = ua.LocalizedText(identifier)
+    attrs.Description = ua.LocalizedText(f"Workstation {identifier}")
+    attrs.EventNotifier = 0
+    station.NodeAttributes = attrs
+    items = [station]
+
+    access = ua.AccessLevel.CurrentRead.mask | ua.AccessLevel.CurrentWrite.mask
+    if historizing:
+        access |= ua.AccessLevel.HistoryRead.mask
+    for short_name, name, value, variant_type in STATION_VARIABLES:
+        variable = ua.AddNodesItem()
+        variable.RequestedNewNodeId = station_node_id(identifier, short_name, idx)
+        variable.BrowseName = ua.QualifiedName(name, idx)
+        variable.NodeClass = ua.NodeClass.Variable
+        variable.ParentNodeId = station.RequestedNewNodeId
+        variable.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasComponent)
+        variable.TypeDefinition = ua.NodeId(ua.ObjectIds.BaseDataVariableType)
+        attrs = ua.VariableAttributes()
+        attrs.DisplayName = ua.LocalizedText(name)
+        attrs.Description = ua.LocalizedText(name)
+        attrs.Value = ua.Variant(value, variant_type)
+        attrs.DataType = ua.NodeId(variant_type.value)
+        attrs.ValueRank = ua.ValueRank.Scalar
+        attrs.AccessLevel = access
+        attrs.UserAccessLevel = access
+        attrs.MinimumSamplingInterval = MINIMUM_SAMPLING_INTERVAL
+        attrs.Historizing = historizing
+        variable.NodeAttributes = attrs
+        items.append(variable)
+
+    kpi_object = ua.AddNodesItem()
+    kpi_object.RequestedNewNodeId = station_node_id(identifier, "KPI", idx)
+    kpi_object.BrowseName = ua.QualifiedName("KPI", idx)
+    kpi_object.NodeClass = ua.NodeClass.Object
+    kpi_object.ParentNodeId = station.RequestedNewNodeId
+    kpi_object.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasComponent)
+    kpi_object.TypeDefinition = ua.NodeId(ua.ObjectIds.BaseObjectType)
+    attrs = ua.ObjectAttributes()
+    attrs.DisplayName = ua.LocalizedText("KPI")
+    attrs.Description = ua.LocalizedText(f"KPIs of workstation {identifier}")
+    attrs.EventNotifier = 0
+    kpi_object.NodeAttributes = attrs
+    items.append(kpi_object)
+    for short_name, name in STATION_KPIS:
+        variable = ua.AddNodesItem()
+        variable.RequestedNewNodeId = station_node_id(identifier, "KPI." + short_name, idx)
+        variable.BrowseName = ua.QualifiedName(name, idx)
+        variable.NodeClass = ua.NodeClass.Variable
+        variable.ParentNodeId = kpi_object.RequestedNewNodeId
+        variable.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasComponent)
+        variable.TypeDefinition = ua.NodeId(ua.ObjectIds.BaseDataVariableType)
+        attrs = ua.VariableAttributes()
+        attrs.DisplayName = ua.LocalizedText(name)
+        attrs.Description = ua.LocalizedText(name)
+        attrs.Value = ua.Variant(0.0, ua.VariantType.Double)
+        attrs.DataType = ua.NodeId(ua.ObjectIds.Double)
+        attrs.ValueRank = ua.ValueRank.Scalar
+        attrs.AccessLevel = ua.AccessLevel.CurrentRead.mask
+        attrs.UserAccessLevel = ua.AccessLevel.CurrentRead.mask
+        attrs.MinimumSamplingInterval = MINIMUM_SAMPLING_INTERVAL
+        variable.NodeAttributes = attrs
+        items.append(variable)
+    return items
+
+async def add_stations(server, idx, parent, workstation_type, identifiers, historizing = False):
+    """
+    Adds one WorkstationType object per station with a single AddNodes call, so that even hundreds
+    of stations are registered at startup without a request per node
+    :param server the asyncua server
+    :param idx namespace index
+    :param parent folder node the stations are added to
+    :param workstation_type the WorkstationType node
+    :param identifiers identifiers of the stations (WorkstationModule.identifier)
+    :param historizing True if every write of the variables is recorded for HistoryRead
+    :returns dict identifier -> dict short name -> variable node
+    :rtype dict
+    """
+    items = []
+    for identifier in identifiers:
+        items.extend(_station_items(identifier, parent.nodeid, workstation_type.nodeid, idx, historizing))
+    results = await server.iserver.isession.add_nodes(items)
+    for item, result in zip(items, results):
+        if not result.StatusCode.is_good():
+            raise ua.UaStatusCodeError(result.StatusCode.value)
+    station_variables = {identifier: {short_name: server.get_node(station_node_id(identifier, short_name, idx)) for short_name, *_ in STATION_VARIABLES} for identifier in identifiers}
+    if historizing:
+        for variables in station_variables.values():
+            for variable in variables.values():
+                await server.iserver.history_manager.historize_data_change(variable)
+    return station_variables
+
+async def write_kpis(server, idx, identifier, values):
+    """
+    Writes the KPIs of a station into its KPI variables, directly into the address space without Write requests
+    :param server the asyncua server
+    :param idx namespace index
+    :param identifier identifier of the station
+    :param values KpiValues of the station
+    """
+    for (short_name, name), value in zip(STATION_KPIS, values):
+        await server.write_attribute_value(station_node_id(identifier, "KPI." + short_name, idx), ua.DataValue(ua.Variant(float(value), ua.VariantType.Double)))
+
+async def enable_kpis(server, idx, identifiers):
+    """
+    Keeps StationKpis for every station and updates them and the KPI variables on every successful write of a
+    counter (O(1) per write)
+    :param server the asyncua server
+    :param idx namespace index
+    :param identifiers identifiers of the stations
+    :returns dict identifier -> StationKpis
+    :rtype dict
+    """
+    kpis = {identifier: StationKpis() for identifier in identifiers}
+    counters = {station_node_id(identifier, short_name, idx): (identifier, name) for identifier in identifiers for short_name, name in KPI_COUNTERS.items()}
+
+    async def post_write(event, dispatcher):
+        for write_value, status in zip(event.request_params.NodesToWrite, event.response_params):
+            counter = counters.get(write_value.NodeId)
+            if counter is None or write_value.AttributeId != ua.AttributeIds.Value or not status.is_good() or write_value.Value.Value is None:
+                continue
+            identifier, name = counter
+            kpis[identifier].update(name, write_value.Value.Value.Value)
+            await write_kpis(server, idx, identifier, kpis[identifier].snapshot())
+
+    server.iserver.callback_service.addListener(CallbackType.PostWrite, post_write, KPI_CALLBACK_PRIORITY)
+    return kpis
+
+async def main(stations = STATIONS):
     # Setup server
     server = Server()
+    #Jeder Schreibzugriff auf die Stationsvariablen landet im Ringpuffer des Historians (HistoryRead, ReadProcessed min/max/avg)
+    server.iserver.history_manager = HistorianManager(server.iserver, Historian(HISTORY_CAPACITY, HISTORY_RETENTION))
     await server.init()
     # Server Endpoints. Replace with your desired URL
     server.set_endpoint("opc.tcp://localhost:4840/")
@@ -16,39 +245,50 @@ async def main():
     # Get Objects node for populating custom stuff
     object_node = server.get_objects_node()
   
-    # Populating address space with a folder and variables
+    # Populating address space with a folder and one object per station
     workstation_details = await object_node.add_folder(idx, "workstation_details")
-    
-    total_blocks_var = await workstation_details.add_variable(ua.NodeId("TB", idx), "Total_blocks", 0)
-    await total_blocks_var.set_writable()
-    
-    drilled_blocks_var = await workstation_details.add_variable(ua.NodeId("DIB", idx), "Drilled_blocks", 0)    
-    await drilled_blocks_var.set_writable()
-    
-    damaged_blocks_var = await workstation_details.add_variable(ua.NodeId("DMB", idx), "Damaged_blocks", 0)
-    await damaged_blocks_var.set_writable()
+    workstation_type = await add_workstation_type(server, idx)
+    station_variables = await add_stations(server, idx, workstation_details, workstation_type, stations, historizing=True)
+    station_kpis = await enable_kpis(server, idx, stations)
 
-    drilling_time_var = await workstation_details.add_variable(ua.NodeId("DRILL", idx), "MotorOn_time", 0.0)
-    await drilling_time_var.set_writable()
     @uamethod
-    async def show_values(parent):
-        tb_val = await total_blocks_var.read_value()
-        dib_val = await drilled_blocks_var.read_value()
-        dmb_val = await damaged_blocks_var.read_value()
-        run_val = await workstation_running_status_var.read_value()
+    async def show_values(parent, station):
+        if station not in station_variables:
+            return f"Unknown station: {station}"
+        variables = station_variables[station]
+        tb_val = await variables["TB"].read_value()
+        dib_val = await variables["DIB"].read_value()
+        dmb_val = await variables["DMB"].read_value()
+        run_val = await variables["RUN"].read_value()
         return f"Ejected_blocks: {tb_val}, Drilled_blocks: {dib_val}, Damaged_blocks: {dmb_val}, Workstation_running: {run_val}"
     
-    # Add the method to the custom object
-    await myobject.add_method(idx, 'show_values', show_values, [], [ua.VariantType.String])
+    # Add the method to the folder, the station is passed as argument
+    await workstation_details.add_method(idx, 'show_values', show_values, [ua.VariantType.String], [ua.VariantType.String])
+
+    @uamethod
+    async def get_kpis(parent, station):
+        if station not in station_kpis:
+            return ua.StatusCode(ua.StatusCodes.BadInvalidArgument)
+        return station_kpis[station].snapshot()
+
+    # Typed KPI result, one Double output argument per KPI
+    kpi_arguments = [ua.Argument(Name=name, DataType=ua.NodeId(ua.ObjectIds.Double), ValueRank=ua.ValueRank.Scalar, Description=ua.LocalizedText(name)) for short_name, name in STATION_KPIS]
+    station_argument = ua.Argument(Name="Station", DataType=ua.NodeId(ua.ObjectIds.String), ValueRank=ua.ValueRank.Scalar, Description=ua.LocalizedText("Identifier of the station"))
+    await workstation_details.add_method(idx, 'get_kpis', get_kpis, [station_argument], kpi_arguments)
 
     # Start server
     await server.start()
     
     while True:
         await asyncio.sleep(1)
+        #Gleitende Fenster auch ohne neue Zaehlerwerte altern lassen
+        for identifier, kpis in station_kpis.items():
+            await write_kpis(server, idx, identifier, kpis.snapshot())
 
 if __name__ == "__main__":
+    #Stationen koennen beim Start angegeben werden: python ServerCode_1.py B4 B5 B6
+    stations = sys.argv[1:] or STATIONS
     loop = asyncio.get_event_loop()
     loop.set_exception_handler(lambda x, y: None)  # Silently consume exceptions
-    loop.run_until_complete(main())
-    loop.run_forever()
\ No newline at end of file
+    loop.run_until_complete(main(stations))
+    loop.run_forever()
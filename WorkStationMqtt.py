@@ -3,18 +3,55 @@ from pyModbusTCP.utils import get_bits_from_int
 from pyModbusTCP.utils import set_bit
 from pyModbusTCP.utils import reset_bit
 from pyModbusTCP.utils import test_bit
-from time import sleep
+from time import monotonic, sleep
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from workstation_io import SensorSnapshot
+from workstation_io import OutputShadow
+from workstation_io import OutputBatch
+from workstation_io import ModbusConnection
+from workstation_io import CoalescingReader
+from workstation_io import RetryPolicy
+from workstation_io import ModbusIOError
+from workstation_io import SensorTimeoutError
+from workstation_io import circuit_breaker_for
+from workstation_io import DeviceLock
+from workstation_io import default_lock_manager
+from telemetry import MqttTelemetryPublisher
+from telemetry import TelemetryPipeline
+from telemetry import ChangeFilter
+from metrics import DrillTimer
+from metrics import CycleProfiler
+from sensor_trace import TraceRecorder
+from sensor_trace import INPUT_READ, OUTPUT_SYNC, OUTPUT_WRITE
 
 import datetime
 
 import multiprocessing
+import threading
 
 class WorkstationModule:
     #Konstanten
     DIGITAL_INPUT_STARTING_ADDRESS = 8001
     DIGITAL_OUTPUT_STARTING_ADDRESS = 8003
-
-    def __init__(self, ip_addr, sem_output : multiprocessing.BoundedSemaphore = None, sem_self_turning : multiprocessing.BoundedSemaphore = None, sem_opposite_turning : multiprocessing.BoundedSemaphore = None, read_write_sem = multiprocessing.BoundedSemaphore(value=1)):
+    #Telemetrie: nur geänderte Werte, höchstens alle TELEMETRY_MIN_INTERVAL Sekunden,
+    #spätestens alle TELEMETRY_HEARTBEAT_INTERVAL Sekunden der vollständige Stand
+    TELEMETRY_MIN_INTERVAL = 1.0
+    TELEMETRY_HEARTBEAT_INTERVAL = 60.0
+    #MQTT: "text" (ein Topic je Zähler) oder "binary" (ein TelemetryRecord je Sample auf workstation/<identifier>/telemetry)
+    TELEMETRY_ENCODING = "text"
+    #Übergänge werden von den Sensoren bestätigt: Abfrageintervall und Timeouts in Sekunden
+    SENSOR_POLL_INTERVAL = 0.02
+    TURNTABLE_START_TIMEOUT = 1.0
+    TURNTABLE_TIMEOUT = 5.0
+    DRILL_DOWN_TIMEOUT = 10.0
+    DRILL_UP_TIMEOUT = 10.0
+    #Prüfer und Auswerfer haben keine Endlagensensoren, ohne Bohren bekommen sie diese feste Zeit für ihre Bewegung
+    SETTLE_TIME = 0.35
+
+    def __init__(self, ip_addr, sem_output : multiprocessing.BoundedSemaphore = None, sem_self_turning : multiprocessing.BoundedSemaphore = None, sem_opposite_turning : multiprocessing.BoundedSemaphore = None, read_write_sem = None, output_verify_interval = None, persistent_connection = True, modbus_timeout = 2.0, retry_policy : RetryPolicy = None, modbus_port = 502, pipelined = False):
         """
         Konstruktor of the WorkstationModules.
 
@@ -22,12 +59,23 @@ class WorkstationModule:
         :param sem_output Semaphore for checking if the exit is currently free (doesnt have to be used)
         :param sem_selbst_drehen Semaphore to show if the stations table is currently turning (the opposite station cant use the exit while the table is turning)
         :param sem_opposite_turning  Semaphore to see if the oposite stations table is currently turning (this station cant use the exit while the table of the other station is turning)
-        :param read_write_sem Semaphore that can be used to make sure that 2 modules cant read/write at the same time.
+        :param read_write_sem DeviceLock or semaphore that can be used to make sure that 2 modules cant read/write at the same time.
+                              If None, the lock of the modbus node from default_lock_manager is used, so modules of
+                              different nodes never block each other.
+        :param output_verify_interval Seconds after which the local copy of the output register is checked against the modbus again
+                                      (None only after errors, 0 before every write)
+        :param persistent_connection Keeps the TCP session to the modbus open between requests (False connects for every request)
+        :param modbus_timeout Timeout in seconds for every modbus request
+        :param retry_policy RetryPolicy for all register accesses (attempts, backoff, deadline), a default policy is used if None
+        :param modbus_port TCP port of the modbus node (e.g. of a local StationSimulator)
+        :param pipelined Checker, drill and ejector of a cycle work in parallel instead of one after another (see process_stations).
+                         The order of the modbus requests then depends on the timing, a recorded trace can not be replayed exactly.
         """
         
         try:
-            #Erzeugt eine Verbindung zum Modbus mit der ip_addr
-            self.client = ModbusClient(host=ip_addr, auto_open=True, auto_close=True)
+            #Erzeugt eine Verbindung zum Modbus mit der ip_addr, die Session bleibt zwischen den Requests offen
+            self.client = ModbusConnection(ip_addr, port=modbus_port, timeout=modbus_timeout, persistent=persistent_connection,
+                                           probe_address=self.DIGITAL_INPUT_STARTING_ADDRESS)
         except ValueError:
             print("Error with host param")
 
@@ -40,8 +88,153 @@ class WorkstationModule:
         self.sem_self_turning = sem_self_turning
         self.sem_opposite_turning = sem_opposite_turning
 
-        self.sem = multiprocessing.BoundedSemaphore(value=1)
-        self.read_write_sem = read_write_sem
+        #Ein Lock je Modbus-Knoten. Die Aktoren halten die exklusive Seite für Schattenregister und Schreibzugriff,
+        #da sie pro Thread reentrant ist, wird pro Befehl nur ein Lock gesetzt.
+        if isinstance(read_write_sem, DeviceLock):
+            self.device_lock = read_write_sem
+        elif read_write_sem is not None:
+            self.device_lock = DeviceLock(ip_addr, semaphore=read_write_sem)
+        else:
+            self.device_lock = default_lock_manager.lock_for(ip_addr, modbus_port)
+        self.sem = self.device_lock.exclusive
+        self.read_write_sem = self.device_lock.exclusive
+        #Lesezugriffe auf benachbarte Register (8001-8003) werden zu einem Request zusammengefasst
+        self.reader = CoalescingReader(self.client, lock=self.device_lock.shared)
+
+        #Begrenzte Wiederholung fehlgeschlagener Zugriffe und ein Circuit Breaker je Modbus-Knoten
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.breaker = circuit_breaker_for(ip_addr, modbus_port)
+
+        #Lokale Kopie des Output Registers, die Aktoren schreiben nur noch ohne vorher zu lesen
+        self.output_shadow = OutputShadow(output_verify_interval)
+        #Telemetrie-Publisher der Station und die Queue davor, werden von work() erzeugt und von close() geschlossen
+        self.publisher = None
+        self.telemetry = None
+        #Offene Transaktion (OutputBatch) des jeweiligen Threads
+        self._local = threading.local()
+        #Gemessene Motorlaufzeit und Zeit bis der Bohrer unten ist, aus den geschriebenen Ausgängen
+        self.drill_timer = DrillTimer()
+        #Zeitmessung der Phasen von work() (Histogramme je Phase)
+        self.profiler = CycleProfiler(on_lap=self._progress)
+        #Wird von stop() gesetzt, work() kehrt dann nach dem laufenden Takt zurück
+        self._stop = threading.Event()
+        #Aufzeichnung der Register (TraceRecorder), wird von start_recording() gesetzt
+        self.recorder = None
+        #Uhr und Wartefunktion der Ablaufsteuerung, werden beim Abspielen einer Aufzeichnung durch eine virtuelle Uhr ersetzt
+        self.clock = monotonic
+        self.sleep = sleep
+        #Ablauf eines Takts: parallel (process_stations) oder nacheinander, Threads für Bohrer und Auswerfer
+        self.pipelined = pipelined
+        self._station_pool = None
+        #Zeigt dass eject_piece() sem_opposite_turning erworben hat, process_stations() gibt sie am Ende des Takts frei
+        self._opposite_held = False
+        #Wird bei jedem Fortschritt der Ablaufsteuerung aufgerufen (Warteschritt, Sensorabfrage, Phase), z.B. als Heartbeat
+        self.progress_hook = None
+
+    def stop(self):
+        """
+        Asks work() to return. A running cycle is finished first, waiting for a workpiece is ended at once.
+        Can be called from any thread.
+        """
+        self._stop.set()
+
+    def start_recording(self, path):
+        """
+        Records every read of the input register, every read-back of the output register and every output write
+        with a monotonic timestamp into a binary trace file (see sensor_trace). The trace can be replayed with
+        sensor_trace.replay() to check changes of the cycle logic against the recorded outputs.
+
+        :param path trace file, records are appended if it exists
+        :returns the recorder
+        :rtype TraceRecorder
+        """
+        self.stop_recording()
+        self.recorder = TraceRecorder(path, self.identifier)
+        return self.recorder
+
+    def stop_recording(self):
+        """
+        Ends the recording and closes the trace file.
+        """
+        recorder = self.recorder
+        self.recorder = None
+        if recorder is not None:
+            recorder.close()
+
+    def _trace(self, kind, value):
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(kind, value)
+
+    def _progress(self):
+        hook = self.progress_hook
+        if hook is not None:
+            hook()
+
+    def _pause(self, seconds):
+        #Wartet, endet aber sofort mit stop(). Mit ersetzter Wartefunktion (Abspielen) wird diese verwendet.
+        self._progress()
+        if self.sleep is sleep:
+            return self._stop.wait(seconds)
+        self.sleep(seconds)
+        return self._stop.is_set()
+
+    def close(self):
+        """
+        Closes the connection to the modbus and the telemetry publisher. The next register access opens the connection again.
+        """
+        self.client.close()
+        self.stop_recording()
+        if self._station_pool is not None:
+            self._station_pool.shutdown()
+            self._station_pool = None
+        if self.telemetry is not None:
+            self.telemetry.close()
+            self.telemetry = None
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+
+    def __enter__(self):
+        self.client.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connection_stats(self):
+        """
+        Returns the metrics of the modbus connection (requests, errors, reconnects, RTT).
+
+        :rtype dict
+        """
+        return self.client.stats()
+
+    def io_stats(self):
+        """
+        Returns the statistics of the register accesses (retry policy, circuit breaker, connection, lock contention).
+
+        :rtype dict
+        """
+        return {"retry": self.retry_policy.stats(), "breaker": self.breaker.stats(), "connection": self.client.stats(),
+                "lock": self.device_lock.stats()}
+
+    def drill_stats(self):
+        """
+        Returns the measured drill timing (motor-on time per workpiece, time-to-bottom, counters).
+
+        :rtype dict
+        """
+        return self.drill_timer.stats()
+
+    def profile_stats(self):
+        """
+        Returns the cycle profile: p50/p95/p99 per phase of work() and the RTT distribution per modbus function.
+        Use self.profiler.dump() for a readable table.
+
+        :rtype dict
+        """
+        return {"cycle": self.profiler.stats(), "modbus": self.client.rtt_stats()}
 
     def get_output_register(self, offset = 0, amount = 1):
         """
@@ -49,14 +242,11 @@ class WorkstationModule:
 
         :param offset Offset to DIGITAL_OUTPUT_STARTING_ADDRESS
         :param amount Amount of registers that can be read
-        :returns list of read registers (or nothing if it fails)
-        :rtype list of int or none
+        :returns list of read registers
+        :rtype list of int
+        :raises ModbusIOError if the registers can not be read (see retry_policy)
         """
-        with self.read_write_sem:
-            result = None
-            while result == None:
-                result = self.client.read_holding_registers(reg_addr=self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset,reg_nb = amount)
-            return result
+        return self.retry_policy.call(self.reader.read, self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, amount, breaker=self.breaker)
 
     def get_input_register(self, offset = 0, amount = 1):
         """
@@ -64,14 +254,30 @@ class WorkstationModule:
 
         :param offset Offset to DIGITAL_INPUT_STARTING_ADDRESS
         :param amount Amount of registers that can be read
-        :returns list of read registers (or nothing if it fails)
-        :rtype list of int or none
+        :returns list of read registers
+        :rtype list of int
+        :raises ModbusIOError if the registers can not be read (see retry_policy)
         """
-        with self.read_write_sem:
-            result = None
-            while result == None:
-                result = self.client.read_holding_registers(reg_addr=self.DIGITAL_INPUT_STARTING_ADDRESS + offset,reg_nb = amount)
-            return result
+        return self.retry_policy.call(self.reader.read, self.DIGITAL_INPUT_STARTING_ADDRESS + offset, amount, breaker=self.breaker)
+
+    def get_registers(self, input_amount = 1, output_amount = 1):
+        """
+        Returns the input and the output registers of the modbus with a single request
+        (DIGITAL_INPUT_STARTING_ADDRESS up to the last output register).
+
+        :param input_amount Amount of input registers that are read
+        :param output_amount Amount of output registers that are read
+        :returns list of input registers and list of output registers
+        :rtype tuple of two lists of int
+        :raises ModbusIOError if the registers can not be read (see retry_policy)
+        """
+        ranges = [(self.DIGITAL_INPUT_STARTING_ADDRESS, input_amount), (self.DIGITAL_OUTPUT_STARTING_ADDRESS, output_amount)]
+        def read_both():
+            inputs, outputs = self.reader.read_many(ranges)
+            if inputs == None or outputs == None:
+                return None
+            return inputs, outputs
+        return self.retry_policy.call(read_both, breaker=self.breaker)
 
     def set_output_register(self, register, offset = 0):
         """
@@ -79,164 +285,387 @@ class WorkstationModule:
 
         :param register list of int that should be written to the registers
         :param offset Offset to DIGITAL_OUTPUT_STARTING_ADDRESS
+        :raises ModbusIOError if the registers can not be written (see retry_policy)
         """
+        return self.retry_policy.call(self._write_registers, self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, register, breaker=self.breaker)
+
+    def _write_registers(self, address, register):
+        #Der Lock ist je Thread wiedereintrittsfähig. Ohne gehaltenes self.sem wird er nur während eines Versuchs gehalten.
+        #Aus _apply_outputs (Lesen-Ändern-Schreiben der lokalen Kopie) ist er dagegen über alle Versuche und Wartezeiten
+        #hinweg belegt, höchstens bis zur deadline der retry_policy, damit kein anderer Thread dazwischen schreibt.
         with self.read_write_sem:
-            result = None
-            while result == None:
-                result = self.client.write_multiple_registers(self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, register)
-            return result
+            return self.client.write_multiple_registers(address, register)
+
+    def read_state(self):
+        """
+        Reads sensors and outputs with one modbus request and takes the outputs over into the local copy (output_shadow).
+
+        :returns snapshot of all sensors and current content of the output register
+        :rtype tuple of SensorSnapshot and int
+        """
+        with self.sem:
+            inputs, outputs = self.get_registers()
+            self.output_shadow.sync(outputs[0])
+            self._trace(INPUT_READ, inputs[0])
+            self._trace(OUTPUT_SYNC, outputs[0])
+        return SensorSnapshot.from_register(inputs[0]), outputs[0]
+
+    def sync_outputs(self):
+        """
+        Reads the output register from the modbus and takes it over into the local copy (output_shadow).
+
+        :returns current content of the output register
+        :rtype int
+        """
+        with self.sem:
+            self.output_shadow.sync(self.get_output_register()[0])
+            self._trace(OUTPUT_SYNC, self.output_shadow.value)
+            return self.output_shadow.value
+
+    def _apply_outputs(self, set_bits = (), reset_bits = ()):
+        """
+        Changes bits of the local copy of the output register and writes the result without reading the register first.
+        The local copy is only read from the modbus if it is unknown or due for verification. Must be called with self.sem held.
+
+        :param set_bits bits that are set
+        :param reset_bits bits that are reset
+        """
+        if self.output_shadow.needs_sync():
+            self.output_shadow.sync(self.get_output_register()[0])
+            self._trace(OUTPUT_SYNC, self.output_shadow.value)
+        before = value = self.output_shadow.value
+        for bit in reset_bits:
+            value = reset_bit(value, bit)
+        for bit in set_bits:
+            value = set_bit(value, bit)
+        try:
+            self.set_output_register([value])
+        except Exception:
+            #Zustand des Moduls ist unbekannt, vor dem nächsten Schreiben wird wieder gelesen
+            self.output_shadow.invalidate()
+            raise
+        self.output_shadow.value = value
+        self._trace(OUTPUT_WRITE, value)
+        self.drill_timer.outputs_written(before, value)
+
+    def _update_outputs(self, set_bits = (), reset_bits = ()):
+        """
+        Sets and resets bits of the output register with a single write.
+        Inside of transaction() the bits are only collected and written when the transaction ends.
+
+        :param set_bits bits that are set
+        :param reset_bits bits that are reset
+        """
+        batch = getattr(self._local, "batch", None)
+        if batch is not None:
+            batch.add(set_bits, reset_bits)
+            return
+        with self.sem:
+            self._apply_outputs(set_bits, reset_bits)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Collects all actuator commands of the with-block and writes them with one write_multiple_registers call
+        when the block ends. If the block raises an exception, the collected commands are discarded.
+        Nested transactions are merged into the outer one. Reading the sensors inside the block is possible,
+        but the commands of the block are not visible on the modbus before the block ends.
+
+        Example:
+            with workstation.transaction():
+                workstation.lock_piece()
+                workstation.drill_on()
+                workstation.drill_down()
+        """
+        if getattr(self._local, "batch", None) is not None:
+            yield
+            return
+        batch = OutputBatch()
+        self._local.batch = batch
+        try:
+            yield
+        finally:
+            self._local.batch = None
+        if batch:
+            with self.sem:
+                self._apply_outputs(batch.set_bits, batch.reset_bits)
 
     def drill_on(self):
         """
         Turns on the drill
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = set_bit(reg[0], 0)
-            self.set_output_register(reg)
+        self._update_outputs(set_bits = (0,))
 
     def drill_off(self):
         """
         Turns of the drill
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = reset_bit(reg[0],0)
-            self.set_output_register(reg)
+        self._update_outputs(reset_bits = (0,))
 
     def drill_up(self):
         """
         Drives the drill up
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = reset_bit(reg[0], 2)
-            reg[0] = set_bit(reg[0], 3)
-            self.set_output_register(reg)
+        self._update_outputs(set_bits = (3,), reset_bits = (2,))
     
     def drill_down(self):
         """
         Drives the drill down
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = reset_bit(reg[0], 3)
-            reg[0] = set_bit(reg[0], 2)
-            self.set_output_register(reg)
+        self._update_outputs(set_bits = (2,), reset_bits = (3,))
 
     def drill_stop(self):
         """
         Stops the vertical movement of the drill.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = reset_bit(reg[0], 2)
-            reg[0] = reset_bit(reg[0], 3)
-            self.set_output_register(reg)
+        self._update_outputs(reset_bits = (2, 3))
 
     def lock_piece(self):
         """
         Activates the lock for the pieces under the drill.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = set_bit(reg[0], 4)
-            self.set_output_register(reg)
+        self._update_outputs(set_bits = (4,))
 
     def unlock_piece(self):
         """
         Deactivates the lock for the pieces under the drill.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = reset_bit(reg[0], 4)
-            self.set_output_register(reg)
+        self._update_outputs(reset_bits = (4,))
 
     def turntable_on(self):
         """
         Starts the turntable.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = set_bit(reg[0], 1)
-            self.set_output_register(reg)
+        self._update_outputs(set_bits = (1,))
 
     def turntable_off(self):
         """
         Stops the turntable.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = reset_bit(reg[0], 1)
-            self.set_output_register(reg)
+        self._update_outputs(reset_bits = (1,))
 
     def turntable_turn_single(self):
         """
-        Turns the turn table exactly for one position
+        Turns the turn table exactly for one position (can not be used inside of transaction()).
+        The turn signal is held until the turntable leaves its position.
+
+        :raises SensorTimeoutError if the turntable does not start turning within TURNTABLE_START_TIMEOUT
         """
+        if getattr(self._local, "batch", None) is not None:
+            raise RuntimeError("turntable_turn_single can not be used inside of a transaction")
         with self.sem:
-            reg = self.get_output_register()
-            reg[0] = set_bit(reg[0], 1)
-            self.set_output_register(reg)
-            sleep(0.1)
-            reg[0] = reset_bit(reg[0], 1)
-            self.set_output_register(reg)
+            self._apply_outputs(set_bits = (1,))
+            try:
+                self.wait_for_sensors(lambda snapshot: not self.check_turntable_position(snapshot), self.SENSOR_POLL_INTERVAL,
+                                      self.TURNTABLE_START_TIMEOUT, "turntable leaving its position")
+            finally:
+                self._apply_outputs(reset_bits = (1,))
 
     def checker_down(self):
         """
         Drives the checker down.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = set_bit(reg[0], 5)
-            self.set_output_register(reg)
+        self._update_outputs(set_bits = (5,))
 
     def checker_up(self):
         """
         Drives the checker up.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = reset_bit(reg[0], 5)
-            self.set_output_register(reg)
+        self._update_outputs(reset_bits = (5,))
 
     def ejector_output_extend(self):
         """
         Activates the ejactor at the exit.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = set_bit(reg[0], 6)
-            self.set_output_register(reg)
+        self._update_outputs(set_bits = (6,))
 
     def ejector_input_extend(self):
         """
          Activates the ejactor at the input.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = set_bit(reg[0], 7)
-            self.set_output_register(reg)
+        self._update_outputs(set_bits = (7,))
 
     def ejector_output_retract(self):
         """
         Deactivates the ejactor at the exit.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = reset_bit(reg[0], 6)
-            self.set_output_register(reg)
+        self._update_outputs(reset_bits = (6,))
 
     def ejector_input_retract(self):
         """
         Deactivates the ejactor at the exit.
         """
-        with self.sem:
-            reg = self.get_output_register()
-            reg[0] = reset_bit(reg[0], 6)
-            self.set_output_register(reg)
+        self._update_outputs(reset_bits = (6,))
+
+    def read_sensors(self):
+        """
+        Reads the input register once and decodes all sensors into an immutable snapshot.
+        Use it once per control tick and pass the snapshot to the check_* methods, so that
+        all decisions of the tick need only one Modbus request.
+
+        :returns snapshot of all sensors of the workstation
+        :rtype SensorSnapshot
+        """
+        #Ist die lokale Kopie des Output Registers zu überprüfen, wird sie mit demselben Request gelesen
+        if self.output_shadow.needs_sync() and self.sem.acquire(block=False):
+            try:
+                inputs, outputs = self.get_registers()
+                self.output_shadow.sync(outputs[0])
+                self._trace(OUTPUT_SYNC, outputs[0])
+            finally:
+                self.sem.release()
+        else:
+            inputs = self.get_input_register()
+        self._trace(INPUT_READ, inputs[0])
+        return SensorSnapshot.from_register(inputs[0])
+
+    def wait_for_sensors(self, condition, poll_interval = None, timeout = None, description = "condition"):
+        """
+        Reads the sensors until condition(snapshot) is true, e.g. wait_for_sensors(self.check_drill_down, timeout=10).
+
+        :param condition callable that gets a SensorSnapshot and returns a bool, e.g. one of the check_* methods
+        :param poll_interval Seconds between two reads of the input register, SENSOR_POLL_INTERVAL if None
+        :param timeout Maximum time to wait in seconds (None waits forever)
+        :param description Name of the awaited state for the error message
+        :returns the snapshot that fulfilled the condition
+        :rtype SensorSnapshot
+        :raises SensorTimeoutError if the condition was not fulfilled before the deadline
+        """
+        if poll_interval is None:
+            poll_interval = self.SENSOR_POLL_INTERVAL
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            self._progress()
+            snapshot = self.read_sensors()
+            if condition(snapshot):
+                return snapshot
+            if deadline is None:
+                self.sleep(poll_interval)
+                continue
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                raise SensorTimeoutError(description, timeout)
+            self.sleep(min(poll_interval, remaining))
+
+    def drill_workpiece(self):
+        """
+        Drills the workpiece under the drill: locks it, lowers the running drill until the drill down sensor is reached
+        and drives the drill up again until the drill up sensor is reached.
+
+        :raises SensorTimeoutError if the drill does not reach the bottom within DRILL_DOWN_TIMEOUT (the drill is driven up
+                                   and turned off before) or the top within DRILL_UP_TIMEOUT
+        """
+        #Sperren, Bohrer an und Bohrer runter werden mit einem Schreibzugriff gesetzt
+        with self.transaction():
+            self.lock_piece()
+            self.drill_on()
+            self.drill_down()
+        try:
+            self.wait_for_sensors(self.check_drill_down, timeout=self.DRILL_DOWN_TIMEOUT, description="drill down")
+        except SensorTimeoutError:
+            #Bohrer kommt nicht unten an: Bohrer hoch und aus, bevor der Fehler weitergegeben wird
+            with self.transaction():
+                self.unlock_piece()
+                self.drill_up()
+                self.drill_off()
+            raise
+        self.drill_timer.bottom_reached()
+        with self.transaction():
+            self.unlock_piece()
+            self.drill_up()
+            self.drill_off()
+        self.drill_timer.workpiece_done()
+        self.wait_for_sensors(self.check_drill_up, timeout=self.DRILL_UP_TIMEOUT, description="drill up")
+
+    def check_piece(self):
+        """
+        Waits with the lowered checker until it reports a workpiece in normal position, at most SETTLE_TIME seconds,
+        and drives the checker up.
 
-    def check_workpiece_sensor(self, sensor_id):
+        :returns True if the checker saw a workpiece in normal position
+        :rtype bool
+        """
+        try:
+            self.wait_for_sensors(self.check_workpiece, timeout=self.SETTLE_TIME, description="workpiece in normal position")
+            normal = True
+        except SensorTimeoutError:
+            #Ohne Werkstück oder mit umgedrehtem Werkstück meldet der Prüfer nie Normallage
+            normal = False
+        self.checker_up()
+        return normal
+
+    def eject_piece(self, nok, queue_to_TS = None):
+        """
+        Second half of the ejection after ejector_output_extend(): waits for the exit (sem_output) and until the
+        opposite table is not turning (sem_opposite_turning, stays acquired until the end of the cycle), reports the
+        destination to the transport system and retracts the ejector, which then gets SETTLE_TIME seconds for its movement.
+
+        :param nok True if the workpiece lies upside down (to DZA instead of WA)
+        :param queue_to_TS Queue to the transport system (optional)
+        """
+        if self.sem_output != None:
+            self.sem_output.acquire()
+        if self.sem_opposite_turning != None:
+            self.sem_opposite_turning.acquire()
+            self._opposite_held = True
+        if queue_to_TS != None:
+            queue_to_TS.put([self.identifier, 'DZA' if nok else 'WA'])
+        self.ejector_output_retract()
+        self.sleep(self.SETTLE_TIME)
+
+    def process_stations(self, drilling, eject, nok_output, queue_to_TS = None):
+        """
+        Works the three pockets of the turntable after a turn in parallel: the checker in the calling thread, the drill
+        and the ejector in threads of their own, each until its own completion (checker and drill confirmed by the sensors).
+        Returns when all three are done, so the cycle takes as long as the slowest station instead of the sum of all.
+        The modbus writes of the threads are serialized by the lock of the modbus node (self.sem).
+
+        :param drilling True if the workpiece under the drill is drilled
+        :param eject True if a workpiece at the exit is ejected
+        :param nok_output True if the workpiece at the exit lies upside down (to DZA instead of WA)
+        :param queue_to_TS Queue to the transport system (optional)
+        :returns True if the checker saw a workpiece in normal position
+        :rtype bool
+        :raises SensorTimeoutError if the drill did not reach its end position (raised after all stations are done)
+        """
+        with self.transaction():
+            self.checker_down()
+            if eject:
+                self.ejector_output_extend()
+        self.profiler.lap("checker_down")
+
+        if self._station_pool is None:
+            self._station_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="station-" + self.identifier)
+        futures = []
+        if drilling:
+            futures.append(self._station_pool.submit(self._profiled, "drill", self.drill_workpiece))
+        if eject:
+            futures.append(self._station_pool.submit(self._profiled, "eject", self.eject_piece, nok_output, queue_to_TS))
+        try:
+            try:
+                normal = self._profiled("checker", self.check_piece)
+            finally:
+                #Vor der nächsten Drehung müssen alle Stationen fertig sein, auch wenn eine davon einen Fehler hatte
+                wait(futures)
+            self.profiler.lap("stations")
+            for future in futures:
+                future.result()
+        finally:
+            #Die Sperre der gegenüberliegenden Station wird auch freigegeben, wenn eine Station einen Fehler hatte
+            if self._opposite_held:
+                self._opposite_held = False
+                self.sem_opposite_turning.release()
+
+        if eject:
+            self.ejector_input_retract()
+            self.profiler.lap("ejector_retract")
+        return normal
+
+    def _profiled(self, phase, function, *args):
+        with self.profiler.phase(phase):
+            return function(*args)
+
+    def check_workpiece_sensor(self, sensor_id, snapshot = None):
         """
         checks the workpiece sensor specified in the parameter. If the sensor is activated this function returns true,
         otherwise it returns false. If a unspecified sensor number is used, it will always return false.
@@ -245,61 +674,74 @@ class WorkstationModule:
         3-Drill
 
         :param sensor_id Number of sensor to be checked (1-3)
+        :param snapshot SensorSnapshot to evaluate, if None the input register is read
         :returns boolean to see if the sensor was activated
         :rtype bool
         """
+        if snapshot is None:
+            snapshot = self.read_sensors()
+        return snapshot.workpiece_sensor(sensor_id)
 
-        #Nummer 1 und 2 werden getauscht damit die Nummerrierung zur Annordnung der Anlage passt 
-        if sensor_id == 2:
-            sensor_id = 3
-        elif sensor_id == 3:
-            sensor_id = 2
-        elif sensor_id != 1:
-            return False
-
-        return test_bit(self.get_input_register()[0], sensor_id-1)
-
-    def check_drill_up(self):
+    def check_drill_up(self, snapshot = None):
         """
         Checks if the drill is up, if yes, this function returns true.
         Returns false, if the drill is not up OR the flag to set the drill up is not set. 
         (as an example if the drill is stopped with drill_stop())
+        :param snapshot SensorSnapshot to evaluate, if None the input register is read
         :returns boolean if the drill is up
         :rtype bool
         """
-        return test_bit(self.get_input_register()[0], 3)
+        if snapshot is None:
+            snapshot = self.read_sensors()
+        return snapshot.drill_up
 
-    def check_drill_down(self):
+    def check_drill_down(self, snapshot = None):
         """
-        Checks if the drill is up, if yes, this function returns true.
-        Returns false, if the drill is not up OR the flag to set the drill up is not set. 
+        Checks if the drill is down, if yes, this function returns true.
+        Returns false, if the drill is not down OR the flag to set the drill down is not set. 
         (as an example if the drill is stopped with drill_stop())
-        :returns boolean if the drill is up
+        :param snapshot SensorSnapshot to evaluate, if None the input register is read
+        :returns boolean if the drill is down
         :rtype bool
         """
-        return test_bit(self.get_input_register()[0], 4)
+        if snapshot is None:
+            snapshot = self.read_sensors()
+        return snapshot.drill_down
 
-    def check_turntable_position(self):
+    def check_turntable_position(self, snapshot = None):
         """
         Überprüft, ob der Drehteller in Position ist, wenn ja wird True zurückgegeben.
+        :param snapshot SensorSnapshot der ausgewertet wird, bei None wird das Eingangsregister gelesen
         :returns boolean ob Drehteller in Position ist
         :rtype bool
         """
-        return test_bit(self.get_input_register()[0], 5)
+        if snapshot is None:
+            snapshot = self.read_sensors()
+        return snapshot.turntable_in_position
 
-    def check_workpiece(self):
+    def check_workpiece(self, snapshot = None):
         """
         Überprüft, ob der der Prüfer ein Werkstück in Normallage erkennt, wenn ja wird True zurückgegeben.
+        :param snapshot SensorSnapshot der ausgewertet wird, bei None wird das Eingangsregister gelesen
         :returns boolean ob Prüfer ein Werkstück in Normallage erkennt
         :rtype bool
         """
-        return test_bit(self.get_input_register()[0], 6)
+        if snapshot is None:
+            snapshot = self.read_sensors()
+        return snapshot.workpiece_normal
 
-    def work(self, queue_to_TS = None):
+    def work(self, queue_to_TS = None, publisher = None):
         drilled=0
         damaged=0
-        import paho.mqtt.publish as publish
         hostname = "192.168.200.176"
+        #Eine dauerhafte MQTT-Verbindung statt einer neuen Verbindung pro Wert
+        if publisher is not None:
+            self.publisher = publisher
+        elif self.publisher is None:
+            self.publisher = MqttTelemetryPublisher(hostname, encoding=self.TELEMETRY_ENCODING, station=self.identifier)
+        #Veröffentlicht wird in einem eigenen Thread, ein langsamer Broker bremst den Drehteller nicht
+        if self.telemetry is None:
+            self.telemetry = TelemetryPipeline(self.publisher.publish, change_filter=ChangeFilter(self.TELEMETRY_MIN_INTERVAL, self.TELEMETRY_HEARTBEAT_INTERVAL))
         """
         Dauerschleife, die dazu führt dass sich der Drehteller dreht, wenn ein Werkstück erkannt wird. Dieses wird dann auf
         Normalposition geprüft (loch oben) und, wenn es sich in Normalposition befindet wird es im nächsten Schritt gebohrt.
@@ -311,104 +753,162 @@ class WorkstationModule:
         workpiece_eject = False        #Zeigt dass sich ein Werkstück im Ausgang befindet -> auswerfern
         workpiece_nok_output = False #Zeigt dass sich ein umgedrehtes Werkstück im Ausgang befindet -> wird nach DZA und nicht nach WA transportiert
 
-        while True:
-            
-            #Wartet bis ein Werkstück durch einen Sensor erkannt wird. (Oder sich noch ein Werkstück in abnormaler Position in der Station befindet)
+        #stop() kann aus einem anderen Thread aufgerufen werden, work() kann danach erneut gestartet werden
+        self._stop.clear()
+        while not self._stop.is_set():
+            try:
+                self.profiler.start_cycle()
             
-            while not self.check_turntable_position or (not self.check_workpiece_sensor(1) and not self.check_workpiece_sensor(2) and not self.check_workpiece_sensor(3) and not workpiece_nok and not workpiece_nok_drill):
-                sleep(0.5)
-
-            sum = drilled + damaged
-            publish.single("Total block:", sum, hostname="192.168.200.176")
-            publish.single("Drilled block:", drilled, hostname="192.168.200.176")
-            publish.single("Damaged block:", damaged, hostname="192.168.200.176")
-
-            #Dient dazu der gegenüberliegenden Bearbeitenstation zu signalisieren dass diese Bearbeitenstation sich dreht und die
-            #gegenüberliegende gerade nicht auswerfen sollte (eventuell überarbeiten um weniger Semaphoren zu benutzen)
-            if self.sem_self_turning != None:
-                self.sem_self_turning.acquire()
-
-            if self.check_workpiece_sensor(3) or workpiece_nok_drill:
-                if workpiece_nok_drill:
-                    workpiece_nok_output = True
-                workpiece_eject = True
-                workpiece_nok_drill = False
-            if workpiece_nok:
-                workpiece_nok = False
-                workpiece_nok_drill= True
+                #Wartet bis ein Werkstück durch einen Sensor erkannt wird. (Oder sich noch ein Werkstück in abnormaler Position in der Station befindet)
+                #Das Eingangsregister wird nur einmal pro Takt gelesen, alle Bedingungen werten denselben Snapshot aus
+                snapshot = self.read_sensors()
+                while not snapshot.turntable_in_position or (not snapshot.any_workpiece() and not workpiece_nok and not workpiece_nok_drill):
+                    if self._pause(0.5):
+                        return
+                    snapshot = self.read_sensors()
+                self.profiler.lap("idle_wait")
+
+                sum = drilled + damaged
+                self.telemetry.submit({"total": sum, "drilled": drilled, "damaged": damaged, "drilling_time": self.drill_timer.motor_on_total})
+
+                #Dient dazu der gegenüberliegenden Bearbeitenstation zu signalisieren dass diese Bearbeitenstation sich dreht und die
+                #gegenüberliegende gerade nicht auswerfen sollte (eventuell überarbeiten um weniger Semaphoren zu benutzen)
+                if self.sem_self_turning != None:
+                    self.sem_self_turning.acquire()
+                self.profiler.lap("turn_semaphore")
+
+                if self.check_workpiece_sensor(3, snapshot) or workpiece_nok_drill:
+                    if workpiece_nok_drill:
+                        workpiece_nok_output = True
+                    workpiece_eject = True
+                    workpiece_nok_drill = False
+                if workpiece_nok:
+                    workpiece_nok = False
+                    workpiece_nok_drill= True
             
-            #Drehteller dreht um eine Position, und es wird gewartet bis der Drehteller wieder in Position ist
-            self.turntable_turn_single()
-            while not self.check_turntable_position():
-                sleep(0.1)
-
-            #Signalisiert der gegenüberliegenden Bearbeitenstation dass die Drehung zuende ist
-            if self.sem_self_turning != None:
-                self.sem_self_turning.release()
+                #Drehteller dreht um eine Position, und es wird gewartet bis der Drehteller wieder in Position ist
+                try:
+                    self.turntable_turn_single()
+                    self.profiler.lap("turntable_turn")
+                    self.wait_for_sensors(self.check_turntable_position, timeout=self.TURNTABLE_TIMEOUT, description="turntable in position")
+                    self.profiler.lap("turntable_settle")
+                finally:
+                    #Signalisiert der gegenüberliegenden Bearbeitenstation dass die Drehung zuende ist
+                    if self.sem_self_turning != None:
+                        self.sem_self_turning.release()
 
             
 
-            #Es wird unabhängig davon geprüft ob ein Werkstück im Prüfer erkannt wird,
-            #da Werkstücke in abnormaler Position von den Sensoren nicht erkannt werden,
-            # aber vom prüfer als nicht normal erkannt werden können.   
-            self.checker_down()
-        
-            if workpiece_eject:
-                self.ejector_output_extend()  # Activate the output ejector
-
-            #Befindet sich ein Werkstück am Ausgang wird dieses ausgeworfen.
-            if workpiece_eject == True:
-                if self.sem_output != None:
-                    self.sem_output.acquire()
-
-                if self.sem_opposite_turning != None:
-                    self.sem_opposite_turning.acquire()
-
-                if queue_to_TS != None:
-                    if workpiece_nok_output:
+                if self.pipelined:
+                    #Prüfer, Bohrer und Auswerfer arbeiten parallel, vor der nächsten Drehung sind alle fertig
+                    drilling = workpiece_ok and self.check_workpiece_sensor(3)
+                    normal = self.process_stations(drilling, workpiece_eject, workpiece_nok_output, queue_to_TS)
+                    if workpiece_eject and queue_to_TS != None:
                         workpiece_nok_output = False
-                        queue_to_TS.put([self.identifier, 'DZA']) #falsch gedrehte Werkstücke nach DZA
+                    workpiece_eject = False
+                    if drilling:
+                        drilled+=1
+                    workpiece_ok = normal
+                    if not normal:
+                        workpiece_nok = True
+                        damaged+=1
+                    continue
+
+                #Es wird unabhängig davon geprüft ob ein Werkstück im Prüfer erkannt wird,
+                #da Werkstücke in abnormaler Position von den Sensoren nicht erkannt werden,
+                # aber vom prüfer als nicht normal erkannt werden können.   
+                with self.transaction():
+                    self.checker_down()
+                    if workpiece_eject:
+                        self.ejector_output_extend()  # Activate the output ejector
+                self.profiler.lap("checker_down")
+
+                #Die Sperre der gegenüberliegenden Station wird auch freigegeben, wenn der Takt mit einem Fehler abbricht
+                opposite_held = False
+                try:
+                    #Befindet sich ein Werkstück am Ausgang wird dieses ausgeworfen.
+                    if workpiece_eject == True:
+                        if self.sem_output != None:
+                            self.sem_output.acquire()
+
+                        if self.sem_opposite_turning != None:
+                            self.sem_opposite_turning.acquire()
+                            opposite_held = True
+
+                        if queue_to_TS != None:
+                            if workpiece_nok_output:
+                                workpiece_nok_output = False
+                                queue_to_TS.put([self.identifier, 'DZA']) #falsch gedrehte Werkstücke nach DZA
+                            else:
+                                queue_to_TS.put([self.identifier, 'WA']) #richtig gedrehte Werkstücke nach WA
+
+                        self.ejector_output_retract()     
+                    self.profiler.lap("eject")
+
+                    #Befindet sich in der Bohrstation ein Werkstück in Normalposition wird dieses gebohrt.
+                    #Dabei wird gewartet bis der Bohrer unten ist. Wird nicht gebohrt, dann wird SETTLE_TIME Sekunden gewartet,
+                    #damit Prüfer und Auswerfer ihre Bewegung durchführen können bevor dies abgebrochen wird.
+                    drilling = workpiece_ok and self.check_workpiece_sensor(3)
+                    if drilling:
+                        #Sperren, Bohrer an und Bohrer runter werden mit einem Schreibzugriff gesetzt
+                        with self.transaction():
+                            self.lock_piece()
+                            self.drill_on()
+                            self.drill_down()
+                        self.profiler.lap("drill_start")
+                        try:
+                            self.wait_for_sensors(self.check_drill_down, timeout=self.DRILL_DOWN_TIMEOUT, description="drill down")
+                        except SensorTimeoutError:
+                            #Bohrer kommt nicht unten an: Bohrer hoch und aus, bevor der Fehler weitergegeben wird
+                            with self.transaction():
+                                self.unlock_piece()
+                                self.drill_up()
+                                self.drill_off()
+                            raise
+                        self.drill_timer.bottom_reached()
+                        self.profiler.lap("drill_down_wait")
                     else:
-                        queue_to_TS.put([self.identifier, 'WA']) #richtig gedrehte Werkstücke nach WA
-
-                self.ejector_output_retract()     
-
-            #Befindet sich in der Bohrstation ein Werkstück in Normalposition wird dieses gebohrt.
-            #Dabei wird gewartet bis der Bohrer unten ist. Wird nicht gebohrt, dann wird 0.35 Sekunden gewartet,
-            #damit Prüfer und Auswerfer ihre Bewegung durchführen können bevor dies abgebrochen wird.
-            if self.check_workpiece_sensor(3) and workpiece_ok:
-                self.lock_piece()
-                self.drill_on()
-                self.drill_down()
-                while not self.check_drill_down():
-                    sleep(0.1)
-            else:
-                sleep(0.35)
-            #Bohrvorgang wird beendet
-            if self.check_workpiece_sensor(3) and workpiece_ok:
-                self.unlock_piece()
-                self.drill_up()
-                drilled+=1
-                self.drill_off()
-                sleep(0.1)
+                        self.sleep(self.SETTLE_TIME)
+                        self.profiler.lap("settle_sleep")
+                    #Bohrvorgang wird beendet
+                    if drilling:
+                        with self.transaction():
+                            self.unlock_piece()
+                            self.drill_up()
+                            self.drill_off()
+                        self.drill_timer.workpiece_done()
+                        drilled+=1
+                        #Weiter, sobald der Bohrer oben ist, statt einer festen Wartezeit
+                        self.wait_for_sensors(self.check_drill_up, timeout=self.DRILL_UP_TIMEOUT, description="drill up")
+                        self.profiler.lap("drill_up")
             
-            workpiece_ok = False
-
-            #Überprüfung findet statt, ob sich ein abnormales Werkstück im Prüfer befindet   
-            if self.check_workpiece():
-                workpiece_ok = True
-            else:
-                workpiece_nok = True
-                damaged+=1
-            self.checker_up()
-
-            if workpiece_eject:
-                if self.sem_opposite_turning != None:
-                    self.sem_opposite_turning.release()
+                    workpiece_ok = False
 
-                self.ejector_input_retract()
-                workpiece_eject = False
-
-
-workstation = WorkstationModule("192.168.200.234")
-workstation.work()
+                    #Überprüfung findet statt, ob sich ein abnormales Werkstück im Prüfer befindet   
+                    if self.check_workpiece():
+                        workpiece_ok = True
+                    else:
+                        workpiece_nok = True
+                        damaged+=1
+                    self.checker_up()
+                    self.profiler.lap("checker")
+                finally:
+                    if opposite_held:
+                        self.sem_opposite_turning.release()
+
+                if workpiece_eject:
+                    self.ejector_input_retract()
+                    workpiece_eject = False
+                    self.profiler.lap("ejector_retract")
+            except (ModbusIOError, SensorTimeoutError) as error:
+                #Modbus nicht erreichbar oder ein Übergang wurde nicht bestätigt: der Takt wird abgebrochen, die Station
+                #wartet bis der Circuit Breaker wieder Zugriffe erlaubt und beginnt dann mit dem nächsten Takt
+                print("Error at " + self.identifier + ": " + str(error))
+                self.output_shadow.invalidate()
+                if self._pause(max(self.breaker.retry_after(), 0.5)):
+                    return
+
+
+if __name__ == "__main__":
+    workstation = WorkstationModule("192.168.200.234")
+    workstation.work()
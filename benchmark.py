@@ -0,0 +1,90 @@
+from station_simulator import StationSimulator, workpiece_stream
+from WorkStationMqtt import WorkstationModule
+from telemetry import NullPublisher
+
+from time import perf_counter
+import argparse
+import threading
+
+
+def run_benchmark(duration = 60.0, port = 5020, normal_ratio = 0.8, seed = 1, simulator_options = None, module_options = None):
+    """
+    Runs WorkstationModule.work() against a local StationSimulator and measures the cycle.
+
+    :param duration Seconds work() runs
+    :param port TCP port of the simulator
+    :param normal_ratio Share of workpieces in normal position
+    :param seed Seed of the workpiece stream, the same seed gives the same sequence of workpieces
+    :param simulator_options dict of further StationSimulator arguments (e.g. turn_time)
+    :param module_options dict of further WorkstationModule arguments
+    :returns cycles per minute, modbus requests per cycle, phase and RTT percentiles, workpiece counters of the simulator
+             and the exception that ended work() early (or None)
+    :rtype dict
+    """
+    simulator = StationSimulator("127.0.0.1", port, stream=workpiece_stream(normal_ratio, seed), **(simulator_options or {}))
+    errors = []
+
+    with simulator:
+        workstation = WorkstationModule("127.0.0.1", modbus_port=port, **(module_options or {}))
+
+        def work():
+            try:
+                workstation.work(publisher=NullPublisher())
+            except Exception as error:
+                errors.append(error)
+
+        worker = threading.Thread(target=work, name="benchmark-work", daemon=True)
+        start = perf_counter()
+        worker.start()
+        worker.join(duration)
+        workstation.stop()
+        worker.join()
+        elapsed = perf_counter() - start
+        workstation.close()
+
+    profile = workstation.profile_stats()
+    cycles = profile["cycle"]["cycles"]
+    connection = workstation.connection_stats()
+    return {
+        "duration": elapsed,
+        "cycles": cycles,
+        "cycles_per_minute": cycles * 60.0 / elapsed,
+        "requests_per_cycle": connection["requests"] / cycles if cycles else None,
+        "requests": connection["requests"],
+        "phases": profile["cycle"]["phases"],
+        "modbus": profile["modbus"],
+        "station": simulator.stats(),
+        "error": errors[0] if errors else None,
+    }
+
+
+def print_report(result):
+    """
+    Prints the result of run_benchmark() as a table, times in milliseconds.
+    """
+    print("duration %.1f s, %d cycles, %.1f cycles/min, %.1f modbus requests/cycle" % (
+        result["duration"], result["cycles"], result["cycles_per_minute"], result["requests_per_cycle"] or 0.0))
+    print("station: %s" % result["station"])
+    print("%-26s %8s %9s %9s %9s %9s" % ("phase / modbus call", "count", "mean", "p50", "p95", "p99"))
+    for name, stats in list(result["phases"].items()) + list(result["modbus"].items()):
+        if not stats["count"]:
+            continue
+        print("%-26s %8d %9.2f %9.2f %9.2f %9.2f" % (name, stats["count"], stats["mean"] * 1000, stats["p50"] * 1000,
+                                                     stats["p95"] * 1000, stats["p99"] * 1000))
+    if result["error"] is not None:
+        print("work() ended with %r" % result["error"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark of WorkstationModule.work() against the station simulator")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds work() runs")
+    parser.add_argument("--port", type=int, default=5020, help="TCP port of the simulator")
+    parser.add_argument("--normal-ratio", type=float, default=0.8, help="share of workpieces in normal position")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the workpiece stream")
+    parser.add_argument("--turn-time", type=float, default=0.5, help="seconds the turntable needs for one position")
+    parser.add_argument("--drill-travel-time", type=float, default=0.3, help="seconds the drill needs from top to bottom")
+    parser.add_argument("--pipelined", action="store_true", help="checker, drill and ejector work in parallel")
+    arguments = parser.parse_args()
+    print_report(run_benchmark(arguments.duration, arguments.port, arguments.normal_ratio, arguments.seed,
+                               {"turn_time": arguments.turn_time, "drill_travel_time": arguments.drill_travel_time},
+                               {"pipelined": arguments.pipelined}))
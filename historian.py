@@ -0,0 +1,367 @@
+from array import array
+from datetime import datetime, timedelta, timezone
+from asyncua import ua
+from asyncua.common.callback import CallbackType
+from asyncua.server.history import HistoryManager, HistoryStorageInterface
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+#Unterstützte Aggregate für ReadProcessed
+AGGREGATES = {
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Minimum): "min",
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Maximum): "max",
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Average): "avg",
+}
+#Priorität des PostWrite-Listeners (der CallbackService hält je Priorität nur einen Listener)
+POST_WRITE_PRIORITY = 10
+
+
+def to_ns(timestamp):
+    """
+    :param timestamp datetime, naive values are taken as UTC
+    :returns nanoseconds since 1970-01-01 UTC
+    :rtype int
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (timestamp - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def from_ns(timestamp_ns):
+    """
+    :param timestamp_ns nanoseconds since 1970-01-01 UTC
+    :returns aware UTC datetime
+    :rtype datetime
+    """
+    return EPOCH + timedelta(microseconds=timestamp_ns // 1000)
+
+
+def _unspecified(timestamp):
+    return timestamp is None or timestamp <= ua.get_win_epoch()
+
+
+class RingBuffer:
+    """
+    Fixed-capacity ring buffer of (timestamp, value) pairs in two preallocated arrays. Appending is O(1) and
+    overwrites the oldest entry when the buffer is full, entries older than the retention are dropped on append.
+    Timestamps must be appended in ascending order, range queries use binary search.
+    """
+
+    def __init__(self, capacity, retention = None):
+        """
+        :param capacity maximum number of entries
+        :param retention maximum age of the entries as timedelta, None to keep entries until they are overwritten
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.retention_ns = None if retention is None else retention // timedelta(microseconds=1) * 1000
+        self.timestamps = array("q", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _physical(self, index):
+        return (self.start + index) % self.capacity
+
+    def timestamp(self, index):
+        """
+        :param index logical index, 0 is the oldest entry
+        :rtype int
+        """
+        return self.timestamps[self._physical(index)]
+
+    def value(self, index):
+        """
+        :param index logical index, 0 is the oldest entry
+        :rtype float
+        """
+        return self.values[self._physical(index)]
+
+    def append(self, timestamp_ns, value):
+        """
+        Adds an entry, overwrites the oldest one if the buffer is full.
+        :param timestamp_ns timestamp in ns since 1970, not older than the newest entry
+        :param value numeric value
+        """
+        if self.size and timestamp_ns < self.timestamp(self.size - 1):
+            #Zeitstempel aus der Vergangenheit ans Ende klemmen, damit die Ordnung für die Binärsuche erhalten bleibt
+            timestamp_ns = self.timestamp(self.size - 1)
+        if self.size == self.capacity:
+            position = self.start
+            self.start = (self.start + 1) % self.capacity
+        else:
+            position = self._physical(self.size)
+            self.size += 1
+        self.timestamps[position] = timestamp_ns
+        self.values[position] = value
+        self.expire(timestamp_ns)
+
+    def expire(self, now_ns):
+        """
+        Drops the entries older than the retention.
+        :param now_ns current time in ns since 1970
+        """
+        if self.retention_ns is None:
+            return
+        limit = now_ns - self.retention_ns
+        while self.size and self.timestamps[self.start] < limit:
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+
+    def bisect_left(self, timestamp_ns):
+        """
+        :returns logical index of the first entry with a timestamp >= timestamp_ns
+        :rtype int
+        """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp_ns:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def bisect_right(self, timestamp_ns):
+        """
+        :returns logical index after the last entry with a timestamp <= timestamp_ns
+        :rtype int
+        """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) <= timestamp_ns:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def range(self, start_ns = None, end_ns = None):
+        """
+        :param start_ns first timestamp (inclusive), None for the oldest entry
+        :param end_ns last timestamp (inclusive), None for the newest entry
+        :returns logical index range of the entries in the interval
+        :rtype range
+        """
+        first = 0 if start_ns is None else self.bisect_left(start_ns)
+        last = self.size if end_ns is None else self.bisect_right(end_ns)
+        return range(first, max(first, last))
+
+
+class Historian(HistoryStorageInterface):
+    """
+    In-memory history storage with one RingBuffer per historized variable. The memory use is fixed by the
+    capacity, no matter how long the server runs. Serves raw reads and min/max/avg per bucket for ReadProcessed.
+    """
+
+    def __init__(self, capacity = 10000, retention = timedelta(days=1), max_history_data_response_size = 10000, max_processed_buckets = 10000):
+        """
+        :param capacity number of values kept per variable
+        :param retention maximum age of the kept values as timedelta, None to keep them until they are overwritten
+        :param max_history_data_response_size maximum number of values per response, the rest is read with continuation points
+        :param max_processed_buckets maximum number of buckets of one ReadProcessed request
+        """
+        super().__init__(max_history_data_response_size)
+        self.capacity = capacity
+        self.retention = retention
+        self.max_processed_buckets = max_processed_buckets
+        self.buffers = {}
+        self.variant_types = {}
+
+    async def init(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def new_historized_node(self, node_id, period, count = 0):
+        """
+        Creates the ring buffer of a variable.
+        :param node_id NodeId of the variable
+        :param period retention as timedelta, the historian default if None
+        :param count capacity, the historian default if 0
+        """
+        self.buffers[node_id] = RingBuffer(count or self.capacity, period or self.retention)
+
+    async def save_node_value(self, node_id, datavalue):
+        """
+        Stores a written value with its source timestamp (server time if missing).
+        :param node_id NodeId of the variable
+        :param datavalue the written DataValue
+        """
+        buffer = self.buffers.get(node_id)
+        if buffer is None or datavalue.Value is None or datavalue.Value.Value is None:
+            return
+        timestamp = datavalue.SourceTimestamp or datavalue.ServerTimestamp or datetime.now(timezone.utc)
+        self.variant_types.setdefault(node_id, datavalue.Value.VariantType)
+        buffer.append(to_ns(timestamp), float(datavalue.Value.Value))
+
+    def _datavalue(self, node_id, buffer, index):
+        variant_type = self.variant_types.get(node_id, ua.VariantType.Double)
+        value = buffer.value(index)
+        if variant_type == ua.VariantType.Boolean:
+            value = bool(value)
+        elif variant_type != ua.VariantType.Double and variant_type != ua.VariantType.Float:
+            value = int(value)
+        timestamp = from_ns(buffer.timestamp(index))
+        return ua.DataValue(ua.Variant(value, variant_type), SourceTimestamp=timestamp, ServerTimestamp=timestamp)
+
+    async def read_node_history(self, node_id, start, end, nb_values):
+        """
+        Raw read of a variable. If only the end time is given, the values are returned newest first,
+        as well as if start is after end.
+        :param node_id NodeId of the variable
+        :param start start time, unspecified if None or the UA epoch
+        :param end end time, unspecified if None or the UA epoch
+        :param nb_values maximum number of values, 0 for no limit
+        :returns list of DataValues and the timestamp to continue from (None if complete)
+        :rtype tuple
+        """
+        buffer = self.buffers.get(node_id)
+        if buffer is None:
+            return [], None
+        start_ns = None if _unspecified(start) else to_ns(start)
+        end_ns = None if _unspecified(end) else to_ns(end)
+        if start_ns is not None and end_ns is not None and start_ns > end_ns:
+            indices = list(reversed(buffer.range(end_ns, start_ns)))
+        elif start_ns is None and end_ns is not None:
+            indices = list(reversed(buffer.range(None, end_ns)))
+        else:
+            indices = list(buffer.range(start_ns, end_ns))
+
+        if nb_values and len(indices) > nb_values:
+            indices = indices[:nb_values]
+        cont = None
+        if len(indices) > self.max_history_data_response_size:
+            cont = from_ns(buffer.timestamp(indices[self.max_history_data_response_size]))
+            indices = indices[:self.max_history_data_response_size]
+        return [self._datavalue(node_id, buffer, index) for index in indices], cont
+
+    def read_processed(self, node_id, start, end, interval, aggregate):
+        """
+        Computes an aggregate per bucket of the interval [start, end) in one pass over the raw values.
+        :param node_id NodeId of the variable
+        :param start start time
+        :param end end time
+        :param interval bucket length in ms, 0 for one bucket over the whole interval
+        :param aggregate "min", "max" or "avg"
+        :returns one DataValue per bucket with the bucket start as timestamp, BadNoData for empty buckets
+        :rtype list
+        :raises ua.UaStatusCodeError BadTooManyOperations if the interval has more than max_processed_buckets buckets
+        """
+        start_ns, end_ns = to_ns(start), to_ns(end)
+        if end_ns < start_ns:
+            start_ns, end_ns = end_ns, start_ns
+        bucket_ns = int(interval * 1000000) or max(end_ns - start_ns, 1)
+        count = max(1, -(-(end_ns - start_ns) // bucket_ns))
+        #Die Anzahl der Buckets bestimmt der Client, sie wird begrenzt bevor dafür Speicher angelegt wird
+        if count > self.max_processed_buckets:
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadTooManyOperations)
+        results = [None] * count
+        sums = [0.0] * count
+        sizes = [0] * count
+
+        buffer = self.buffers.get(node_id)
+        if buffer is not None:
+            for index in buffer.range(start_ns, end_ns - 1):
+                bucket = (buffer.timestamp(index) - start_ns) // bucket_ns
+                value = buffer.value(index)
+                sums[bucket] += value
+                sizes[bucket] += 1
+                current = results[bucket]
+                if current is None or (aggregate == "min" and value < current) or (aggregate == "max" and value > current):
+                    results[bucket] = value
+
+        datavalues = []
+        for bucket in range(count):
+            timestamp = from_ns(start_ns + bucket * bucket_ns)
+            if not sizes[bucket]:
+                datavalues.append(ua.DataValue(StatusCode=ua.StatusCode(ua.StatusCodes.BadNoData), SourceTimestamp=timestamp, ServerTimestamp=timestamp))
+                continue
+            value = sums[bucket] / sizes[bucket] if aggregate == "avg" else results[bucket]
+            datavalues.append(ua.DataValue(ua.Variant(value, ua.VariantType.Double), SourceTimestamp=timestamp, ServerTimestamp=timestamp))
+        return datavalues
+
+    def stats(self):
+        """
+        :returns number of stored values and capacity per historized variable
+        :rtype dict
+        """
+        return {node_id.to_string(): {"values": len(buffer), "capacity": buffer.capacity} for node_id, buffer in self.buffers.items()}
+
+
+class HistorianManager(HistoryManager):
+    """
+    HistoryManager that records every successful Write of a historized variable (instead of sampling them with an
+    internal subscription) and additionally answers ReadProcessed requests with the Minimum, Maximum and Average
+    aggregates of a Historian.
+    """
+
+    def __init__(self, iserver, historian = None):
+        """
+        :param iserver InternalServer of the asyncua server
+        :param historian Historian used as storage, a default Historian if None
+        """
+        super().__init__(iserver)
+        self.storage = historian or Historian()
+        self._historized = set()
+        self._callback_registered = False
+
+    async def historize_data_change(self, node, period = None, count = 0):
+        """
+        Starts recording the writes of a variable.
+        :param node the variable
+        :param period retention as timedelta, the historian default if None
+        :param count capacity, the historian default if 0
+        """
+        if node.nodeid in self._historized:
+            raise ua.UaError(f"Node {node} is already historized")
+        await self.storage.new_historized_node(node.nodeid, period, count)
+        self._historized.add(node.nodeid)
+        if not self._callback_registered:
+            self.iserver.callback_service.addListener(CallbackType.PostWrite, self._post_write, POST_WRITE_PRIORITY)
+            self._callback_registered = True
+
+    async def dehistorize(self, node):
+        """
+        Stops recording a variable, the stored values remain readable.
+        :param node the variable
+        """
+        self._historized.discard(node.nodeid)
+
+    async def _post_write(self, event, dispatcher):
+        for write_value, status in zip(event.request_params.NodesToWrite, event.response_params):
+            if write_value.AttributeId == ua.AttributeIds.Value and write_value.NodeId in self._historized and status.is_good():
+                await self.storage.save_node_value(write_value.NodeId, write_value.Value)
+
+    async def read_history(self, params):
+        """
+        HistoryRead service, ReadProcessedDetails are handled here, everything else by the HistoryManager.
+        """
+        details = params.HistoryReadDetails
+        if not isinstance(details, ua.ReadProcessedDetails):
+            return await super().read_history(params)
+
+        results = []
+        for position, rv in enumerate(params.NodesToRead):
+            result = ua.HistoryReadResult()
+            aggregate_id = details.AggregateType[position] if position < len(details.AggregateType) else None
+            aggregate = AGGREGATES.get(aggregate_id)
+            if aggregate is None:
+                result.StatusCode = ua.StatusCode(ua.StatusCodes.BadAggregateNotSupported)
+            elif rv.NodeId not in self.storage.buffers:
+                result.StatusCode = ua.StatusCode(ua.StatusCodes.BadHistoryOperationUnsupported)
+            else:
+                try:
+                    datavalues = self.storage.read_processed(rv.NodeId, details.StartTime, details.EndTime, details.ProcessingInterval, aggregate)
+                except ua.UaStatusCodeError as error:
+                    result.StatusCode = ua.StatusCode(error.code)
+                else:
+                    result.HistoryData = ua.HistoryData()
+                    result.HistoryData.DataValues = datavalues
+            results.append(result)
+        return results
@@ -0,0 +1,136 @@
+from array import array
+from time import monotonic
+from typing import NamedTuple
+
+
+#Fenster der Durchsatz-KPIs in Sekunden (1 min und 15 min)
+KPI_WINDOWS = (60.0, 900.0)
+
+
+class KpiValues(NamedTuple):
+    """
+    Derived KPIs of a workstation.
+    """
+    blocks_per_minute_1min: float
+    blocks_per_minute_15min: float
+    damage_ratio: float
+    drill_utilization: float
+
+
+class SlidingWindowCounter:
+    """
+    Sum over a sliding time window, kept in a fixed number of buckets. Adding and reading is O(1) (advancing
+    the window clears at most one bucket per elapsed bucket length, bounded by the number of buckets).
+    The window covers between buckets - 1 and buckets bucket lengths, because the newest bucket is still filling.
+    """
+
+    def __init__(self, window, buckets = 60):
+        """
+        :param window length of the window in seconds
+        :param buckets number of buckets, the resolution of the window is window / buckets
+        """
+        self.window = window
+        self.buckets = buckets
+        self.bucket_length = window / buckets
+        self.counts = array("d", bytes(8 * buckets))
+        self.sum = 0.0
+        self.current = None
+
+    def _advance(self, now):
+        index = int(now // self.bucket_length)
+        if self.current is None:
+            self.current = index
+            return
+        steps = index - self.current
+        if steps <= 0:
+            return
+        for step in range(1, min(steps, self.buckets) + 1):
+            position = (self.current + step) % self.buckets
+            self.sum -= self.counts[position]
+            self.counts[position] = 0.0
+        self.current = index
+
+    def add(self, amount, now):
+        """
+        :param amount value added to the window
+        :param now current time in seconds (monotonic)
+        """
+        self._advance(now)
+        self.counts[self.current % self.buckets] += amount
+        self.sum += amount
+
+    def total(self, now):
+        """
+        :param now current time in seconds (monotonic)
+        :returns sum of the values added within the window
+        :rtype float
+        """
+        self._advance(now)
+        return self.sum
+
+
+class StationKpis:
+    """
+    Incremental KPIs of one workstation from its cumulative counters (Total_blocks, Damaged_blocks, MotorOn_time).
+    Every counter update is O(1): only the difference to the previous value is added to the accumulators.
+    A counter that goes down (workstation restarted) counts its new value as difference.
+    The first value of each counter is the baseline and does not count as throughput or drilling time.
+    """
+
+    def __init__(self, clock = monotonic):
+        """
+        :param clock function returning the current time in seconds
+        """
+        self.clock = clock
+        self.throughput = [SlidingWindowCounter(window) for window in KPI_WINDOWS]
+        self.last = {}
+        self.started = None
+        self.total = 0
+        self.damaged = 0
+        self.motor_on = 0.0
+
+    def update(self, name, value, now = None):
+        """
+        Adds a new counter value.
+        :param name "total", "drilled", "damaged" or "drilling_time"
+        :param value the new cumulative value
+        :param now current time in seconds, clock() if None
+        """
+        if now is None:
+            now = self.clock()
+        if self.started is None:
+            self.started = now
+        previous = self.last.get(name)
+        self.last[name] = value
+        if previous is None:
+            delta, baseline = value, True
+        else:
+            delta, baseline = (value - previous if value >= previous else value), False
+
+        if name == "total":
+            self.total += delta
+            if not baseline:
+                for counter in self.throughput:
+                    counter.add(delta, now)
+        elif name == "damaged":
+            self.damaged += delta
+        elif name == "drilling_time" and not baseline:
+            self.motor_on += delta
+
+    def snapshot(self, now = None):
+        """
+        :param now current time in seconds, clock() if None
+        :returns the current KPIs: blocks per minute per window, damaged / total blocks and the share of the
+                 time since the first update the drill motor was on
+        :rtype KpiValues
+        """
+        if now is None:
+            now = self.clock()
+        elapsed = 0.0 if self.started is None else now - self.started
+        rates = []
+        for counter in self.throughput:
+            span = min(counter.window, elapsed)
+            rates.append(counter.total(now) * 60.0 / span if span > 0 else 0.0)
+        damage_ratio = self.damaged / self.total if self.total else 0.0
+        utilization = min(1.0, self.motor_on / elapsed) if elapsed > 0 else 0.0
+        return KpiValues(*rates, damage_ratio, utilization)
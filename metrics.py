@@ -0,0 +1,280 @@
+from array import array
+from contextlib import contextmanager
+from math import log10
+from time import monotonic, perf_counter
+
+
+class Histogram:
+    """
+    Streaming histogram with logarithmic buckets for durations in seconds. Recording is O(1) and the memory is fixed,
+    percentiles are exact up to the bucket width (about 5 % relative error with 50 buckets per decade).
+    """
+
+    def __init__(self, lowest = 1e-5, highest = 1e3, buckets_per_decade = 50):
+        """
+        :param lowest smallest value that is resolved, smaller values land in the first bucket
+        :param highest largest value that is resolved, larger values land in the last bucket
+        :param buckets_per_decade number of buckets per power of ten
+        """
+        self.lowest = lowest
+        self.buckets_per_decade = buckets_per_decade
+        self.size = int(log10(highest / lowest) * buckets_per_decade) + 1
+        self.counts = array("Q", bytes(8 * self.size))
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """
+        :param value the measured value
+        """
+        if value > self.lowest:
+            index = min(int(log10(value / self.lowest) * self.buckets_per_decade), self.size - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        :param percent percentile between 0 and 100
+        :returns upper bound of the bucket that contains the percentile, None if nothing was recorded
+        :rtype float
+        """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                upper = self.lowest * 10 ** ((index + 1) / self.buckets_per_decade)
+                return min(max(upper, self.min), self.max)
+        return self.max
+
+    def stats(self):
+        """
+        :returns count, mean, min, max and the percentiles p50, p95 and p99
+        :rtype dict
+        """
+        return {"count": self.count, "mean": self.sum / self.count if self.count else None, "min": self.min, "max": self.max,
+                "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99)}
+
+    def reset(self):
+        """
+        Removes all recorded values.
+        """
+        for index in range(self.size):
+            self.counts[index] = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+
+class DrillTimer:
+    """
+    Measures the drill from the written output register: the motor-on time between the writes that set and reset
+    the drill motor bit and the time-to-bottom between the write that sets the drill down bit and the moment the
+    drill down sensor is seen. The motor-on time is accumulated per workpiece.
+    """
+    MOTOR_BIT = 0
+    DOWN_BIT = 2
+
+    def __init__(self, clock = perf_counter):
+        """
+        :param clock monotonic high-resolution clock in seconds
+        """
+        self.clock = clock
+        self.motor_on_since = None
+        self.down_since = None
+        #Motorlaufzeit der abgeschlossenen Einschaltungen, gesamt und seit dem letzten Werkstück
+        self.motor_on_total = 0.0
+        self.motor_on_workpiece = 0.0
+        self.motor_starts = 0
+        self.workpieces = 0
+        self.motor_on_histogram = Histogram()
+        self.time_to_bottom_histogram = Histogram()
+
+    def outputs_written(self, before, after, now = None):
+        """
+        Called after every successful write of the output register.
+        :param before output register before the write
+        :param after output register after the write
+        :param now time of the write, clock() if None
+        """
+        if now is None:
+            now = self.clock()
+        motor_before = before >> self.MOTOR_BIT & 1
+        motor_after = after >> self.MOTOR_BIT & 1
+        if not motor_before and motor_after:
+            self.motor_on_since = now
+            self.motor_starts += 1
+        elif motor_before and not motor_after and self.motor_on_since is not None:
+            span = now - self.motor_on_since
+            self.motor_on_total += span
+            self.motor_on_workpiece += span
+            self.motor_on_since = None
+
+        down_before = before >> self.DOWN_BIT & 1
+        down_after = after >> self.DOWN_BIT & 1
+        if not down_before and down_after:
+            self.down_since = now
+        elif down_before and not down_after:
+            self.down_since = None
+
+    def bottom_reached(self, now = None):
+        """
+        Called when check_drill_down() is true the first time after drill_down().
+        :param now time the sensor was seen, clock() if None
+        :returns time from the drill down write to the sensor in seconds, None if the drill was not lowered
+        :rtype float
+        """
+        if self.down_since is None:
+            return None
+        if now is None:
+            now = self.clock()
+        duration = now - self.down_since
+        self.down_since = None
+        self.time_to_bottom_histogram.record(duration)
+        return duration
+
+    def workpiece_done(self):
+        """
+        Closes the motor-on time of the current workpiece, called after drill_off().
+        :returns motor-on time of the workpiece in seconds
+        :rtype float
+        """
+        duration = self.motor_on_workpiece
+        self.motor_on_workpiece = 0.0
+        self.workpieces += 1
+        self.motor_on_histogram.record(duration)
+        return duration
+
+    def motor_on_time(self, now = None):
+        """
+        :param now current time, clock() if None
+        :returns accumulated motor-on time in seconds including a running motor
+        :rtype float
+        """
+        if self.motor_on_since is None:
+            return self.motor_on_total
+        if now is None:
+            now = self.clock()
+        return self.motor_on_total + now - self.motor_on_since
+
+    def stats(self):
+        """
+        :returns counters and the histograms of motor-on time per workpiece and time-to-bottom
+        :rtype dict
+        """
+        return {"motor_on_total": self.motor_on_time(), "motor_starts": self.motor_starts, "workpieces": self.workpieces,
+                "motor_on": self.motor_on_histogram.stats(), "time_to_bottom": self.time_to_bottom_histogram.stats()}
+
+
+class CycleProfiler:
+    """
+    Per-phase timing of a cyclic state machine. lap() closes the current phase and starts the next one, so the
+    phases of a cycle add up to the cycle time. Every phase has its own streaming Histogram.
+    If a report function is given, the statistics are handed to it every report_interval seconds at the start of a cycle.
+    """
+
+    def __init__(self, clock = perf_counter, report = None, report_interval = 60.0, on_lap = None):
+        """
+        :param clock monotonic high-resolution clock in seconds
+        :param report function report(stats) that publishes the statistics periodically (optional)
+        :param report_interval seconds between two reports
+        :param on_lap function called without arguments at every lap and cycle start, e.g. to feed a watchdog (optional)
+        """
+        self.clock = clock
+        self.report = report
+        self.report_interval = report_interval
+        self.on_lap = on_lap
+        self.histograms = {}
+        self.cycles = 0
+        self._cycle_start = None
+        self._last = None
+        self._last_report = monotonic()
+
+    def record(self, phase, duration):
+        """
+        :param phase name of the phase
+        :param duration duration in seconds
+        """
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = Histogram()
+        histogram.record(duration)
+
+    def start_cycle(self, now = None):
+        """
+        Ends the previous cycle (recorded as phase "cycle") and starts a new one.
+        :param now current time, clock() if None
+        """
+        if now is None:
+            now = self.clock()
+        if self._cycle_start is not None:
+            self.record("cycle", now - self._cycle_start)
+            self.cycles += 1
+        self._cycle_start = self._last = now
+        if self.on_lap is not None:
+            self.on_lap()
+        if self.report is not None and monotonic() - self._last_report >= self.report_interval:
+            self._last_report = monotonic()
+            self.report(self.stats())
+
+    def lap(self, phase, now = None):
+        """
+        Records the time since the previous lap (or the start of the cycle) as the given phase.
+        :param phase name of the phase that just ended
+        :param now current time, clock() if None
+        """
+        if now is None:
+            now = self.clock()
+        if self._last is not None:
+            self.record(phase, now - self._last)
+        self._last = now
+        if self.on_lap is not None:
+            self.on_lap()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Records the duration of the with-block as the given phase, independent of the laps.
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - start)
+
+    def stats(self):
+        """
+        :returns number of cycles and count, mean, min, max, p50, p95 and p99 per phase
+        :rtype dict
+        """
+        return {"cycles": self.cycles, "phases": {phase: histogram.stats() for phase, histogram in self.histograms.items()}}
+
+    def dump(self, file = None):
+        """
+        Prints a table of the phases with count, mean and percentiles in milliseconds.
+        :param file file to print to, stdout if None
+        """
+        print("%-20s %8s %9s %9s %9s %9s %9s" % ("phase", "count", "mean", "p50", "p95", "p99", "max"), file=file)
+        for phase, histogram in self.histograms.items():
+            stats = histogram.stats()
+            print("%-20s %8d %9.2f %9.2f %9.2f %9.2f %9.2f" % (phase, stats["count"], stats["mean"] * 1000, stats["p50"] * 1000,
+                                                             stats["p95"] * 1000, stats["p99"] * 1000, stats["max"] * 1000), file=file)
+
+    def reset(self):
+        """
+        Removes all recorded phases.
+        """
+        self.histograms = {}
+        self.cycles = 0
@@ -0,0 +1,236 @@
+from metrics import Histogram
+
+from time import monotonic_ns, perf_counter
+import multiprocessing
+import os
+import queue
+import struct
+
+
+#Eintrag (16 Byte): Stations-ID (6 Byte ASCII), Ziel, reserviert, monotoner Zeitstempel des put() in ns
+ROUTING_RECORD = struct.Struct("<6sBBQ")
+#Ziele des Transportsystems und ihr Code im Eintrag
+DESTINATION_CODES = {"WA": 1, "DZA": 2}
+DESTINATIONS = {code: destination for destination, code in DESTINATION_CODES.items()}
+
+
+class RoutingRing:
+    """
+    Ring buffer in shared memory for the routing decisions of the stations, a drop-in for the multiprocessing.Queue
+    queue_to_TS: put([identifier, 'WA']) / put([identifier, 'DZA']) and get() -> [identifier, destination].
+    Every decision is a fixed ROUTING_RECORD that is written into the buffer in place, without pickling, pipe and
+    feeder thread. Two counting semaphores (items and free slots) let get() and put() block with a timeout.
+    Several producers (stations) serialize on a lock (multi_producer=True), there must be only one consumer.
+    Like the other multiprocessing objects, the ring is handed to the processes when they are started.
+
+    A producer that is killed inside put() can not release the lock or finish its entry. The producer holding the
+    ring is noted in shared memory, and the consumer calls recover() with the pid of every producer that ended, which
+    gives the reserved slot back (the decision is lost) or finishes the entry and releases the lock. Until then
+    put() of the other producers raises queue.Full after LOCK_TIMEOUT instead of waiting forever.
+    """
+    #Maximale Wartezeit in Sekunden auf den Lock der Produzenten
+    LOCK_TIMEOUT = 1.0
+    #Schritt des Produzenten, der den Ring hält: Platz belegt, Eintrag an den Konsumenten übergeben, Zähler erhöhen
+    RESERVED = 0
+    HANDED_OVER = 1
+    COUNTING = 2
+
+    def __init__(self, capacity = 1024, multi_producer = True):
+        """
+        :param capacity number of records the ring holds, put() blocks (or raises queue.Full) when it is full
+        :param multi_producer False if only one process puts, saves the producer lock
+        """
+        self.capacity = capacity
+        self._buffer = multiprocessing.RawArray("B", capacity * ROUTING_RECORD.size)
+        #Fortlaufende Schreib- und Leseposition, der Platz im Ring ist Position % capacity
+        self._positions = multiprocessing.RawArray("Q", 2)
+        #Geschriebene Einträge, put() die den Ring voll vorfanden, höchster Füllstand
+        self._counters = multiprocessing.RawArray("Q", 3)
+        #Produzent, der den Ring gerade hält: pid (0 für keinen), Schreibposition, Schritt
+        self._owner = multiprocessing.RawArray("q", 3)
+        self._items = multiprocessing.Semaphore(0)
+        self._free = multiprocessing.Semaphore(capacity)
+        self._put_lock = multiprocessing.Lock() if multi_producer else None
+        self._init_local()
+
+    def _init_local(self):
+        #Latenz von put() bis get(), wird im Prozess des Konsumenten gemessen
+        self.latency = Histogram()
+        self.gets = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("latency", "gets"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local()
+
+    def put(self, item, block = True, timeout = None):
+        """
+        Appends a routing decision.
+
+        :param item [identifier, destination] with an identifier of at most 6 ASCII characters and 'WA' or 'DZA'
+        :param block waits for a free slot if the ring is full
+        :param timeout maximum time to wait in seconds (None waits forever)
+        :raises ValueError if identifier or destination can not be encoded
+        :raises queue.Full if there was no free slot or the lock was not free within LOCK_TIMEOUT
+        """
+        identifier, destination = item
+        station = identifier.encode("ascii")
+        if len(station) > 6 or destination not in DESTINATION_CODES:
+            raise ValueError("can not encode routing decision %r" % (item,))
+        timestamp = monotonic_ns()
+
+        if not self._free.acquire(False):
+            self._count_full()
+            if not block or not self._free.acquire(True, timeout):
+                raise queue.Full
+        if not self._enter(self.RESERVED):
+            self._free.release()
+            raise queue.Full
+        try:
+            position = self._positions[0]
+            ROUTING_RECORD.pack_into(self._buffer, position % self.capacity * ROUTING_RECORD.size,
+                                     station, DESTINATION_CODES[destination], 0, timestamp)
+            #Die Semaphore ist zugleich die Speicherbarriere: der Konsument liest den Eintrag erst nach dem release().
+            #Die Schreibposition wird erst danach veröffentlicht, so bleibt sie bei einem Abbruch davor unverändert.
+            self._items.release()
+            self._owner[2] = self.HANDED_OVER
+            self._positions[0] = position + 1
+            self._counters[0] += 1
+            depth = position + 1 - self._positions[1]
+            if depth > self._counters[2]:
+                self._counters[2] = depth
+        finally:
+            self._leave()
+
+    def _count_full(self):
+        if self._enter(self.COUNTING):
+            self._counters[1] += 1
+            self._leave()
+
+    def _enter(self, step):
+        #Nimmt den Lock der Produzenten und vermerkt diesen Prozess für recover()
+        lock = self._put_lock
+        if lock is not None and not lock.acquire(True, self.LOCK_TIMEOUT):
+            return False
+        self._owner[1] = self._positions[0]
+        self._owner[2] = step
+        self._owner[0] = os.getpid()
+        return True
+
+    def _leave(self):
+        self._owner[0] = 0
+        if self._put_lock is not None:
+            self._put_lock.release()
+
+    def recover(self, pid):
+        """
+        Cleans up after a producer process that ended inside put(): a slot that was reserved but not handed over is
+        given back, an entry that was handed over gets its write position, then the lock is released.
+        Must only be called by the consumer and only after the process has ended.
+
+        :param pid process id of the ended producer
+        :returns True if the producer held the ring
+        :rtype bool
+        """
+        if self._owner[0] != pid:
+            return False
+        step = self._owner[2]
+        if step == self.RESERVED:
+            self._free.release()
+        elif step == self.HANDED_OVER:
+            self._positions[0] = self._owner[1] + 1
+        self._leave()
+        return True
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def get(self, block = True, timeout = None):
+        """
+        Takes the oldest routing decision. Must only be called by one consumer.
+
+        :param block waits for a decision if the ring is empty
+        :param timeout maximum time to wait in seconds (None waits forever)
+        :returns [identifier, destination]
+        :rtype list
+        :raises queue.Empty if there was no decision
+        """
+        if not self._items.acquire(block, timeout):
+            raise queue.Empty
+        position = self._positions[1]
+        station, code, _, timestamp = ROUTING_RECORD.unpack_from(self._buffer, position % self.capacity * ROUTING_RECORD.size)
+        self._positions[1] = position + 1
+        self._free.release()
+        self.gets += 1
+        self.latency.record((monotonic_ns() - timestamp) / 1e9)
+        return [station.rstrip(b"\0").decode("ascii"), DESTINATIONS[code]]
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        """
+        :returns number of decisions in the ring (depth)
+        :rtype int
+        """
+        #Die Leseposition kann der Schreibposition kurz vorauslaufen, weil diese erst nach der Übergabe steigt
+        return max(0, self._positions[0] - self._positions[1])
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return self.qsize() >= self.capacity
+
+    def close(self):
+        pass
+
+    def join_thread(self):
+        pass
+
+    def stats(self):
+        """
+        :returns depth, capacity, written and (by this process) taken decisions, number of put() that found the ring
+                 full, highest depth and the put-to-get latency in seconds (count, mean, min, max, p50, p95, p99)
+        :rtype dict
+        """
+        return {"depth": self.qsize(), "capacity": self.capacity, "puts": self._counters[0], "gets": self.gets,
+                "full": self._counters[1], "max_depth": self._counters[2], "latency": self.latency.stats()}
+
+
+def _produce(channel, identifier, count):
+    for index in range(count):
+        channel.put([identifier, 'DZA' if index % 5 == 0 else 'WA'])
+
+
+def compare(producers = 8, count = 20000):
+    """
+    Puts count decisions from each of several producer processes into a multiprocessing.Queue and into a RoutingRing
+    and takes them in this process.
+
+    :returns decisions per second for "queue" and "ring"
+    :rtype dict
+    """
+    results = {}
+    for name, channel in (("queue", multiprocessing.Queue()), ("ring", RoutingRing())):
+        processes = [multiprocessing.Process(target=_produce, args=(channel, "B%d" % index, count)) for index in range(producers)]
+        start = perf_counter()
+        for process in processes:
+            process.start()
+        for _ in range(producers * count):
+            channel.get()
+        elapsed = perf_counter() - start
+        for process in processes:
+            process.join()
+        results[name] = producers * count / elapsed
+    return results
+
+
+if __name__ == "__main__":
+    for name, rate in compare().items():
+        print("%-6s %10.0f decisions/s" % (name, rate))
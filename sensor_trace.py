@@ -0,0 +1,285 @@
+from time import monotonic_ns, perf_counter, sleep
+import mmap
+import struct
+import threading
+
+
+#Kopf der Datei (16 Byte): Kennung, Version, Stations-ID (6 Byte ASCII), Größe eines Eintrags
+TRACE_MAGIC = b"WSTR"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sH6sI")
+#Eintrag (16 Byte, little endian): monotoner Zeitstempel in ns, Art, Registeradresse, Registerwert
+TRACE_RECORD = struct.Struct("<QHHI")
+
+#Arten von Einträgen
+INPUT_READ = 1      #Eingangsregister gelesen (SensorSnapshot)
+OUTPUT_SYNC = 2     #Ausgangsregister vom Modbus gelesen (Abgleich der lokalen Kopie)
+OUTPUT_WRITE = 3    #Ausgangsregister geschrieben
+
+INPUT_ADDRESS = 8001
+OUTPUT_ADDRESS = 8003
+
+
+class TraceRecorder:
+    """
+    Append-only binary log of the register traffic of a workstation: every input register snapshot, every read-back
+    of the output register and every output write, each as a fixed-size TRACE_RECORD with a monotonic timestamp.
+    The file can be read while it is written (TraceReader maps it into memory).
+    """
+
+    def __init__(self, path, station, buffer_size = 65536):
+        """
+        :param path file the trace is appended to; a new file gets the TRACE_HEADER
+        :param station identifier of the workstation (at most 6 ASCII characters)
+        :param buffer_size size of the write buffer in bytes
+        """
+        self.path = path
+        self.station = station
+        self._file = open(path, "ab", buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, station.encode("ascii"), TRACE_RECORD.size))
+        self._lock = threading.Lock()
+        self.records = 0
+
+    def record(self, kind, value, address = None):
+        """
+        Appends one record.
+        :param kind INPUT_READ, OUTPUT_SYNC or OUTPUT_WRITE
+        :param value register value
+        :param address register address, INPUT_ADDRESS for INPUT_READ and OUTPUT_ADDRESS otherwise if None
+        """
+        if address is None:
+            address = INPUT_ADDRESS if kind == INPUT_READ else OUTPUT_ADDRESS
+        with self._lock:
+            self._file.write(TRACE_RECORD.pack(monotonic_ns(), kind, address, value))
+            self.records += 1
+
+    def flush(self):
+        """
+        Writes the buffered records to the file.
+        """
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        """
+        Flushes and closes the file.
+        """
+        with self._lock:
+            self._file.close()
+
+
+class TraceReader:
+    """
+    Random access to the records of a trace file over mmap, without loading the file.
+    Records that were only partially written at the end of the file are ignored.
+    """
+
+    def __init__(self, path):
+        """
+        :param path trace file written by TraceRecorder
+        :raises ValueError if the file is not a trace file of this version
+        """
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, station, record_size = TRACE_HEADER.unpack_from(self._map, 0)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+            raise ValueError("%s is not a workstation trace of version %d" % (path, TRACE_VERSION))
+        self.station = station.rstrip(b"\0").decode("ascii")
+        self._count = (len(self._map) - TRACE_HEADER.size) // TRACE_RECORD.size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        """
+        :returns record as tuple (timestamp_ns, kind, address, value)
+        :rtype tuple
+        """
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("trace record index out of range")
+        return TRACE_RECORD.unpack_from(self._map, TRACE_HEADER.size + index * TRACE_RECORD.size)
+
+    def __iter__(self):
+        return TRACE_RECORD.iter_unpack(self._map[TRACE_HEADER.size:TRACE_HEADER.size + self._count * TRACE_RECORD.size])
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class ReplayFinished(Exception):
+    """
+    Raised by the ReplayClient when the replayed cycle reads more inputs than were recorded.
+    """
+
+
+class VirtualClock:
+    """
+    Clock of a replay. The time jumps to the timestamp of every replayed input and sleeping only advances the
+    virtual time, so the cycle runs unthrottled (speed None) or accelerated (real sleep of duration / speed).
+    """
+
+    def __init__(self, start = 0.0, speed = None):
+        """
+        :param start virtual start time in seconds
+        :param speed acceleration against real time, None for unthrottled
+        """
+        self.time = start
+        self.speed = speed
+
+    def now(self):
+        return self.time
+
+    def advance_to(self, time):
+        if time > self.time:
+            self.time = time
+
+    def sleep(self, seconds):
+        self.time += seconds
+        if self.speed:
+            sleep(seconds / self.speed)
+
+
+class ReplayClient:
+    """
+    Stands in for the ModbusConnection of a WorkstationModule during a replay. Reads of the input register return the
+    recorded inputs in order, reads of the output register the recorded read-backs, and every output write is
+    compared with the recorded write at the same position.
+    """
+
+    def __init__(self, trace, clock):
+        """
+        :param trace TraceReader
+        :param clock VirtualClock that follows the timestamps of the replayed inputs
+        """
+        self.clock = clock
+        self.inputs = []
+        self.syncs = []
+        self.writes = []
+        for timestamp_ns, kind, address, value in trace:
+            if kind == INPUT_READ:
+                self.inputs.append((timestamp_ns, value))
+            elif kind == OUTPUT_SYNC:
+                self.syncs.append(value)
+            elif kind == OUTPUT_WRITE:
+                self.writes.append((timestamp_ns, value))
+        self.start_ns = trace[0][0] if len(trace) else 0
+        self.outputs = self.syncs[0] if self.syncs else 0
+        self.input_index = 0
+        self.sync_index = 0
+        self.write_index = 0
+        self.diffs = []
+        self.requests = 0
+
+    def read_holding_registers(self, reg_addr, reg_nb = 1):
+        self.requests += 1
+        registers = []
+        for address in range(reg_addr, reg_addr + reg_nb):
+            if address == INPUT_ADDRESS:
+                if self.input_index >= len(self.inputs):
+                    raise ReplayFinished("all %d recorded inputs replayed" % len(self.inputs))
+                timestamp_ns, value = self.inputs[self.input_index]
+                self.input_index += 1
+                self.clock.advance_to((timestamp_ns - self.start_ns) / 1e9)
+                registers.append(value)
+            elif address == OUTPUT_ADDRESS:
+                if self.sync_index < len(self.syncs):
+                    self.outputs = self.syncs[self.sync_index]
+                    self.sync_index += 1
+                registers.append(self.outputs)
+            else:
+                registers.append(0)
+        return registers
+
+    def write_multiple_registers(self, regs_addr, regs_value):
+        self.requests += 1
+        for address, value in enumerate(regs_value, regs_addr):
+            if address != OUTPUT_ADDRESS:
+                continue
+            self.outputs = value
+            expected = self.writes[self.write_index][1] if self.write_index < len(self.writes) else None
+            if value != expected:
+                self.diffs.append({"write": self.write_index, "time": self.clock.now(), "expected": expected, "actual": value})
+            self.write_index += 1
+        return True
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {"requests": self.requests, "inputs": self.input_index, "writes": self.write_index, "diffs": len(self.diffs)}
+
+    def rtt_stats(self):
+        return {}
+
+
+def replay(path, module_class = None, speed = None):
+    """
+    Feeds the inputs of a trace into the work() cycle of a WorkstationModule and compares its output writes
+    with the recorded ones.
+
+    :param path trace file written by WorkstationModule.start_recording()
+    :param module_class class with the work() cycle, WorkStationMqtt.WorkstationModule if None
+    :param speed acceleration against the recorded time, None for unthrottled
+    :returns number of replayed inputs and writes, recorded writes, virtual and real duration and the differing writes
+    :rtype dict
+    """
+    if module_class is None:
+        from WorkStationMqtt import WorkstationModule as module_class
+    from telemetry import NullPublisher
+    from workstation_io import CircuitBreaker, CoalescingReader, DeviceLock
+
+    trace = TraceReader(path)
+    clock = VirtualClock(speed=speed)
+    client = ReplayClient(trace, clock)
+    trace.close()
+
+    #Eigener Lock und Circuit Breaker, damit das Abspielen keine laufende Station desselben Prozesses beeinflusst
+    workstation = module_class("127.0.0.1", read_write_sem=DeviceLock("replay"))
+    workstation.identifier = trace.station
+    workstation.client = client
+    workstation.breaker = CircuitBreaker("replay")
+    workstation.reader = CoalescingReader(client, lock=workstation.device_lock.shared)
+    workstation.clock = clock.now
+    workstation.sleep = clock.sleep
+    workstation.drill_timer.clock = clock.now
+    workstation.profiler.clock = clock.now
+
+    start = perf_counter()
+    error = None
+    try:
+        workstation.work(publisher=NullPublisher())
+    except ReplayFinished:
+        pass
+    except Exception as exception:
+        error = exception
+    finally:
+        workstation.close()
+    return {
+        "inputs": client.input_index,
+        "writes": client.write_index,
+        "recorded_writes": len(client.writes),
+        "virtual_duration": clock.now(),
+        "real_duration": perf_counter() - start,
+        "diffs": client.diffs,
+        "error": error,
+    }
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("usage: python sensor_trace.py <trace file> [speed]")
+        sys.exit(2)
+    result = replay(sys.argv[1], speed=float(sys.argv[2]) if len(sys.argv) > 2 else None)
+    print("replayed %d inputs and %d of %d writes, %.1f s recorded time in %.2f s" % (
+        result["inputs"], result["writes"], result["recorded_writes"], result["virtual_duration"], result["real_duration"]))
+    for diff in result["diffs"][:20]:
+        print("write %(write)d at %(time).3f s: expected %(expected)s, got %(actual)s" % diff)
+    if result["error"] is not None:
+        print("work() ended with %r" % result["error"])
+    sys.exit(1 if result["diffs"] or result["error"] is not None else 0)
@@ -0,0 +1,282 @@
+from pyModbusTCP.server import DataBank, ModbusServer
+
+from time import monotonic
+import heapq
+import itertools
+import random
+import threading
+
+
+#Register wie an der Station
+DIGITAL_INPUT_ADDRESS = 8001
+DIGITAL_OUTPUT_ADDRESS = 8003
+
+#Bits des Eingangsregisters
+ENTRANCE_SENSOR = 0
+DRILL_SENSOR = 1
+CHECKER_SENSOR = 2
+DRILL_UP_SENSOR = 3
+DRILL_DOWN_SENSOR = 4
+TURNTABLE_IN_POSITION = 5
+WORKPIECE_NORMAL = 6
+
+#Bits des Ausgangsregisters
+DRILL_MOTOR = 0
+TURNTABLE_TURN = 1
+DRILL_DOWN = 2
+DRILL_UP = 3
+CHECKER_DOWN = 5
+OUTPUT_EJECTOR = 6
+
+#Plätze auf dem Drehteller: Eingang -> Prüfer -> Bohrer -> Ausgang
+ENTRANCE, CHECKER, DRILL, OUTPUT = range(4)
+
+
+def workpiece_stream(normal_ratio = 0.8, seed = None):
+    """
+    Endless random stream of workpiece orientations.
+
+    :param normal_ratio Share of workpieces in normal position (hole up)
+    :param seed Seed of the random generator, for repeatable runs
+    :returns iterator of bool, True for a workpiece in normal position
+    """
+    generator = random.Random(seed)
+    while True:
+        yield generator.random() < normal_ratio
+
+
+class Workpiece:
+    """
+    A workpiece on the turntable.
+    """
+
+    def __init__(self, normal):
+        """
+        :param normal True if the workpiece lies in normal position (hole up)
+        """
+        self.normal = normal
+        self.drilled = False
+
+
+class _StationDataBank(DataBank):
+    def __init__(self, simulator):
+        super().__init__()
+        self.simulator = simulator
+
+    def on_holding_registers_change(self, address, from_value, to_value, srv_info):
+        if address == DIGITAL_OUTPUT_ADDRESS:
+            self.simulator.outputs_changed(from_value, to_value)
+
+
+class StationSimulator:
+    """
+    Modbus TCP stand-in for a workstation. Serves the input register 8001 and the output register 8003 and models
+    the turntable (time to leave the position and to settle), the drill travel, the checker and the output ejector.
+    Workpieces arrive at the entrance from a configurable stream of orientations; workpieces in abnormal position
+    are not seen by the workpiece sensors, only by the checker, like at the real station.
+    """
+
+    def __init__(self, host = "127.0.0.1", port = 5020, stream = None, turn_start_time = 0.02, turn_time = 0.5,
+                 drill_travel_time = 0.3, checker_time = 0.1, arrival_time = 0.2):
+        """
+        :param host Address the modbus server listens on
+        :param port TCP port of the modbus server
+        :param stream Iterable of workpiece orientations (True for normal position), workpiece_stream() if None.
+                      When the stream ends, no more workpieces arrive.
+        :param turn_start_time Seconds from the turn signal until the turntable leaves its position
+        :param turn_time Seconds from leaving the position until the turntable is in the next position
+        :param drill_travel_time Seconds the drill needs from top to bottom and back
+        :param checker_time Seconds until the lowered checker reports the orientation
+        :param arrival_time Seconds until the next workpiece is placed on a free entrance
+        """
+        self.stream = iter(workpiece_stream() if stream is None else stream)
+        self.turn_start_time = turn_start_time
+        self.turn_time = turn_time
+        self.drill_travel_time = drill_travel_time
+        self.checker_time = checker_time
+        self.arrival_time = arrival_time
+
+        self.data_bank = _StationDataBank(self)
+        self.server = ModbusServer(host, port, no_block=True, data_bank=self.data_bank)
+        self.host = host
+        self.port = port
+
+        self._lock = threading.Condition()
+        self._events = []
+        self._sequence = itertools.count()
+        self._running = False
+        self._thread = None
+
+        self.slots = [None] * 4
+        self.in_position = True
+        self.drill_position = "up"
+        self.drill_target = "up"
+        self.checker_ready = False
+        self.outputs = 0
+
+        self.arrived = 0
+        self.ejected = 0
+        self.ejected_drilled = 0
+        self.ejected_abnormal = 0
+        self.turns = 0
+
+    def start(self):
+        """
+        Starts the modbus server and the model thread and places the first workpiece.
+        """
+        with self._lock:
+            self._running = True
+            self._place_workpiece()
+            self._update_inputs()
+        self._thread = threading.Thread(target=self._run, name="station-simulator", daemon=True)
+        self._thread.start()
+        self.server.start()
+
+    def stop(self):
+        """
+        Stops the modbus server and the model thread.
+        """
+        self.server.stop()
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def stats(self):
+        """
+        :returns number of arrived, ejected, ejected drilled and ejected abnormal workpieces and of turns
+        :rtype dict
+        """
+        with self._lock:
+            return {"arrived": self.arrived, "ejected": self.ejected, "drilled": self.ejected_drilled,
+                    "abnormal": self.ejected_abnormal, "turns": self.turns}
+
+    def outputs_changed(self, before, after):
+        """
+        Called by the data bank when a client wrote the output register.
+        """
+        with self._lock:
+            self.outputs = after
+            rising = after & ~before
+            falling = before & ~after
+            if rising >> TURNTABLE_TURN & 1 and self.in_position:
+                self._schedule(self.turn_start_time, self._leave_position)
+            if rising >> DRILL_DOWN & 1:
+                self.drill_position = "moving"
+                self.drill_target = "down"
+                self._schedule(self.drill_travel_time, self._drill_reached, "down")
+            if rising >> DRILL_UP & 1:
+                self.drill_position = "moving"
+                self.drill_target = "up"
+                self._schedule(self.drill_travel_time, self._drill_reached, "up")
+            if rising >> CHECKER_DOWN & 1:
+                self._schedule(self.checker_time, self._checker_reached)
+            if falling >> CHECKER_DOWN & 1:
+                self.checker_ready = False
+            if rising >> OUTPUT_EJECTOR & 1:
+                self._eject()
+            self._update_inputs()
+
+    def _schedule(self, delay, action, *args):
+        heapq.heappush(self._events, (monotonic() + delay, next(self._sequence), action, args))
+        self._lock.notify()
+
+    def _run(self):
+        with self._lock:
+            while self._running:
+                if not self._events:
+                    self._lock.wait()
+                    continue
+                due, _, action, args = self._events[0]
+                delay = due - monotonic()
+                if delay > 0:
+                    self._lock.wait(delay)
+                    continue
+                heapq.heappop(self._events)
+                action(*args)
+                self._update_inputs()
+
+    def _leave_position(self):
+        self.in_position = False
+        self._schedule(self.turn_time, self._arrive_position)
+
+    def _arrive_position(self):
+        #Drehteller um einen Platz weiter, ein nicht ausgeworfenes Werkstück kommt wieder am Eingang an
+        self.slots = [self.slots[OUTPUT]] + self.slots[:OUTPUT]
+        self.in_position = True
+        self.checker_ready = False
+        self.turns += 1
+        if self.slots[ENTRANCE] is None:
+            self._schedule(self.arrival_time, self._place_workpiece)
+
+    def _place_workpiece(self):
+        if self.slots[ENTRANCE] is not None or not self.in_position:
+            return
+        normal = next(self.stream, None)
+        if normal is None:
+            return
+        self.slots[ENTRANCE] = Workpiece(normal)
+        self.arrived += 1
+
+    def _drill_reached(self, position):
+        if position != self.drill_target:
+            #Der Bohrer wurde unterwegs umgesteuert
+            return
+        self.drill_position = position
+        workpiece = self.slots[DRILL]
+        if position == "down" and workpiece is not None and self.outputs >> DRILL_MOTOR & 1:
+            workpiece.drilled = True
+
+    def _checker_reached(self):
+        if self.outputs >> CHECKER_DOWN & 1:
+            self.checker_ready = True
+
+    def _eject(self):
+        workpiece = self.slots[OUTPUT]
+        if workpiece is None:
+            return
+        self.slots[OUTPUT] = None
+        self.ejected += 1
+        if workpiece.drilled:
+            self.ejected_drilled += 1
+        if not workpiece.normal:
+            self.ejected_abnormal += 1
+
+    def _update_inputs(self):
+        def seen(slot):
+            workpiece = self.slots[slot]
+            return workpiece is not None and workpiece.normal
+
+        value = 0
+        if seen(ENTRANCE):
+            value |= 1 << ENTRANCE_SENSOR
+        if seen(DRILL):
+            value |= 1 << DRILL_SENSOR
+        if seen(CHECKER):
+            value |= 1 << CHECKER_SENSOR
+        if self.drill_position == "up":
+            value |= 1 << DRILL_UP_SENSOR
+        if self.drill_position == "down":
+            value |= 1 << DRILL_DOWN_SENSOR
+        if self.in_position:
+            value |= 1 << TURNTABLE_IN_POSITION
+        if self.checker_ready and seen(CHECKER):
+            value |= 1 << WORKPIECE_NORMAL
+        self.data_bank.set_holding_registers(DIGITAL_INPUT_ADDRESS, [value])
+
+
+if __name__ == "__main__":
+    with StationSimulator(host="0.0.0.0", port=5020) as simulator:
+        print("Station simulator on port %d, Ctrl+C to stop" % simulator.port)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            print(simulator.stats())
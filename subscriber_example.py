@@ -0,0 +1,73 @@
+# subscriber_example.py
+from asyncua import ua, Client
+import asyncio
+
+#Publishing-Intervall der Subscription und Abtastintervall der Monitored Items in ms
+PUBLISHING_INTERVAL = 500
+SAMPLING_INTERVAL = 100
+#Absolutes Totband: Aenderungen der Bohrzeit unterhalb dieses Werts werden nicht gemeldet
+DRILLING_TIME_DEADBAND = 0.01
+
+NODES = {"TB": "Total_blocks", "DIB": "Drilled_blocks", "DMB": "Damaged_blocks", "DRILL": "MotorOn_time", "RUN": "Workstation_running"}
+
+class WorkstationSubscriptionHandler:
+    """
+    Receives the data change notifications of the variables of a station and keeps the latest values
+    """
+
+    def __init__(self, names):
+        """
+        :param names mapping of node ids to the display names of the values
+        """
+        self.names = names
+        self.values = {}
+
+    def datachange_notification(self, node, val, data):
+        """
+        Called by the subscription for every changed value
+        :param node the node which changed
+        :param val the new value
+        :param data the monitored item notification
+        """
+        name = self.names.get(node.nodeid.Identifier.rpartition(".")[2], str(node))
+        self.values[name] = val
+        print(f"{name}: {val}")
+
+    def status_change_notification(self, status):
+        """
+        Called when the server reports a status change of the subscription
+        :param status the status change notification
+        """
+        print(f"Subscription status: {status.Status}")
+
+async def main(url = "opc.tcp://localhost:4840/", uri = "http://example.uri.github.io", station = "B4", publishing_interval = PUBLISHING_INTERVAL, sampling_interval = SAMPLING_INTERVAL, deadband = DRILLING_TIME_DEADBAND):
+    """
+    Subscribes to the workstation variables and prints every change pushed by the server
+    :param url endpoint of the OPC UA server
+    :param uri namespace uri of the workstation variables
+    :param station identifier of the station (WorkstationModule.identifier)
+    :param publishing_interval publishing interval of the subscription in ms
+    :param sampling_interval sampling interval of the monitored items in ms
+    :param deadband absolute deadband for the drilling time, None for no filter
+    """
+    async with Client(url = url) as client:
+        idx = await client.get_namespace_index(uri)
+        nodes = {identifier: client.get_node(ua.NodeId(station + "." + identifier, idx)) for identifier in NODES}
+        handler = WorkstationSubscriptionHandler(NODES)
+        subscription = await client.create_subscription(publishing_interval, handler)
+        #Zaehler: jede Aenderung melden
+        counters = [node for identifier, node in nodes.items() if identifier != "DRILL"]
+        await subscription.subscribe_data_change(counters, sampling_interval = sampling_interval)
+        #Bohrzeit: nur Aenderungen groesser als das Totband melden
+        if deadband:
+            await subscription.deadband_monitor(nodes["DRILL"], deadband, ua.DeadbandType.Absolute)
+        else:
+            await subscription.subscribe_data_change(nodes["DRILL"], sampling_interval = sampling_interval)
+        try:
+            while True:
+                await asyncio.sleep(1)
+        finally:
+            await subscription.delete()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,506 @@
+from telemetry import MqttTelemetryPublisher
+from telemetry import OpcUaTelemetrySession
+from routing_ring import RoutingRing
+
+from time import monotonic, perf_counter, sleep
+import argparse
+import importlib
+import json
+import multiprocessing
+import queue
+import threading
+
+
+#Felder des Status, den eine Station im geteilten Speicher für den Supervisor ablegt
+STATUS_FIELDS = ("heartbeat", "last_cycle", "cycles", "total", "drilled", "damaged", "motor_on", "io_errors")
+#Zähler, die nach einem Neustart der Station weitergezählt werden
+COUNTER_FIELDS = ("cycles", "total", "drilled", "damaged", "motor_on", "io_errors")
+#Semaphoren einer Station für das Zusammenspiel mit der gegenüberliegenden Station
+SEMAPHORE_ROLES = ("sem_output", "sem_self_turning", "sem_opposite_turning")
+
+#Abstand der Heartbeats einer Station und Zeit ohne Heartbeat, nach der sie als hängend neu gestartet wird
+HEARTBEAT_INTERVAL = 1.0
+HEALTH_TIMEOUT = 15.0
+
+
+class TimedSemaphore:
+    """
+    Wrapper of a multiprocessing semaphore for one station. Measures the time acquire() waits and counts the
+    acquisitions that are not released yet, both in shared memory, so the supervisor sees the statistics of all
+    station processes and can give back what a crashed station still held (reclaim()).
+    Several wrappers can share one semaphore, e.g. sem_self_turning of one station and sem_opposite_turning of the other.
+    """
+
+    def __init__(self, semaphore):
+        """
+        :param semaphore multiprocessing semaphore (e.g. BoundedSemaphore(1))
+        """
+        self.semaphore = semaphore
+        #Anzahl der Belegungen, gesamte und maximale Wartezeit, noch nicht freigegebene Belegungen
+        self._values = multiprocessing.Array("d", 4)
+
+    def acquire(self, block = True, timeout = None):
+        start = perf_counter()
+        acquired = self.semaphore.acquire(block, timeout)
+        wait = perf_counter() - start
+        with self._values.get_lock():
+            if acquired:
+                self._values[0] += 1
+                self._values[3] += 1
+            self._values[1] += wait
+            self._values[2] = max(self._values[2], wait)
+        return acquired
+
+    def release(self):
+        """
+        Releases one acquisition made through this wrapper, does nothing if there is none (e.g. already reclaimed).
+        Can be called from another process than the one that acquired, like the exit that is freed by the transport system.
+        """
+        with self._values.get_lock():
+            if self._values[3] < 1:
+                return
+            self._values[3] -= 1
+        self.semaphore.release()
+
+    def reclaim(self):
+        """
+        Releases all acquisitions of this wrapper that were not released, after the station process ended.
+
+        :returns number of released acquisitions
+        :rtype int
+        """
+        with self._values.get_lock():
+            held = int(self._values[3])
+            self._values[3] = 0
+        for _ in range(held):
+            self.semaphore.release()
+        return held
+
+    def stats(self):
+        """
+        :returns number of acquisitions, total and maximum wait time in seconds and the acquisitions held right now
+        :rtype dict
+        """
+        with self._values.get_lock():
+            acquisitions, wait_total, wait_max, held = self._values[:]
+        return {"acquisitions": int(acquisitions), "wait_total": wait_total, "wait_max": wait_max, "held": int(held)}
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class StationStatus:
+    """
+    Status of one station process in shared memory (STATUS_FIELDS), written by the station and read by the supervisor.
+    Without a lock: every field has one writer, and a station that is terminated can not leave a lock held.
+    """
+
+    def __init__(self):
+        self._values = multiprocessing.RawArray("d", len(STATUS_FIELDS))
+
+    def update(self, **values):
+        for name, value in values.items():
+            self._values[STATUS_FIELDS.index(name)] = value
+
+    def snapshot(self):
+        """
+        :rtype dict
+        """
+        return dict(zip(STATUS_FIELDS, self._values[:]))
+
+    def reset(self):
+        for index in range(len(STATUS_FIELDS)):
+            self._values[index] = 0.0
+
+
+class StatusPublisher:
+    """
+    Telemetry publisher of a supervised station: takes the counters over into the StationStatus and hands them on
+    to the configured publisher (MQTT or OPC UA), if there is one.
+    """
+
+    def __init__(self, status, forward = None):
+        """
+        :param status StationStatus of the station
+        :param forward publisher the values are handed on to (optional)
+        """
+        self.status = status
+        self.forward = forward
+
+    def publish(self, values):
+        self.status.update(**{name: value for name, value in values.items() if name in ("total", "damaged")})
+        if self.forward is not None:
+            return self.forward.publish(values)
+        return 0
+
+    def close(self):
+        if self.forward is not None:
+            self.forward.close()
+
+
+def load_config(path):
+    """
+    Reads the configuration of the supervisor from a JSON file, e.g.
+
+        {
+            "module": "WorkStationMqtt",
+            "routing_queue": "ring",
+            "restart_delay": 2.0,
+            "max_restarts": 10,
+            "stations": [
+                {"ip": "192.168.200.234", "opposite": "B5", "telemetry": {"mqtt": "192.168.200.176"}},
+                {"ip": "192.168.200.235", "opposite": "B4", "options": {"pipelined": true}}
+            ]
+        }
+
+    "routing_queue" selects the queue_to_TS of all stations: "ring" (RoutingRing in shared memory, default) or
+    "queue" (multiprocessing.Queue). Per station: "ip", optional "name" (identifier, 'B' + last digit of the ip if missing), "port", "opposite"
+    (name of the station on the other side of the shared exit), "options" (further WorkstationModule arguments) and
+    "telemetry" ({"mqtt": broker} or {"opcua": url}, counters are only kept by the supervisor if missing).
+
+    :param path path of the JSON file
+    :rtype dict
+    """
+    with open(path) as file:
+        return json.load(file)
+
+
+def station_name(settings):
+    """
+    :returns identifier of a configured station, like WorkstationModule.identifier if no name is configured
+    :rtype str
+    """
+    return settings.get("name") or 'B' + settings["ip"][-1]
+
+
+def run_station(settings, module_name, semaphores, queue_to_TS, status, stop_flag):
+    """
+    Target of a station process: builds the WorkstationModule with the wired semaphores and runs work() until
+    stop_flag is set. The heartbeat is written by the control loop itself (progress_hook: every idle tick, sensor poll
+    and phase), so a station that hangs on a semaphore or a modbus access stops sending it. A thread writes the
+    counters into the StationStatus every HEARTBEAT_INTERVAL and hands the stop_flag on to stop().
+    """
+    module_class = importlib.import_module(module_name).WorkstationModule
+    workstation = module_class(settings["ip"], modbus_port=settings.get("port", 502), **semaphores, **settings.get("options", {}))
+    workstation.identifier = station_name(settings)
+
+    telemetry = settings.get("telemetry") or {}
+    forward = None
+    if "mqtt" in telemetry:
+        forward = MqttTelemetryPublisher(telemetry["mqtt"], encoding=workstation.TELEMETRY_ENCODING, station=workstation.identifier)
+    elif "opcua" in telemetry:
+        forward = OpcUaTelemetrySession(telemetry["opcua"], station=workstation.identifier)
+
+    def progress():
+        status.update(heartbeat=monotonic())
+
+    def counters():
+        cycles = None
+        while True:
+            if workstation.profiler.cycles != cycles:
+                cycles = workstation.profiler.cycles
+                status.update(last_cycle=monotonic())
+            status.update(cycles=cycles, drilled=workstation.drill_timer.workpieces,
+                          motor_on=workstation.drill_timer.motor_on_time(), io_errors=workstation.retry_policy.give_ups)
+            sleep(HEARTBEAT_INTERVAL)
+            if stop_flag.value:
+                workstation.stop()
+                return
+
+    workstation.progress_hook = progress
+    threading.Thread(target=counters, name="counters-" + workstation.identifier, daemon=True).start()
+    try:
+        workstation.work(queue_to_TS, publisher=StatusPublisher(status, forward))
+    finally:
+        workstation.close()
+
+
+class StationWorker:
+    """
+    A supervised station: its settings, semaphores and status and the current process.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.name = station_name(settings)
+        self.semaphores = {}
+        self.status = StationStatus()
+        self.process = None
+        self.state = "stopped"
+        self.restarts = 0
+        self.restart_at = None
+        self.exitcode = None
+        #Zähler der beendeten Prozesse, der laufende Prozess zählt wieder ab 0
+        self.carry = dict.fromkeys(COUNTER_FIELDS, 0.0)
+        self.routed = {"WA": 0, "DZA": 0}
+
+
+class Supervisor:
+    """
+    Starts every configured station in a process of its own and wires stations that share an exit: the turntable
+    semaphores are crossed (sem_opposite_turning of one station is sem_self_turning of the other) and both use one
+    sem_output. All stations put their routing decisions into one queue_to_TS.
+
+    The supervisor takes the place of the transport system: it takes every [identifier, 'WA'|'DZA'] from the queue,
+    hands it to transport(identifier, destination) if given and frees the exit of the station again.
+    Stations whose process ends or that stop sending heartbeats are restarted after restart_delay seconds, the
+    semaphores they still held are released before. stats() aggregates state, counters and semaphore wait times.
+    """
+
+    CHECK_INTERVAL = 0.5
+    #Wartezeit in Sekunden nach terminate(), bevor ein Stationsprozess mit kill() beendet wird
+    TERMINATE_TIMEOUT = 5.0
+
+    def __init__(self, config, transport = None):
+        """
+        :param config configuration as read by load_config()
+        :param transport function transport(identifier, destination) called for every ejected workpiece (optional)
+        :raises ValueError if station names are not unique or an opposite station does not name the station back
+        """
+        self.module_name = config.get("module", "WorkStationMqtt")
+        self.restart_delay = config.get("restart_delay", 2.0)
+        self.max_restarts = config.get("max_restarts")
+        self.transport = transport
+        self.stations = [StationWorker(settings) for settings in config["stations"]]
+        self.by_name = {station.name: station for station in self.stations}
+        if len(self.by_name) != len(self.stations):
+            raise ValueError("station names are not unique")
+        self._wire_pairs()
+
+        if config.get("routing_queue", "ring") == "ring":
+            self.queue_to_TS = RoutingRing(config.get("routing_capacity", 1024))
+        else:
+            self.queue_to_TS = multiprocessing.Queue()
+        #Ohne Lock, damit ein abgebrochener Stationsprozess das Stoppen der anderen nicht blockieren kann
+        self.stop_flag = multiprocessing.RawValue("b", 0)
+        self._stopped = threading.Event()
+        #Der Dispatcher läuft, bis alle Stationen beendet sind, damit ihre letzten Auswürfe noch abgenommen werden
+        self._dispatching = threading.Event()
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        self.started = None
+
+    def _wire_pairs(self):
+        for station in self.stations:
+            opposite = station.settings.get("opposite")
+            if opposite is None or station.semaphores:
+                continue
+            partner = self.by_name.get(opposite)
+            if partner is None or partner.settings.get("opposite") != station.name:
+                raise ValueError("station %s and its opposite station %s must name each other" % (station.name, opposite))
+            exit_free = multiprocessing.BoundedSemaphore(1)
+            turning = multiprocessing.BoundedSemaphore(1)
+            partner_turning = multiprocessing.BoundedSemaphore(1)
+            station.semaphores = {"sem_output": TimedSemaphore(exit_free), "sem_self_turning": TimedSemaphore(turning),
+                                  "sem_opposite_turning": TimedSemaphore(partner_turning)}
+            partner.semaphores = {"sem_output": TimedSemaphore(exit_free), "sem_self_turning": TimedSemaphore(partner_turning),
+                                  "sem_opposite_turning": TimedSemaphore(turning)}
+
+    def start(self):
+        """
+        Starts all stations and the thread that takes the routing decisions from queue_to_TS.
+        """
+        self.started = monotonic()
+        self._stopped.clear()
+        self.stop_flag.value = 0
+        self._dispatching.set()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="supervisor-dispatch", daemon=True)
+        self._dispatcher.start()
+        for station in self.stations:
+            self._start_station(station)
+
+    def _start_station(self, station):
+        station.status.reset()
+        station.status.update(heartbeat=monotonic())
+        station.process = multiprocessing.Process(target=run_station, name="station-" + station.name,
+                                                  args=(station.settings, self.module_name, station.semaphores,
+                                                        self.queue_to_TS, station.status, self.stop_flag))
+        station.process.start()
+        station.state = "running"
+        station.restart_at = None
+
+    def _dispatch(self):
+        #Nach stop() wird abgenommen, bis die Queue eine CHECK_INTERVAL lang leer bleibt, so endet der Dispatcher auch
+        #wenn ein abgebrochener Stationsprozess einen Eintrag nicht mehr fertigstellen konnte
+        while True:
+            try:
+                identifier, destination = self.queue_to_TS.get(timeout=self.CHECK_INTERVAL)
+            except queue.Empty:
+                if self._dispatching.is_set():
+                    continue
+                return
+            station = self.by_name.get(identifier)
+            if station is not None:
+                with self._lock:
+                    station.routed[destination] = station.routed.get(destination, 0) + 1
+            if self.transport is not None:
+                self.transport(identifier, destination)
+            #Das Transportsystem hat das Werkstück übernommen, der Ausgang ist wieder frei
+            if station is not None and "sem_output" in station.semaphores:
+                station.semaphores["sem_output"].release()
+
+    def check(self):
+        """
+        Restarts stations whose process ended or whose heartbeat is older than HEALTH_TIMEOUT.
+        Called every CHECK_INTERVAL seconds by run().
+        """
+        now = monotonic()
+        for station in self.stations:
+            if station.state == "running":
+                process = station.process
+                if process.is_alive() and now - station.status.snapshot()["heartbeat"] > HEALTH_TIMEOUT:
+                    print("Station %s sends no heartbeat, restarting it" % station.name)
+                    process.terminate()
+                    process.join(self.TERMINATE_TIMEOUT)
+                if not process.is_alive():
+                    self._station_ended(station, now)
+            elif station.state == "restarting" and now >= station.restart_at and not self._stopped.is_set():
+                station.restarts += 1
+                self._start_station(station)
+
+    def _release_routing(self, station):
+        #Ein Prozess, der in RoutingRing.put() beendet wurde, hält sonst den Lock der anderen Stationen
+        if isinstance(self.queue_to_TS, RoutingRing) and self.queue_to_TS.recover(station.process.pid):
+            print("Station %s ended while putting a routing decision, routing ring recovered" % station.name)
+
+    def _station_ended(self, station, now):
+        station.exitcode = station.process.exitcode
+        self._release_routing(station)
+        snapshot = station.status.snapshot()
+        with self._lock:
+            for name in COUNTER_FIELDS:
+                station.carry[name] += snapshot[name]
+            station.status.reset()
+        #Was die Station noch belegt hatte, wird freigegeben, sonst blockiert die gegenüberliegende Station
+        for semaphore in station.semaphores.values():
+            semaphore.reclaim()
+        if self.max_restarts is not None and station.restarts >= self.max_restarts:
+            station.state = "failed"
+            print("Station %s ended with exit code %s, no restarts left" % (station.name, station.exitcode))
+        else:
+            station.state = "restarting"
+            station.restart_at = now + self.restart_delay
+            print("Station %s ended with exit code %s, restart in %.1f s" % (station.name, station.exitcode, self.restart_delay))
+
+    def run(self, report_interval = 60.0):
+        """
+        Starts the stations and supervises them until stop() is called (e.g. from a signal handler) or Ctrl+C.
+
+        :param report_interval seconds between two reports on stdout, None for no reports
+        """
+        self.start()
+        last_report = monotonic()
+        try:
+            while not self._stopped.wait(self.CHECK_INTERVAL):
+                self.check()
+                if report_interval is not None and monotonic() - last_report >= report_interval:
+                    last_report = monotonic()
+                    print_report(self.stats())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self, timeout = 10.0):
+        """
+        Asks all stations to return after their running cycle, terminates (and if that does not help kills) those that
+        do not end within timeout seconds and stops the dispatcher after it took the routing decisions of the last cycles.
+        """
+        self._stopped.set()
+        self.stop_flag.value = 1
+        deadline = monotonic() + timeout
+        for station in self.stations:
+            if station.process is None:
+                continue
+            station.process.join(max(0.0, deadline - monotonic()))
+            if station.process.is_alive():
+                station.process.terminate()
+                station.process.join(self.TERMINATE_TIMEOUT)
+            if station.process.is_alive():
+                station.process.kill()
+                station.process.join()
+            if station.state == "running":
+                station.exitcode = station.process.exitcode
+                self._release_routing(station)
+            if station.state in ("running", "restarting"):
+                station.state = "stopped"
+        self._dispatching.clear()
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+            self._dispatcher = None
+
+    def stats(self):
+        """
+        Aggregated state of all stations: state, restarts, age of the heartbeat and of the last cycle, counters over all
+        restarts, workpieces routed to WA and DZA and the wait times of the semaphores, "routing" the depth and
+        latency of the RoutingRing. interlock_share is the share of
+        the supervised time a station waited for the turntable and exit semaphores, the throughput the interlock costs.
+
+        :rtype dict
+        """
+        now = monotonic()
+        elapsed = now - self.started if self.started is not None else 0.0
+        stations = {}
+        totals = dict.fromkeys(COUNTER_FIELDS, 0.0)
+        totals.update(interlock_wait=0.0, WA=0, DZA=0)
+        for station in self.stations:
+            snapshot = station.status.snapshot()
+            with self._lock:
+                counters = {name: station.carry[name] + snapshot[name] for name in COUNTER_FIELDS}
+                routed = dict(station.routed)
+            semaphores = {role: semaphore.stats() for role, semaphore in station.semaphores.items()}
+            interlock_wait = sum(semaphore["wait_total"] for semaphore in semaphores.values())
+            running = station.state == "running"
+            stations[station.name] = {
+                "state": station.state,
+                "pid": station.process.pid if station.process is not None else None,
+                "restarts": station.restarts,
+                "exitcode": station.exitcode,
+                "heartbeat_age": now - snapshot["heartbeat"] if running else None,
+                "last_cycle_age": now - snapshot["last_cycle"] if running and snapshot["last_cycle"] else None,
+                "counters": counters,
+                "routed": routed,
+                "semaphores": semaphores,
+                "interlock_wait": interlock_wait,
+                "interlock_share": interlock_wait / elapsed if elapsed > 0 else 0.0,
+            }
+            for name in COUNTER_FIELDS:
+                totals[name] += counters[name]
+            totals["interlock_wait"] += interlock_wait
+            for destination in ("WA", "DZA"):
+                totals[destination] += routed.get(destination, 0)
+        routing = self.queue_to_TS.stats() if isinstance(self.queue_to_TS, RoutingRing) else {"depth": self.queue_to_TS.qsize()}
+        return {"uptime": elapsed, "stations": stations, "totals": totals, "routing": routing}
+
+
+def print_report(stats):
+    """
+    Prints the result of Supervisor.stats() as a table, wait times in seconds.
+    """
+    print("uptime %.0f s, %d cycles, %d WA, %d DZA, %.1f s interlock wait" % (
+        stats["uptime"], stats["totals"]["cycles"], stats["totals"]["WA"], stats["totals"]["DZA"], stats["totals"]["interlock_wait"]))
+    routing = stats["routing"]
+    if "latency" in routing and routing["latency"]["count"]:
+        print("routing: depth %d (max %d of %d), %d full, latency p50 %.3f ms, p99 %.3f ms" % (
+            routing["depth"], routing["max_depth"], routing["capacity"], routing["full"],
+            routing["latency"]["p50"] * 1000, routing["latency"]["p99"] * 1000))
+    print("%-8s %-10s %8s %8s %8s %8s %8s %10s %10s %10s %8s" % ("station", "state", "restarts", "cycles", "drilled", "damaged",
+                                                               "errors", "wait exit", "wait turn", "wait opp.", "share"))
+    for name, station in stats["stations"].items():
+        waits = [station["semaphores"][role]["wait_total"] if role in station["semaphores"] else 0.0 for role in SEMAPHORE_ROLES]
+        counters = station["counters"]
+        print("%-8s %-10s %8d %8d %8d %8d %8d %10.2f %10.2f %10.2f %7.1f%%" % (
+            name, station["state"], station["restarts"], counters["cycles"], counters["drilled"], counters["damaged"],
+            counters["io_errors"], waits[0], waits[1], waits[2], station["interlock_share"] * 100))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Starts and supervises the workstations of a configuration file")
+    parser.add_argument("config", help="JSON file with the stations (see supervisor.load_config)")
+    parser.add_argument("--report-interval", type=float, default=60.0, help="seconds between two reports")
+    arguments = parser.parse_args()
+    Supervisor(load_config(arguments.config)).run(arguments.report_interval)
@@ -0,0 +1,656 @@
+from collections import deque
+from time import monotonic, monotonic_ns
+from typing import NamedTuple
+import asyncio
+import struct
+import threading
+
+
+class TelemetryRecord(NamedTuple):
+    """
+    One complete telemetry sample of a workstation.
+    """
+    station: str
+    sequence: int
+    timestamp_ns: int
+    total: int
+    drilled: int
+    damaged: int
+    drilling_time: float
+
+
+#Binärformat (little endian, 39 Byte): Version, Stations-ID (6 Byte ASCII), Sequenznummer,
+#monotoner Zeitstempel in ns, Total, Drilled, Damaged, Bohrzeit in s
+TELEMETRY_RECORD_VERSION = 1
+TELEMETRY_RECORD = struct.Struct("<B6sIQIIId")
+
+
+def encode_record(record):
+    """
+    Packs a TelemetryRecord into the fixed binary layout TELEMETRY_RECORD.
+
+    :param record TelemetryRecord
+    :rtype bytes
+    """
+    return TELEMETRY_RECORD.pack(TELEMETRY_RECORD_VERSION, record.station.encode("ascii"), record.sequence & 0xFFFFFFFF,
+                                 record.timestamp_ns, record.total, record.drilled, record.damaged, record.drilling_time)
+
+
+def decode_record(payload):
+    """
+    Unpacks a binary telemetry message.
+
+    :param payload bytes of one message
+    :rtype TelemetryRecord
+    :raises ValueError if the payload has the wrong size or version
+    """
+    if len(payload) != TELEMETRY_RECORD.size:
+        raise ValueError("telemetry record must have %d bytes, got %d" % (TELEMETRY_RECORD.size, len(payload)))
+    version, station, sequence, timestamp_ns, total, drilled, damaged, drilling_time = TELEMETRY_RECORD.unpack(payload)
+    if version != TELEMETRY_RECORD_VERSION:
+        raise ValueError("unknown telemetry record version %d" % version)
+    return TelemetryRecord(station.rstrip(b"\0").decode("ascii"), sequence, timestamp_ns, total, drilled, damaged, drilling_time)
+
+
+class MqttTelemetryPublisher:
+    """
+    Long-lived MQTT connection of a workstation for its counters. Connects once in the background, reconnects
+    automatically (paho network loop) and publishes all counters of a sample back to back over the same session
+    instead of opening a new connection per value.
+    """
+    #Standard-Topics der Zähler, wie sie bisher mit publish.single verwendet wurden
+    TOPICS = {"total": "Total block:", "drilled": "Drilled block:", "damaged": "Damaged block:"}
+
+    def __init__(self, hostname, port = 1883, qos = 0, retain = False, topics = None, client_id = "", keepalive = 60, encoding = "text", station = None):
+        """
+        :param hostname Hostname or ip-adress of the MQTT broker
+        :param port Port of the MQTT broker
+        :param qos MQTT quality of service for all messages (0, 1 or 2)
+        :param retain Sets the retain flag of all messages
+        :param topics dict that maps the counter names ("total", "drilled", "damaged") to topics, TOPICS if None
+        :param client_id MQTT client id (empty for a random id)
+        :param keepalive Keepalive interval in seconds
+        :param encoding "text" publishes every counter as plain text on its own topic, "binary" publishes one
+                        TelemetryRecord per sample on the topic "workstation/<station>/telemetry" (see decode_record)
+        :param station Identifier of the workstation, required for the binary encoding (at most 6 ASCII characters)
+        """
+        import paho.mqtt.client as mqtt
+
+        if encoding not in ("text", "binary"):
+            raise ValueError("unknown encoding " + str(encoding))
+        if encoding == "binary" and (not station or len(station.encode("ascii")) > 6):
+            raise ValueError("binary encoding needs a station identifier with 1-6 ASCII characters")
+
+        self.hostname = hostname
+        self.port = port
+        self.qos = qos
+        self.retain = retain
+        self.topics = dict(self.TOPICS if topics is None else topics)
+        self.encoding = encoding
+        self.station = station
+        self.record_topic = "workstation/%s/telemetry" % station
+        #Letzter vollständiger Stand für das Binärformat, Teil-Samples werden darin zusammengeführt
+        self._state = {"total": 0, "drilled": 0, "damaged": 0, "drilling_time": 0.0}
+        self._sequence = 0
+
+        try:
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+        except AttributeError:
+            #paho-mqtt < 2.0
+            self.client = mqtt.Client(client_id=client_id)
+        self._success = mqtt.MQTT_ERR_SUCCESS
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+        self._lock = threading.Lock()
+        self.connected = False
+        self.connects = 0
+        self.published = 0
+        self.failed = 0
+
+        self.client.connect_async(hostname, port, keepalive)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, reason_code, *args):
+        self.connected = reason_code == 0
+        if self.connected:
+            self.connects += 1
+
+    def _on_disconnect(self, client, userdata, *args):
+        self.connected = False
+
+    def publish(self, values):
+        """
+        Publishes several values in one batch over the open session.
+
+        :param values dict of counter name to value, e.g. {"total": 3, "drilled": 2, "damaged": 1, "drilling_time": 4.2};
+                      in text encoding values without a topic (drilling_time by default) are not published
+        :returns number of messages that were handed over to the session
+        :rtype int
+        """
+        sent = 0
+        with self._lock:
+            if self.encoding == "binary":
+                return self._publish_record(values)
+            for name, value in values.items():
+                topic = self.topics.get(name)
+                if topic is None:
+                    continue
+                info = self.client.publish(topic, value, qos=self.qos, retain=self.retain)
+                if info.rc == self._success:
+                    sent += 1
+                else:
+                    self.failed += 1
+            self.published += sent
+        return sent
+
+    def _publish_record(self, values):
+        self._state.update(values)
+        self._sequence += 1
+        record = TelemetryRecord(self.station, self._sequence, monotonic_ns(), self._state["total"], self._state["drilled"],
+                                 self._state["damaged"], float(self._state["drilling_time"]))
+        info = self.client.publish(self.record_topic, encode_record(record), qos=self.qos, retain=self.retain)
+        if info.rc != self._success:
+            self.failed += 1
+            return 0
+        self.published += 1
+        return 1
+
+    def publish_counters(self, total, drilled, damaged):
+        """
+        Publishes the counters of the workstation.
+
+        :param total Total number of blocks
+        :param drilled Number of drilled blocks
+        :param damaged Number of damaged blocks
+        """
+        return self.publish({"total": total, "drilled": drilled, "damaged": damaged})
+
+    def stats(self):
+        """
+        :returns connection state, number of connects and of published and failed messages
+        :rtype dict
+        """
+        return {"connected": self.connected, "connects": self.connects, "published": self.published, "failed": self.failed}
+
+    def close(self):
+        """
+        Disconnects from the broker and stops the network loop.
+        """
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class OpcUaTelemetrySession:
+    """
+    Long-lived OPC UA client session for the counters of a workstation. Connects once, caches the namespace index,
+    the node handles and their data types and writes all values of a sample with one Write service request.
+    If a write fails, the session is set up again and the write is repeated once.
+    """
+    #Kurznamen der Zähler; die NodeIds auf dem Server aus ServerCode_1.py sind ns=<uri>;s=<station>.<Kurzname>
+    NODES = {"total": "TB", "drilled": "DIB", "damaged": "DMB", "drilling_time": "DRILL"}
+
+    def __init__(self, url = "opc.tcp://localhost:4840/", uri = "http://example.uri.github.io", nodes = None, timeout = 4, station = None):
+        """
+        :param url Endpoint of the OPC UA server
+        :param uri Namespace uri of the workstation variables
+        :param nodes dict that maps the value names ("total", "drilled", "damaged", "drilling_time") to string NodeIds, NODES if None
+        :param timeout Timeout of the OPC UA requests in seconds
+        :param station identifier of the station (WorkstationModule.identifier); the NodeIds are prefixed with "<station>." if given
+        """
+        self.url = url
+        self.uri = uri
+        self.station = station
+        self.node_ids = dict(self.NODES if nodes is None else nodes)
+        if station is not None:
+            self.node_ids = {name: station + "." + node_id for name, node_id in self.node_ids.items()}
+        self.timeout = timeout
+
+        self.client = None
+        self._nodes = {}
+        self._variant_types = {}
+        self._loop = None
+
+        self.connects = 0
+        self.writes = 0
+        self.errors = 0
+
+    async def connect(self):
+        """
+        Connects to the server and resolves namespace index, nodes and data types once.
+        """
+        from asyncua import Client
+
+        client = Client(url=self.url, timeout=self.timeout)
+        await client.connect()
+        try:
+            idx = await client.get_namespace_index(self.uri)
+            nodes = {name: client.get_node("ns=%d;s=%s" % (idx, node_id)) for name, node_id in self.node_ids.items()}
+            variant_types = {name: await node.read_data_type_as_variant_type() for name, node in nodes.items()}
+        except BaseException:
+            await client.disconnect()
+            raise
+        self.client = client
+        self._nodes = nodes
+        self._variant_types = variant_types
+        self.connects += 1
+
+    async def disconnect(self):
+        """
+        Closes the session.
+        """
+        client, self.client = self.client, None
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+
+    async def write(self, values):
+        """
+        Writes several values with one Write service request.
+
+        :param values dict of value name to value, e.g. {"total": 3, "drilled": 2, "damaged": 1, "drilling_time": 4.2}
+        """
+        try:
+            if self.client is None:
+                await self.connect()
+            await self._write(values)
+        except Exception:
+            #Session neu aufbauen und den Schreibzugriff einmal wiederholen
+            self.errors += 1
+            await self.disconnect()
+            await self.connect()
+            await self._write(values)
+        self.writes += 1
+
+    async def _write(self, values):
+        from asyncua import ua
+
+        names = [name for name in values if name in self._nodes]
+        await self.client.write_values([self._nodes[name] for name in names],
+                                       [ua.Variant(values[name], self._variant_types[name]) for name in names])
+
+    def publish(self, values):
+        """
+        Synchronous write() on an event loop owned by the session, e.g. as sink of a TelemetryPipeline.
+        Must not be called from a thread with a running event loop.
+
+        :param values dict of value name to value
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self.write(values))
+
+    def close(self):
+        """
+        Closes the session and the event loop of publish().
+        """
+        if self._loop is not None:
+            self._loop.run_until_complete(self.disconnect())
+            self._loop.close()
+            self._loop = None
+
+    def stats(self):
+        """
+        :returns connection state, number of connects, successful writes and failed writes
+        :rtype dict
+        """
+        return {"connected": self.client is not None, "connects": self.connects, "writes": self.writes, "errors": self.errors}
+
+
+class NullPublisher:
+    """
+    Telemetry publisher that drops all samples, e.g. to measure or replay a station without a broker or server.
+    """
+
+    def publish(self, values):
+        return 0
+
+    def close(self):
+        pass
+
+
+class ChangeFilter:
+    """
+    Change detection between the counters and a publisher. Keeps the last published values and only lets values
+    through that changed since then. Changes are sent at most every min_interval seconds (changes in between are
+    collected), and at least every heartbeat_interval seconds the full last-value state is sent again.
+    """
+
+    def __init__(self, min_interval = 1.0, heartbeat_interval = 60.0):
+        """
+        :param min_interval Minimum time in seconds between two published samples
+        :param heartbeat_interval Maximum time in seconds without a published sample (None disables the heartbeat)
+        """
+        self.min_interval = min_interval
+        self.heartbeat_interval = heartbeat_interval
+
+        self.last_values = {}
+        self._pending = {}
+        self._last_publish = None
+
+        self.offered = 0
+        self.sent = 0
+        self.suppressed = 0
+        self.heartbeats = 0
+
+    def offer(self, sample, now = None):
+        """
+        Offers a new sample.
+
+        :param sample dict of name to value
+        :param now monotonic timestamp (optional)
+        :returns the values that have to be published now or None
+        :rtype dict or none
+        """
+        self.offered += 1
+        for name, value in sample.items():
+            if name not in self.last_values or self.last_values[name] != value:
+                self._pending[name] = value
+            else:
+                #Wert ist wieder beim zuletzt veröffentlichten Stand
+                self._pending.pop(name, None)
+        result = self.flush(now)
+        if result is None:
+            self.suppressed += 1
+        return result
+
+    def flush(self, now = None, force = False):
+        """
+        Returns the collected changes if min_interval has passed (or force is set), or the full state if the heartbeat is due.
+
+        :param now monotonic timestamp (optional)
+        :param force Ignores min_interval
+        :returns the values that have to be published now or None
+        :rtype dict or none
+        """
+        if now is None:
+            now = monotonic()
+        if self._heartbeat_due(now):
+            values = dict(self.last_values)
+            values.update(self._pending)
+            self.heartbeats += 1
+        elif self._pending and (force or self._last_publish is None or now - self._last_publish >= self.min_interval):
+            values = dict(self._pending)
+        else:
+            return None
+        self.last_values.update(values)
+        self._pending.clear()
+        self._last_publish = now
+        self.sent += 1
+        return values
+
+    def failed(self, values):
+        """
+        Takes back values returned by offer() or flush() whose publishing failed. They no longer count as published
+        and are returned again by the next flush(), unless a newer value of the same name is pending.
+
+        :param values dict of name to value as returned by offer() or flush()
+        """
+        for name, value in values.items():
+            if self.last_values.get(name) == value:
+                del self.last_values[name]
+            self._pending.setdefault(name, value)
+        self.sent -= 1
+
+    def next_due(self, now = None):
+        """
+        :returns seconds until flush() may return something, None if nothing is due
+        :rtype float or none
+        """
+        if self._last_publish is None:
+            return 0.0 if self._pending else None
+        if now is None:
+            now = monotonic()
+        due = []
+        if self._pending:
+            due.append(self._last_publish + self.min_interval - now)
+        if self.heartbeat_interval is not None:
+            due.append(self._last_publish + self.heartbeat_interval - now)
+        return max(0.0, min(due)) if due else None
+
+    def stats(self):
+        """
+        :returns offered, sent and suppressed samples and sent heartbeats
+        :rtype dict
+        """
+        return {"offered": self.offered, "sent": self.sent, "suppressed": self.suppressed, "heartbeats": self.heartbeats}
+
+    def _heartbeat_due(self, now):
+        return self.heartbeat_interval is not None and self._last_publish is not None \
+            and now - self._last_publish >= self.heartbeat_interval
+
+
+class TelemetryPipeline:
+    """
+    Bounded, non-blocking queue between the control loop and a telemetry publisher. submit() never waits for the
+    network, a dedicated worker thread hands the samples to the sink. If the sink falls behind and the queue is
+    full, a new sample is merged into the newest waiting one (only the latest counter values are kept) or, without
+    coalescing, the oldest waiting sample is dropped. The physical cycle therefore never depends on network latency.
+    """
+
+    def __init__(self, sink, maxsize = 16, coalesce = True, name = "telemetry", change_filter = None):
+        """
+        :param sink callable that publishes one sample (dict of name to value), e.g. MqttTelemetryPublisher.publish
+        :param maxsize Maximum number of waiting samples
+        :param coalesce Merges samples into the newest waiting one when the queue is full, otherwise the oldest is dropped
+        :param name Name of the worker thread
+        :param change_filter ChangeFilter applied by the worker, only changed values and heartbeats reach the sink (optional)
+        """
+        self.sink = sink
+        self.change_filter = change_filter
+        self.maxsize = maxsize
+        self.coalesce = coalesce
+
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self.submitted = 0
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_lag = None
+        self.max_lag = 0.0
+
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, sample):
+        """
+        Queues a sample for publishing without blocking.
+
+        :param sample dict of name to value
+        :returns false if the pipeline is closed or a waiting sample was dropped
+        :rtype bool
+        """
+        with self._condition:
+            if self._closed:
+                self.dropped += 1
+                return False
+            self.submitted += 1
+            accepted = True
+            if len(self._queue) >= self.maxsize:
+                if self.coalesce:
+                    #Der Zeitpunkt des älteren Samples bleibt erhalten, damit der Rückstand sichtbar bleibt
+                    self._queue[-1][1].update(sample)
+                    self.coalesced += 1
+                    return True
+                self._queue.popleft()
+                self.dropped += 1
+                accepted = False
+            self._queue.append((monotonic(), dict(sample)))
+            self._condition.notify()
+            return accepted
+
+    def pending(self):
+        """
+        :returns number of waiting samples
+        :rtype int
+        """
+        with self._condition:
+            return len(self._queue)
+
+    def stats(self):
+        """
+        :returns submitted, published, coalesced, dropped and failed samples, waiting samples, the lag
+                 (seconds from submit until the sink got the sample, last and maximum) and the ChangeFilter statistics
+        :rtype dict
+        """
+        with self._condition:
+            stats = {"submitted": self.submitted, "published": self.published, "coalesced": self.coalesced,
+                     "dropped": self.dropped, "errors": self.errors, "pending": len(self._queue),
+                     "last_lag": self.last_lag, "max_lag": self.max_lag}
+        if self.change_filter is not None:
+            stats["change_filter"] = self.change_filter.stats()
+        return stats
+
+    def close(self, timeout = 5.0):
+        """
+        Publishes the waiting samples and stops the worker thread.
+
+        :param timeout Maximum time in seconds to wait for the worker
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._worker.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    #Mit ChangeFilter wird auch ohne neue Samples für Heartbeats und zurückgehaltene Änderungen geweckt
+                    timeout = None if self.change_filter is None else self.change_filter.next_due()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                if self._queue:
+                    submitted_at, sample = self._queue.popleft()
+                    lag = monotonic() - submitted_at
+                    self.last_lag = lag
+                    self.max_lag = max(self.max_lag, lag)
+                elif self._closed and self.change_filter is None:
+                    return
+                else:
+                    sample = None
+
+            if self.change_filter is not None:
+                if sample is not None:
+                    sample = self.change_filter.offer(sample)
+                if sample is None:
+                    #Beim Schließen werden zurückgehaltene Änderungen sofort veröffentlicht
+                    sample = self.change_filter.flush(force=self._closed)
+                if not sample:
+                    if self._closed and not self._queue:
+                        return
+                    continue
+            try:
+                self.sink(sample)
+            except Exception:
+                #Die Werte gelten nicht als veröffentlicht, der ChangeFilter liefert sie beim nächsten Mal wieder
+                if self.change_filter is not None:
+                    self.change_filter.failed(sample)
+                with self._condition:
+                    self.errors += 1
+            else:
+                with self._condition:
+                    self.published += 1
+
+
+class AsyncTelemetryPipeline:
+    """
+    asyncio counterpart of the TelemetryPipeline: submit() never awaits the network, a task of its own awaits the sink.
+    If the sink falls behind and the queue is full, a new sample is merged into the newest waiting one, so a slow
+    broker or server never stalls the work cycle in the event loop.
+    """
+
+    def __init__(self, sink, maxsize = 16):
+        """
+        :param sink coroutine function that publishes one sample (dict of name to value)
+        :param maxsize Maximum number of waiting samples
+        """
+        self.sink = sink
+        self.maxsize = maxsize
+
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+        self.submitted = 0
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_lag = None
+        self.max_lag = 0.0
+
+    def submit(self, sample):
+        """
+        Queues a sample for publishing without awaiting anything. Must be called in the event loop.
+
+        :param sample dict of name to value
+        :returns false if the pipeline is closed
+        :rtype bool
+        """
+        if self._closed:
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        if len(self._queue) >= self.maxsize:
+            self._queue[-1][1].update(sample)
+            self.coalesced += 1
+        else:
+            self._queue.append((monotonic(), dict(sample)))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+        return True
+
+    def stats(self):
+        """
+        :returns submitted, published, coalesced, dropped and failed samples, waiting samples and the lag
+                 (seconds from submit until the sink got the sample, last and maximum)
+        :rtype dict
+        """
+        return {"submitted": self.submitted, "published": self.published, "coalesced": self.coalesced,
+                "dropped": self.dropped, "errors": self.errors, "pending": len(self._queue),
+                "last_lag": self.last_lag, "max_lag": self.max_lag}
+
+    async def close(self, timeout = 5.0):
+        """
+        Publishes the waiting samples and stops the task.
+
+        :param timeout Maximum time in seconds to wait for the task, then it is cancelled
+        """
+        self._closed = True
+        self._wakeup.set()
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+        self._task = None
+
+    async def _run(self):
+        while True:
+            while not self._queue:
+                if self._closed:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            submitted_at, sample = self._queue.popleft()
+            lag = monotonic() - submitted_at
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            try:
+                await self.sink(sample)
+            except Exception:
+                self.errors += 1
+            else:
+                self.published += 1
@@ -0,0 +1,620 @@
+from pyModbusTCP.utils import set_bit
+from pyModbusTCP.utils import reset_bit
+
+from workstation_io import SensorSnapshot
+from workstation_io import OutputShadow
+from workstation_io import OutputBatch
+from workstation_io import RetryPolicy
+from workstation_io import ModbusIOError
+from workstation_io import SensorTimeoutError
+from workstation_io import circuit_breaker_for
+from telemetry import AsyncTelemetryPipeline
+
+from contextlib import asynccontextmanager
+from time import monotonic, perf_counter
+import asyncio
+import contextvars
+import struct
+
+
+class AsyncModbusConnection:
+    """
+    Modbus TCP session based on asyncio streams (function codes 3 and 16).
+    The session stays open between requests and is opened again after an error.
+    Requests of one connection are serialized, requests to different nodes run concurrently in the same event loop.
+    """
+
+    def __init__(self, host, port = 502, unit_id = 1, timeout = 2.0):
+        """
+        :param host Ip-adress of the modbus node (String)
+        :param port TCP port of the modbus node
+        :param unit_id Modbus unit id
+        :param timeout Timeout in seconds for every single request
+        """
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.timeout = timeout
+
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+        self._transaction_id = 0
+        self._connected_before = False
+
+        self.requests = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.last_rtt = None
+        self.max_rtt = 0.0
+        self._rtt_sum = 0.0
+
+    @property
+    def is_open(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def open(self):
+        """
+        Opens the session if it is not open yet.
+
+        :returns true if the session is open
+        :rtype bool
+        """
+        async with self._lock:
+            return await self._ensure_open()
+
+    async def close(self):
+        """
+        Closes the session.
+        """
+        async with self._lock:
+            await self._close()
+
+    async def read_holding_registers(self, reg_addr, reg_nb = 1):
+        """
+        Reads holding registers (function code 3).
+
+        :returns list of read registers (or None if it fails)
+        :rtype list of int or none
+        """
+        pdu = await self._request(struct.pack(">BHH", 3, reg_addr, reg_nb))
+        if pdu is None or len(pdu) < 2 or pdu[1] != 2 * reg_nb:
+            return None
+        return list(struct.unpack(">%dH" % reg_nb, pdu[2:2 + 2 * reg_nb]))
+
+    async def write_multiple_registers(self, regs_addr, regs_value):
+        """
+        Writes holding registers (function code 16).
+
+        :returns True if the write was successful, otherwise None
+        :rtype bool or none
+        """
+        values = list(regs_value)
+        request = struct.pack(">BHHB", 16, regs_addr, len(values), 2 * len(values)) + struct.pack(">%dH" % len(values), *values)
+        pdu = await self._request(request)
+        if pdu is None or len(pdu) < 5 or struct.unpack(">HH", pdu[1:5]) != (regs_addr, len(values)):
+            return None
+        return True
+
+    def stats(self):
+        """
+        :returns connection metrics (requests, errors, reconnects, RTT in seconds)
+        :rtype dict
+        """
+        return {
+            "host": self.host,
+            "open": self.is_open,
+            "requests": self.requests,
+            "errors": self.errors,
+            "reconnects": self.reconnects,
+            "last_rtt": self.last_rtt,
+            "avg_rtt": self._rtt_sum / self.requests if self.requests else None,
+            "max_rtt": self.max_rtt,
+        }
+
+    async def _ensure_open(self):
+        if self.is_open:
+            return True
+        try:
+            self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self._reader = self._writer = None
+            return False
+        if self._connected_before:
+            self.reconnects += 1
+        self._connected_before = True
+        return True
+
+    async def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self._reader = self._writer = None
+
+    async def _request(self, pdu):
+        async with self._lock:
+            if not await self._ensure_open():
+                self.errors += 1
+                return None
+            self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+            frame = struct.pack(">HHHB", self._transaction_id, 0, len(pdu) + 1, self.unit_id) + pdu
+
+            start = perf_counter()
+            try:
+                self._writer.write(frame)
+                await self._writer.drain()
+                header = await asyncio.wait_for(self._reader.readexactly(7), self.timeout)
+                transaction_id, protocol, length, unit_id = struct.unpack(">HHHB", header)
+                response = await asyncio.wait_for(self._reader.readexactly(length - 1), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                #Nach einem Fehler wird die Session beim nächsten Request neu aufgebaut
+                self.errors += 1
+                await self._close()
+                return None
+            rtt = perf_counter() - start
+
+            self.requests += 1
+            self.last_rtt = rtt
+            self._rtt_sum += rtt
+            if rtt > self.max_rtt:
+                self.max_rtt = rtt
+
+            if transaction_id != self._transaction_id or protocol != 0 or response[0] != pdu[0]:
+                #Exception-Antwort oder Antwort auf einen anderen Request
+                self.errors += 1
+                if transaction_id != self._transaction_id:
+                    await self._close()
+                return None
+            return response
+
+
+class AsyncWorkstationModule:
+    """
+    asyncio variant of the WorkstationModule. Register I/O, sensor waits and actuator commands are awaitables,
+    so the work cycles of many workstations (and e.g. an asyncua client) run concurrently in one event loop.
+    """
+    #Konstanten
+    DIGITAL_INPUT_STARTING_ADDRESS = 8001
+    DIGITAL_OUTPUT_STARTING_ADDRESS = 8003
+    #Übergänge werden von den Sensoren bestätigt: Abfrageintervall und Timeouts in Sekunden
+    SENSOR_POLL_INTERVAL = 0.02
+    TURNTABLE_START_TIMEOUT = 1.0
+    TURNTABLE_TIMEOUT = 5.0
+    DRILL_DOWN_TIMEOUT = 10.0
+    DRILL_UP_TIMEOUT = 10.0
+    #Prüfer und Auswerfer haben keine Endlagensensoren, ohne Bohren bekommen sie diese feste Zeit für ihre Bewegung
+    SETTLE_TIME = 0.35
+
+    def __init__(self, ip_addr, sem_output : asyncio.Semaphore = None, sem_self_turning : asyncio.Semaphore = None, sem_opposite_turning : asyncio.Semaphore = None, output_verify_interval = None, modbus_timeout = 2.0, port = 502, retry_policy : RetryPolicy = None):
+        """
+        Konstruktor of the AsyncWorkstationModules.
+
+        :param ip_addr Ip-adress of the modbus node, which is used for the workstation (String)
+        :param sem_output Semaphore for checking if the exit is currently free (doesnt have to be used)
+        :param sem_self_turning Semaphore to show if the stations table is currently turning (the opposite station cant use the exit while the table is turning)
+        :param sem_opposite_turning Semaphore to see if the oposite stations table is currently turning (this station cant use the exit while the table of the other station is turning)
+        :param output_verify_interval Seconds after which the local copy of the output register is checked against the modbus again
+                                      (None only after errors, 0 before every write)
+        :param modbus_timeout Timeout in seconds for every modbus request
+        :param port TCP port of the modbus node
+        :param retry_policy RetryPolicy for all register accesses, a default policy is used if None
+        """
+        self.client = AsyncModbusConnection(ip_addr, port=port, timeout=modbus_timeout)
+
+        self.identifier = 'B' + ip_addr[len(ip_addr)-1]
+
+        self.sem_output = sem_output
+        self.sem_self_turning = sem_self_turning
+        self.sem_opposite_turning = sem_opposite_turning
+
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.breaker = circuit_breaker_for(ip_addr, port)
+
+        self.sem = asyncio.Lock()
+        self.output_shadow = OutputShadow(output_verify_interval)
+        #Offene Transaktion (OutputBatch) des jeweiligen Tasks
+        self._batch = contextvars.ContextVar("batch_%x" % id(self), default=None)
+        #Entkoppelt die Telemetrie vom Takt (AsyncTelemetryPipeline), wird von work() angelegt
+        self.telemetry = None
+
+    async def close(self):
+        """
+        Closes the connection to the modbus and publishes the waiting telemetry. The next register access opens the connection again.
+        """
+        await self.client.close()
+        if self.telemetry is not None:
+            await self.telemetry.close()
+            self.telemetry = None
+
+    async def get_output_register(self, offset = 0, amount = 1):
+        """
+        Returns the output registers of the modbus.
+
+        :param offset Offset to DIGITAL_OUTPUT_STARTING_ADDRESS
+        :param amount Amount of registers that can be read
+        :rtype list of int
+        :raises ModbusIOError if the registers can not be read (see retry_policy)
+        """
+        return await self._retry(self.client.read_holding_registers, self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, amount)
+
+    async def get_input_register(self, offset = 0, amount = 1):
+        """
+        Returns the input registers of the modbus.
+
+        :param offset Offset to DIGITAL_INPUT_STARTING_ADDRESS
+        :param amount Amount of registers that can be read
+        :rtype list of int
+        :raises ModbusIOError if the registers can not be read (see retry_policy)
+        """
+        return await self._retry(self.client.read_holding_registers, self.DIGITAL_INPUT_STARTING_ADDRESS + offset, amount)
+
+    async def set_output_register(self, register, offset = 0):
+        """
+        Overwrites the output register of the modbus.
+
+        :param register list of int that should be written to the registers
+        :param offset Offset to DIGITAL_OUTPUT_STARTING_ADDRESS
+        :raises ModbusIOError if the registers can not be written (see retry_policy)
+        """
+        return await self._retry(self.client.write_multiple_registers, self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, register)
+
+    async def _retry(self, function, *args):
+        return await self.retry_policy.call_async(function, *args, breaker=self.breaker)
+
+    async def _apply_outputs(self, set_bits = (), reset_bits = ()):
+        """
+        Changes bits of the local copy of the output register and writes the result. Must be called with self.sem held.
+        """
+        if self.output_shadow.needs_sync():
+            self.output_shadow.sync((await self.get_output_register())[0])
+        value = self.output_shadow.value
+        for bit in reset_bits:
+            value = reset_bit(value, bit)
+        for bit in set_bits:
+            value = set_bit(value, bit)
+        try:
+            await self.set_output_register([value])
+        except BaseException:
+            self.output_shadow.invalidate()
+            raise
+        self.output_shadow.value = value
+
+    async def _update_outputs(self, set_bits = (), reset_bits = ()):
+        """
+        Sets and resets bits of the output register with a single write.
+        Inside of transaction() the bits are only collected and written when the transaction ends.
+        """
+        batch = self._batch.get()
+        if batch is not None:
+            batch.add(set_bits, reset_bits)
+            return
+        async with self.sem:
+            await self._apply_outputs(set_bits, reset_bits)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Collects all actuator commands of the async with-block and writes them with one write_multiple_registers call
+        when the block ends. If the block raises an exception, the collected commands are discarded.
+        """
+        if self._batch.get() is not None:
+            yield
+            return
+        batch = OutputBatch()
+        token = self._batch.set(batch)
+        try:
+            yield
+        finally:
+            self._batch.reset(token)
+        if batch:
+            async with self.sem:
+                await self._apply_outputs(batch.set_bits, batch.reset_bits)
+
+    async def drill_on(self):
+        """
+        Turns on the drill
+        """
+        await self._update_outputs(set_bits = (0,))
+
+    async def drill_off(self):
+        """
+        Turns of the drill
+        """
+        await self._update_outputs(reset_bits = (0,))
+
+    async def drill_up(self):
+        """
+        Drives the drill up
+        """
+        await self._update_outputs(set_bits = (3,), reset_bits = (2,))
+
+    async def drill_down(self):
+        """
+        Drives the drill down
+        """
+        await self._update_outputs(set_bits = (2,), reset_bits = (3,))
+
+    async def drill_stop(self):
+        """
+        Stops the vertical movement of the drill.
+        """
+        await self._update_outputs(reset_bits = (2, 3))
+
+    async def lock_piece(self):
+        """
+        Activates the lock for the pieces under the drill.
+        """
+        await self._update_outputs(set_bits = (4,))
+
+    async def unlock_piece(self):
+        """
+        Deactivates the lock for the pieces under the drill.
+        """
+        await self._update_outputs(reset_bits = (4,))
+
+    async def turntable_on(self):
+        """
+        Starts the turntable.
+        """
+        await self._update_outputs(set_bits = (1,))
+
+    async def turntable_off(self):
+        """
+        Stops the turntable.
+        """
+        await self._update_outputs(reset_bits = (1,))
+
+    async def turntable_turn_single(self):
+        """
+        Turns the turn table exactly for one position (can not be used inside of transaction()).
+        The turn signal is held until the turntable leaves its position.
+
+        :raises SensorTimeoutError if the turntable does not start turning within TURNTABLE_START_TIMEOUT
+        """
+        if self._batch.get() is not None:
+            raise RuntimeError("turntable_turn_single can not be used inside of a transaction")
+        async with self.sem:
+            await self._apply_outputs(set_bits = (1,))
+            try:
+                await self.wait_for_sensors(lambda snapshot: not snapshot.turntable_in_position, self.SENSOR_POLL_INTERVAL,
+                                            self.TURNTABLE_START_TIMEOUT, "turntable leaving its position")
+            finally:
+                await self._apply_outputs(reset_bits = (1,))
+
+    async def checker_down(self):
+        """
+        Drives the checker down.
+        """
+        await self._update_outputs(set_bits = (5,))
+
+    async def checker_up(self):
+        """
+        Drives the checker up.
+        """
+        await self._update_outputs(reset_bits = (5,))
+
+    async def ejector_output_extend(self):
+        """
+        Activates the ejactor at the exit.
+        """
+        await self._update_outputs(set_bits = (6,))
+
+    async def ejector_input_extend(self):
+        """
+        Activates the ejactor at the input.
+        """
+        await self._update_outputs(set_bits = (7,))
+
+    async def ejector_output_retract(self):
+        """
+        Deactivates the ejactor at the exit.
+        """
+        await self._update_outputs(reset_bits = (6,))
+
+    async def ejector_input_retract(self):
+        """
+        Deactivates the ejactor at the exit.
+        """
+        await self._update_outputs(reset_bits = (6,))
+
+    async def read_sensors(self):
+        """
+        Reads the input register once and decodes all sensors into an immutable snapshot.
+
+        :rtype SensorSnapshot
+        """
+        return SensorSnapshot.from_register((await self.get_input_register())[0])
+
+    async def wait_for_sensors(self, condition, poll_interval = None, timeout = None, description = "condition"):
+        """
+        Waits until condition(snapshot) is true without blocking the event loop.
+
+        :param condition callable that gets a SensorSnapshot and returns a bool
+        :param poll_interval Seconds between two reads of the input register, SENSOR_POLL_INTERVAL if None
+        :param timeout Maximum time to wait in seconds (None waits forever)
+        :param description Name of the awaited state for the error message
+        :returns the snapshot that fulfilled the condition
+        :rtype SensorSnapshot
+        :raises SensorTimeoutError if the condition was not fulfilled before the deadline
+        """
+        if poll_interval is None:
+            poll_interval = self.SENSOR_POLL_INTERVAL
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            snapshot = await self.read_sensors()
+            if condition(snapshot):
+                return snapshot
+            if deadline is None:
+                await asyncio.sleep(poll_interval)
+                continue
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise SensorTimeoutError(description, timeout)
+            await asyncio.sleep(min(poll_interval, remaining))
+
+    async def work(self, queue_to_TS = None, telemetry = None):
+        """
+        Same work cycle as WorkstationModule.work(), see there.
+
+        :param queue_to_TS Queue to the transport system, gets [identifier, 'WA'] or [identifier, 'DZA'] for every ejected workpiece
+        :param telemetry optional coroutine function telemetry(total, drilled, damaged) that gets the counters when a workpiece
+                         is detected; it is awaited by the AsyncTelemetryPipeline, not by the work cycle
+        :raises SensorTimeoutError if the turntable or the drill do not reach their position within their timeout
+                                   (if the drill does not reach the bottom, it is driven up and turned off before)
+        """
+        if telemetry is not None and self.telemetry is None:
+            async def publish(sample):
+                await telemetry(sample["total"], sample["drilled"], sample["damaged"])
+            self.telemetry = AsyncTelemetryPipeline(publish)
+
+        drilled = 0
+        damaged = 0
+
+        workpiece_ok = False
+        workpiece_nok = False
+        workpiece_nok_drill = False
+        workpiece_eject = False
+        workpiece_nok_output = False
+
+        while True:
+            try:
+                snapshot = await self.wait_for_sensors(lambda snapshot: snapshot.turntable_in_position and (snapshot.any_workpiece() or workpiece_nok or workpiece_nok_drill), 0.5)
+            except ModbusIOError as error:
+                #Modbus nicht erreichbar: warten bis der Circuit Breaker wieder Zugriffe erlaubt, dann neu beginnen
+                print("Modbus error at " + self.identifier + ": " + str(error))
+                await asyncio.sleep(max(self.breaker.retry_after(), 0.5))
+                continue
+
+            if self.telemetry is not None:
+                self.telemetry.submit({"total": drilled + damaged, "drilled": drilled, "damaged": damaged})
+
+            if self.sem_self_turning is not None:
+                await self.sem_self_turning.acquire()
+
+            if snapshot.workpiece_drill or workpiece_nok_drill:
+                if workpiece_nok_drill:
+                    workpiece_nok_output = True
+                workpiece_eject = True
+                workpiece_nok_drill = False
+            if workpiece_nok:
+                workpiece_nok = False
+                workpiece_nok_drill = True
+
+            try:
+                await self.turntable_turn_single()
+                await self.wait_for_sensors(lambda snapshot: snapshot.turntable_in_position, timeout=self.TURNTABLE_TIMEOUT,
+                                            description="turntable in position")
+            finally:
+                if self.sem_self_turning is not None:
+                    self.sem_self_turning.release()
+
+            async with self.transaction():
+                await self.checker_down()
+                if workpiece_eject:
+                    await self.ejector_output_extend()
+
+            #Die Sperre der gegenüberliegenden Station wird auch freigegeben, wenn der Takt mit einem Fehler abbricht
+            opposite_held = False
+            try:
+                if workpiece_eject:
+                    if self.sem_output is not None:
+                        await self.sem_output.acquire()
+                    if self.sem_opposite_turning is not None:
+                        await self.sem_opposite_turning.acquire()
+                        opposite_held = True
+
+                    if queue_to_TS is not None:
+                        if workpiece_nok_output:
+                            workpiece_nok_output = False
+                            queue_to_TS.put_nowait([self.identifier, 'DZA'])
+                        else:
+                            queue_to_TS.put_nowait([self.identifier, 'WA'])
+
+                    await self.ejector_output_retract()
+
+                drilling = workpiece_ok and (await self.read_sensors()).workpiece_drill
+                if drilling:
+                    async with self.transaction():
+                        await self.lock_piece()
+                        await self.drill_on()
+                        await self.drill_down()
+                    try:
+                        await self.wait_for_sensors(lambda snapshot: snapshot.drill_down, timeout=self.DRILL_DOWN_TIMEOUT,
+                                                    description="drill down")
+                    except SensorTimeoutError:
+                        #Bohrer kommt nicht unten an: Bohrer hoch und aus, bevor der Fehler weitergegeben wird
+                        async with self.transaction():
+                            await self.unlock_piece()
+                            await self.drill_up()
+                            await self.drill_off()
+                        raise
+                    async with self.transaction():
+                        await self.unlock_piece()
+                        await self.drill_up()
+                        await self.drill_off()
+                    drilled += 1
+                    #Weiter, sobald der Bohrer oben ist, statt einer festen Wartezeit
+                    await self.wait_for_sensors(lambda snapshot: snapshot.drill_up, timeout=self.DRILL_UP_TIMEOUT,
+                                                description="drill up")
+                else:
+                    await asyncio.sleep(self.SETTLE_TIME)
+
+                workpiece_ok = False
+
+                if (await self.read_sensors()).workpiece_normal:
+                    workpiece_ok = True
+                else:
+                    workpiece_nok = True
+                    damaged += 1
+                await self.checker_up()
+            finally:
+                if opposite_held:
+                    self.sem_opposite_turning.release()
+
+            if workpiece_eject:
+                await self.ejector_input_retract()
+                workpiece_eject = False
+
+
+async def run_stations(modules, queue_to_TS = None, telemetry = None, restart_delay = 1.0):
+    """
+    Runs the work cycles of several AsyncWorkstationModules concurrently in the running event loop.
+    Every station is supervised on its own: if its work() ends with an exception, the error is printed, the
+    connection is closed and the work cycle is started again after restart_delay seconds, the other stations go on.
+
+    :param modules list of AsyncWorkstationModule
+    :param queue_to_TS asyncio.Queue shared by all stations (optional)
+    :param telemetry coroutine function telemetry(identifier, total, drilled, damaged) (optional)
+    :param restart_delay seconds before the work cycle of a failed station is started again
+    """
+    def station_telemetry(module):
+        if telemetry is None:
+            return None
+        async def publish(total, drilled, damaged):
+            await telemetry(module.identifier, total, drilled, damaged)
+        return publish
+
+    async def supervise(module):
+        while True:
+            try:
+                await module.work(queue_to_TS, station_telemetry(module))
+                return
+            except Exception as error:
+                print("Station " + module.identifier + " failed: " + repr(error) + ", restart in " + str(restart_delay) + " s")
+                await module.close()
+                module.output_shadow.invalidate()
+                await asyncio.sleep(restart_delay)
+
+    try:
+        await asyncio.gather(*(supervise(module) for module in modules))
+    finally:
+        for module in modules:
+            await module.close()
+
+
+if __name__ == "__main__":
+    stations = [AsyncWorkstationModule("192.168.200.234")]
+    asyncio.run(run_stations(stations))
@@ -0,0 +1,856 @@
+from pyModbusTCP.client import ModbusClient
+from pyModbusTCP.utils import test_bit
+
+from time import monotonic, perf_counter, sleep
+import asyncio
+import multiprocessing
+import random
+import threading
+from typing import NamedTuple
+
+from metrics import Histogram
+
+
+class ModbusIOError(IOError):
+    """
+    Raised when a register access still fails after all attempts of the RetryPolicy.
+    """
+
+
+class CircuitOpenError(ModbusIOError):
+    """
+    Raised without contacting the modbus node while the CircuitBreaker of the node is open.
+    """
+
+    def __init__(self, host, retry_after):
+        super().__init__("circuit breaker for %s is open, retry in %.2f s" % (host, retry_after))
+        self.host = host
+        self.retry_after = retry_after
+
+
+class SensorTimeoutError(TimeoutError):
+    """
+    Raised when the sensors do not confirm an expected state of the workstation before the deadline.
+    """
+
+    def __init__(self, description, timeout):
+        super().__init__("%s not confirmed by the sensors within %.2f s" % (description, timeout))
+        self.description = description
+        self.timeout = timeout
+
+
+class SensorSnapshot(NamedTuple):
+    """
+    Immutable view of the digital input register (DIGITAL_INPUT_STARTING_ADDRESS) at one point in time.
+    The register is read once and every bit is decoded into a named field, so that several
+    decisions in one control tick are made on the same consistent state of the sensors.
+
+    Bit layout of the input register:
+    0-Workpiece sensor turntable entrance
+    1-Workpiece sensor drill
+    2-Workpiece sensor checker station
+    3-Drill is up
+    4-Drill is down
+    5-Turntable is in position
+    6-Checker detects a workpiece in normal position
+    """
+    raw: int
+    workpiece_entrance: bool
+    workpiece_drill: bool
+    workpiece_checker: bool
+    drill_up: bool
+    drill_down: bool
+    turntable_in_position: bool
+    workpiece_normal: bool
+
+    @classmethod
+    def from_register(cls, value):
+        """
+        Decodes the value of the input register.
+
+        :param value Content of the input register (int)
+        :returns decoded snapshot of all sensors
+        :rtype SensorSnapshot
+        """
+        return cls(value, *(test_bit(value, bit) for bit in range(7)))
+
+    def workpiece_sensor(self, sensor_id):
+        """
+        Returns the state of the workpiece sensor with the same numbering as WorkstationModule.check_workpiece_sensor.
+        1-Turntable entrance
+        2-Checker station
+        3-Drill
+
+        :param sensor_id Number of sensor to be checked (1-3)
+        :returns boolean to see if the sensor was activated (false for unspecified sensor numbers)
+        :rtype bool
+        """
+        if sensor_id == 1:
+            return self.workpiece_entrance
+        if sensor_id == 2:
+            return self.workpiece_checker
+        if sensor_id == 3:
+            return self.workpiece_drill
+        return False
+
+    def any_workpiece(self):
+        """
+        :returns true if at least one of the three workpiece sensors is activated
+        :rtype bool
+        """
+        return self.workpiece_entrance or self.workpiece_checker or self.workpiece_drill
+
+
+class OutputShadow:
+    """
+    Local copy of the output word at DIGITAL_OUTPUT_STARTING_ADDRESS.
+    Actuator commands are applied to the shadow and written to the device without reading the register first.
+    The shadow is read back from the device when its value is unknown (at start and after a failed write)
+    and, if verify_interval is set, whenever the last check is older than verify_interval seconds.
+    """
+
+    def __init__(self, verify_interval = None):
+        """
+        :param verify_interval Seconds after which the shadow is checked against the device again.
+                               None only checks after errors, 0 checks before every write
+                               (use this if another process writes the same outputs).
+        """
+        self.verify_interval = verify_interval
+        self.value = None
+        self.last_sync = None
+        self.syncs = 0
+        self.mismatches = 0
+
+    def needs_sync(self):
+        """
+        :returns true if the shadow has to be read back from the device before the next write
+        :rtype bool
+        """
+        if self.value is None:
+            return True
+        if self.verify_interval is None:
+            return False
+        return monotonic() - self.last_sync >= self.verify_interval
+
+    def sync(self, device_value):
+        """
+        Takes over the value read from the device. A difference to a known shadow value is counted as mismatch.
+
+        :param device_value Current content of the output register (int)
+        """
+        if self.value is not None and self.value != device_value:
+            self.mismatches += 1
+        self.value = device_value
+        self.last_sync = monotonic()
+        self.syncs += 1
+
+    def invalidate(self):
+        """
+        Marks the shadow as unknown, the next write reads the register from the device first.
+        """
+        self.value = None
+
+
+class OutputBatch:
+    """
+    Set and reset operations on the output register that are collected by WorkstationModule.transaction().
+    Later operations on the same bit override earlier ones, so the batch always describes the net change.
+    """
+
+    def __init__(self):
+        self.set_bits = set()
+        self.reset_bits = set()
+
+    def add(self, set_bits = (), reset_bits = ()):
+        """
+        Adds an operation to the batch (reset_bits are applied before set_bits, like in a single actuator call).
+
+        :param set_bits bits that are set
+        :param reset_bits bits that are reset
+        """
+        for bit in reset_bits:
+            self.set_bits.discard(bit)
+            self.reset_bits.add(bit)
+        for bit in set_bits:
+            self.reset_bits.discard(bit)
+            self.set_bits.add(bit)
+
+    def __bool__(self):
+        return bool(self.set_bits or self.reset_bits)
+
+
+class ModbusConnection:
+    """
+    Modbus TCP session of a workstation that stays open between requests.
+    Offers the same read_holding_registers / write_multiple_registers calls as pyModbusTCP's ModbusClient,
+    opens the session on demand, closes it after a failed request (the next request reconnects) and
+    checks an idle session before it is used again. All requests are serialized with a lock, so one
+    connection can be shared between the control loop and other threads (e.g. the CoAP handler).
+    """
+
+    def __init__(self, host, port = 502, timeout = 2.0, persistent = True, health_check_interval = 10.0, probe_address = 8001):
+        """
+        :param host Ip-adress of the modbus node (String)
+        :param port TCP port of the modbus node
+        :param timeout Timeout in seconds for every single request
+        :param persistent Keeps the session open between requests, if False the session is closed after every request
+        :param health_check_interval Seconds of inactivity after which the session is checked with a probe read before the next request (None disables it)
+        :param probe_address Register read by the health check, the input register of the workstation by default
+        """
+        self.client = ModbusClient(host=host, port=port, timeout=timeout, auto_open=False, auto_close=False)
+        self.host = host
+        self.port = port
+        self.persistent = persistent
+        self.health_check_interval = health_check_interval
+        self.probe_address = probe_address
+
+        self._lock = threading.Lock()
+        self._connected_before = False
+        self._last_activity = None
+
+        self.requests = 0
+        self.errors = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.health_checks = 0
+        self.last_rtt = None
+        self.max_rtt = 0.0
+        self._rtt_sum = 0.0
+        #RTT-Verteilung je Modbus-Funktion
+        self.rtt_histograms = {}
+
+    def open(self):
+        """
+        Opens the session if it is not open yet.
+
+        :returns true if the session is open
+        :rtype bool
+        """
+        with self._lock:
+            return self._ensure_open()
+
+    def close(self):
+        """
+        Closes the session.
+        """
+        with self._lock:
+            self.client.close()
+
+    @property
+    def is_open(self):
+        return self.client.is_open
+
+    def check_health(self):
+        """
+        Checks the session with a probe read. A broken session is closed and opened again.
+
+        :returns true if the modbus node answers
+        :rtype bool
+        """
+        with self._lock:
+            return self._check_health()
+
+    def read_holding_registers(self, reg_addr, reg_nb = 1):
+        """
+        Reads holding registers over the session.
+
+        :returns list of read registers (or None if it fails)
+        :rtype list of int or none
+        """
+        with self._lock:
+            return self._request(self.client.read_holding_registers, reg_addr, reg_nb)
+
+    def write_multiple_registers(self, regs_addr, regs_value):
+        """
+        Writes holding registers over the session.
+
+        :returns True if the write was successful, otherwise None
+        :rtype bool or none
+        """
+        with self._lock:
+            return self._request(self.client.write_multiple_registers, regs_addr, regs_value)
+
+    def stats(self):
+        """
+        :returns connection metrics (requests, errors, connects, reconnects, RTT in seconds)
+        :rtype dict
+        """
+        with self._lock:
+            return {
+                "host": self.host,
+                "open": self.client.is_open,
+                "requests": self.requests,
+                "errors": self.errors,
+                "connects": self.connects,
+                "reconnects": self.reconnects,
+                "health_checks": self.health_checks,
+                "last_rtt": self.last_rtt,
+                "avg_rtt": self._rtt_sum / self.requests if self.requests else None,
+                "max_rtt": self.max_rtt,
+            }
+
+    def rtt_stats(self):
+        """
+        :returns RTT distribution (count, mean, min, max, p50, p95, p99 in seconds) per modbus function
+        :rtype dict
+        """
+        with self._lock:
+            return {name: histogram.stats() for name, histogram in self.rtt_histograms.items()}
+
+    def _ensure_open(self):
+        if self.client.is_open:
+            return True
+        if not self.client.open():
+            return False
+        self.connects += 1
+        if self._connected_before:
+            self.reconnects += 1
+        self._connected_before = True
+        self._last_activity = monotonic()
+        return True
+
+    def _check_health(self):
+        self.health_checks += 1
+        if self._ensure_open() and self.client.read_holding_registers(self.probe_address, 1) is not None:
+            self._last_activity = monotonic()
+            return True
+        #Session ist defekt: schließen und sofort neu aufbauen
+        self.client.close()
+        return self._ensure_open()
+
+    def _request(self, function, *args):
+        if self.persistent and self.client.is_open and self.health_check_interval is not None \
+                and monotonic() - self._last_activity >= self.health_check_interval:
+            self._check_health()
+        if not self._ensure_open():
+            self.errors += 1
+            return None
+
+        start = perf_counter()
+        result = function(*args)
+        rtt = perf_counter() - start
+
+        histogram = self.rtt_histograms.get(function.__name__)
+        if histogram is None:
+            histogram = self.rtt_histograms[function.__name__] = Histogram()
+        histogram.record(rtt)
+        self.requests += 1
+        self.last_rtt = rtt
+        self._rtt_sum += rtt
+        if rtt > self.max_rtt:
+            self.max_rtt = rtt
+        self._last_activity = monotonic()
+
+        if result is None or result is False:
+            #Nach einem Fehler wird die Session beim nächsten Request neu aufgebaut
+            self.errors += 1
+            self.client.close()
+            return None
+        if not self.persistent:
+            self.client.close()
+        return result
+
+
+class _PendingRead:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.done = threading.Event()
+        self.result = None
+
+
+class CoalescingReader:
+    """
+    Read layer that merges reads of adjacent, nearby or overlapping register ranges into one read_holding_registers request
+    and hands every caller its part of the result. A caller whose range is covered by a request that is already
+    in flight (e.g. from another thread) waits for that request instead of sending its own. With a lock, requests are
+    only in flight while their thread holds it, so callers join only requests of threads sharing a reader-writer lock.
+    """
+
+    def __init__(self, client, lock = None, max_gap = 2, max_registers = 125):
+        """
+        :param client ModbusConnection (or ModbusClient) that executes the requests
+        :param lock Semaphore/Lock that is held while a request is executed (optional)
+        :param max_gap Maximum number of unrequested registers between two ranges that are still read together
+        :param max_registers Maximum number of registers in one request (125 is the Modbus limit)
+        """
+        self.client = client
+        self.lock = lock
+        self.max_gap = max_gap
+        self.max_registers = max_registers
+
+        self._in_flight = []
+        self._in_flight_lock = threading.Lock()
+
+        self.requests = 0
+        self.ranges_read = 0
+        self.joined = 0
+
+    def read(self, reg_addr, reg_nb = 1):
+        """
+        Reads one register range.
+
+        :returns list of read registers (or None if it fails)
+        :rtype list of int or none
+        """
+        return self.read_many([(reg_addr, reg_nb)])[0]
+
+    def read_many(self, ranges):
+        """
+        Reads several register ranges with as few requests as possible.
+
+        :param ranges list of (reg_addr, reg_nb)
+        :returns one list of registers (or None if it fails) per range, in the order of ranges
+        :rtype list
+        """
+        spans = []
+        for reg_addr, reg_nb in sorted(set(ranges)):
+            end = reg_addr + reg_nb
+            if spans and reg_addr - spans[-1][1] <= self.max_gap and max(end, spans[-1][1]) - spans[-1][0] <= self.max_registers:
+                spans[-1][1] = max(end, spans[-1][1])
+            else:
+                spans.append([reg_addr, end])
+
+        results = [self._read_span(start, end) for start, end in spans]
+        self.ranges_read += len(ranges)
+
+        values = []
+        for reg_addr, reg_nb in ranges:
+            for (start, end), (span_start, registers) in zip(spans, results):
+                if start <= reg_addr and reg_addr + reg_nb <= end:
+                    values.append(None if registers is None else registers[reg_addr - span_start:reg_addr - span_start + reg_nb])
+                    break
+        return values
+
+    def stats(self):
+        """
+        :returns number of modbus requests, requested ranges and ranges served by a request already in flight
+        :rtype dict
+        """
+        return {"requests": self.requests, "ranges": self.ranges_read, "joined": self.joined}
+
+    def _read_span(self, start, end):
+        #Erst der Lock, dann der Eintrag in _in_flight: ein Request ist nur in flight, während sein Besitzer den Lock hält.
+        #Sonst könnte ein Thread, der den Lock exklusiv hält, auf einen Request warten, dessen Besitzer auf den Lock wartet.
+        if self.lock is None:
+            return self._join_or_read(start, end)
+        with self.lock:
+            return self._join_or_read(start, end)
+
+    def _join_or_read(self, start, end):
+        with self._in_flight_lock:
+            for pending in self._in_flight:
+                if pending.start <= start and end <= pending.end:
+                    self.joined += 1
+                    break
+            else:
+                pending = None
+                own = _PendingRead(start, end)
+                self._in_flight.append(own)
+
+        if pending is not None:
+            pending.done.wait()
+            return pending.start, pending.result
+
+        try:
+            own.result = self.client.read_holding_registers(start, end - start)
+            self.requests += 1
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.remove(own)
+            own.done.set()
+        return start, own.result
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one modbus node. After failure_threshold failed requests in a row the breaker opens and
+    all requests are rejected with CircuitOpenError for reset_timeout seconds. Then one trial request is let
+    through (half open): if it succeeds the breaker closes again, otherwise it opens for another reset_timeout.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, host, failure_threshold = 5, reset_timeout = 5.0):
+        """
+        :param host Name of the modbus endpoint (e.g. "192.168.200.234:502")
+        :param failure_threshold Number of failed requests in a row after which the breaker opens
+        :param reset_timeout Seconds the breaker stays open before a trial request is let through
+        """
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.trips = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        :returns true if a request may be sent to the modbus node
+        :rtype bool
+        """
+        with self._lock:
+            if self.state == self.OPEN and monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def retry_after(self):
+        """
+        :returns seconds until the next request may be sent (0 if the breaker is not open)
+        :rtype float
+        """
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (monotonic() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = monotonic()
+                self.trips += 1
+
+    def stats(self):
+        """
+        :returns state, failures in a row and number of trips of the breaker
+        :rtype dict
+        """
+        retry_after = self.retry_after()
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.consecutive_failures, "trips": self.trips, "retry_after": retry_after}
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def circuit_breaker_for(host, port = 502, failure_threshold = 5, reset_timeout = 5.0):
+    """
+    Returns the CircuitBreaker of a modbus endpoint. All modules of one process that talk to the same endpoint share it,
+    nodes behind the same host on different ports get breakers of their own.
+    The thresholds are only used when the breaker is created.
+
+    :param host Ip-adress of the modbus node (String)
+    :param port TCP port of the modbus node
+    :rtype CircuitBreaker
+    """
+    endpoint = "%s:%d" % (host, port)
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(endpoint, failure_threshold, reset_timeout)
+            _circuit_breakers[endpoint] = breaker
+        return breaker
+
+
+class RetryPolicy:
+    """
+    Bounded retry of register accesses: at most max_attempts attempts with exponential backoff and jitter between
+    them, all within deadline seconds. A failed attempt is a call that returns None; an exception is not retried but
+    passed on, after it was counted as a failure of the CircuitBreaker. No lock should be held by the
+    caller while the policy waits, so other stations can use the modbus meanwhile.
+    """
+
+    def __init__(self, max_attempts = 5, base_delay = 0.05, max_delay = 2.0, jitter = 0.5, deadline = 5.0):
+        """
+        :param max_attempts Maximum number of attempts per call
+        :param base_delay Delay in seconds after the first failed attempt, doubled after every further one
+        :param max_delay Upper limit of the delay in seconds
+        :param jitter Fraction (0-1) by which every delay is randomly shortened
+        :param deadline Maximum duration of a call in seconds including all delays (None for no limit)
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+
+        self.calls = 0
+        self.attempts = 0
+        self.failures = 0
+        self.retries = 0
+        self.give_ups = 0
+        self.rejected = 0
+
+    def delay(self, attempt):
+        """
+        :param attempt Number of the failed attempt (starting with 1)
+        :returns delay in seconds before the next attempt
+        :rtype float
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, function, *args, breaker = None):
+        """
+        Calls function(*args) until it returns something else than None.
+
+        :param breaker CircuitBreaker of the modbus node (optional)
+        :returns result of the function
+        :raises CircuitOpenError if the breaker is open
+        :raises ModbusIOError if all attempts failed or the deadline is reached
+        """
+        start = monotonic()
+        self.calls += 1
+        attempt = 0
+        while True:
+            attempt += 1
+            self._before_attempt(breaker)
+            try:
+                result = function(*args)
+            except BaseException:
+                self._raised(breaker)
+                raise
+            if result is not None:
+                self._success(breaker)
+                return result
+            sleep(self._failure(function, breaker, attempt, start))
+
+    async def call_async(self, function, *args, breaker = None):
+        """
+        Same as call() for a coroutine function, waits with asyncio.sleep between the attempts.
+        """
+        start = monotonic()
+        self.calls += 1
+        attempt = 0
+        while True:
+            attempt += 1
+            self._before_attempt(breaker)
+            try:
+                result = await function(*args)
+            except BaseException:
+                self._raised(breaker)
+                raise
+            if result is not None:
+                self._success(breaker)
+                return result
+            await asyncio.sleep(self._failure(function, breaker, attempt, start))
+
+    def stats(self):
+        """
+        :returns calls, attempts, failed attempts, retries, calls that gave up and calls rejected by an open breaker
+        :rtype dict
+        """
+        return {"calls": self.calls, "attempts": self.attempts, "failures": self.failures, "retries": self.retries,
+                "give_ups": self.give_ups, "rejected": self.rejected}
+
+    def _before_attempt(self, breaker):
+        if breaker is not None and not breaker.allow():
+            self.rejected += 1
+            raise CircuitOpenError(breaker.host, breaker.retry_after())
+        self.attempts += 1
+
+    def _raised(self, breaker):
+        #Eine Exception zählt für den Circuit Breaker als Fehlschlag, sonst bliebe ein Probeversuch für immer halb offen
+        self.failures += 1
+        if breaker is not None:
+            breaker.record_failure()
+
+    def _success(self, breaker):
+        if breaker is not None:
+            breaker.record_success()
+
+    def _failure(self, function, breaker, attempt, start):
+        #Gibt die Wartezeit bis zum nächsten Versuch zurück oder bricht mit ModbusIOError ab
+        self.failures += 1
+        if breaker is not None:
+            breaker.record_failure()
+        delay = self.delay(attempt)
+        if attempt >= self.max_attempts or (self.deadline is not None and monotonic() + delay - start > self.deadline):
+            self.give_ups += 1
+            raise ModbusIOError("%s failed after %d attempts" % (getattr(function, "__name__", function), attempt))
+        self.retries += 1
+        return delay
+
+
+class _LockSide:
+    """
+    Shared (reader) or exclusive (writer) side of a DeviceLock. Can be used like a semaphore
+    (with-statement, acquire()/release()).
+    """
+
+    def __init__(self, device_lock, shared):
+        self._device_lock = device_lock
+        self._shared = shared
+
+    def acquire(self, block = True):
+        return self._device_lock._acquire(self._shared, block)
+
+    def release(self):
+        self._device_lock._release(self._shared)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class DeviceLock:
+    """
+    Lock for the register accesses to one modbus endpoint. The exclusive side (writer) is reentrant per thread:
+    while a thread holds it, further acquisitions of either side by the same thread do not block, so an actuator
+    command takes only one lock for reading the shadow, writing and retrying. With reader_writer=True several
+    threads or processes can read at the same time while writes stay exclusive.
+    The lock is based on multiprocessing semaphores and can be handed to other processes when they are started.
+    Wait and hold times are measured per process.
+    """
+
+    def __init__(self, endpoint, reader_writer = False, semaphore = None):
+        """
+        :param endpoint Name of the modbus endpoint (e.g. "192.168.200.234:502")
+        :param reader_writer Allows concurrent readers
+        :param semaphore Existing semaphore that is used as exclusive lock (optional)
+        """
+        self.endpoint = endpoint
+        self.reader_writer = reader_writer
+        self._write_sem = semaphore if semaphore is not None else multiprocessing.BoundedSemaphore(value=1)
+        self._readers = multiprocessing.Value("i", 0) if reader_writer else None
+        self.shared = _LockSide(self, True)
+        self.exclusive = _LockSide(self, False)
+        self._init_local()
+
+    def _init_local(self):
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"read": [0, 0.0, 0.0, 0.0, 0.0], "write": [0, 0.0, 0.0, 0.0, 0.0]}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("_local", "_stats_lock", "_stats"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local()
+
+    def reading(self):
+        """
+        :returns context manager for a read access
+        """
+        return self.shared
+
+    def writing(self):
+        """
+        :returns context manager for a write access
+        """
+        return self.exclusive
+
+    def stats(self):
+        """
+        Returns the contention metrics of this process: number of acquisitions, total and maximum wait time and
+        total and maximum hold time in seconds, separately for reads and writes.
+
+        :rtype dict
+        """
+        with self._stats_lock:
+            return {kind: {"acquisitions": values[0], "wait_total": values[1], "wait_max": values[2], "hold_total": values[3], "hold_max": values[4]}
+                    for kind, values in self._stats.items()}
+
+    def _acquire(self, shared, block):
+        local = self._local
+        if getattr(local, "exclusive_depth", 0):
+            #Der Thread hält den Lock bereits exklusiv
+            local.exclusive_depth += 1
+            return True
+
+        start = perf_counter()
+        if shared and self.reader_writer:
+            with self._readers.get_lock():
+                if self._readers.value == 0 and not self._write_sem.acquire(block):
+                    return False
+                self._readers.value += 1
+        else:
+            if not self._write_sem.acquire(block):
+                return False
+            local.exclusive_depth = 1
+        acquired = perf_counter()
+
+        if not hasattr(local, "holds"):
+            local.holds = []
+        local.holds.append((shared, acquired))
+        self._record("read" if shared else "write", 1, acquired - start, 0.0)
+        return True
+
+    def _release(self, shared):
+        local = self._local
+        depth = getattr(local, "exclusive_depth", 0)
+        if depth > 1:
+            local.exclusive_depth = depth - 1
+            return
+        local.exclusive_depth = 0
+
+        shared, acquired = local.holds.pop()
+        if shared and self.reader_writer:
+            with self._readers.get_lock():
+                self._readers.value -= 1
+                if self._readers.value == 0:
+                    self._write_sem.release()
+        else:
+            self._write_sem.release()
+        self._record("read" if shared else "write", 0, 0.0, perf_counter() - acquired)
+
+    def _record(self, kind, acquisitions, wait, hold):
+        with self._stats_lock:
+            values = self._stats[kind]
+            values[0] += acquisitions
+            values[1] += wait
+            values[2] = max(values[2], wait)
+            values[3] += hold
+            values[4] = max(values[4], hold)
+
+
+class DeviceLockManager:
+    """
+    Hands out one DeviceLock per modbus endpoint. Stations on different modbus nodes get different locks
+    and run in parallel, all accesses to the same node share one lock.
+    """
+
+    def __init__(self, reader_writer = False):
+        """
+        :param reader_writer Creates locks that allow concurrent readers
+        """
+        self.reader_writer = reader_writer
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def lock_for(self, host, port = 502):
+        """
+        :param host Ip-adress of the modbus node (String)
+        :param port TCP port of the modbus node
+        :rtype DeviceLock
+        """
+        endpoint = "%s:%d" % (host, port)
+        with self._lock:
+            lock = self._locks.get(endpoint)
+            if lock is None:
+                lock = DeviceLock(endpoint, self.reader_writer)
+                self._locks[endpoint] = lock
+            return lock
+
+    def stats(self):
+        """
+        :returns contention metrics of all locks by endpoint
+        :rtype dict
+        """
+        with self._lock:
+            locks = list(self._locks.items())
+        return {endpoint: lock.stats() for endpoint, lock in locks}
+
+
+#Lock-Verwaltung für alle Module eines Prozesses, die keinen eigenen Lock bekommen
+default_lock_manager = DeviceLockManager()
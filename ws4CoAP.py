@@ -2,11 +2,17 @@ from pyModbusTCP.client import ModbusClient
 from pyModbusTCP.utils import set_bit, reset_bit, test_bit
 from time import sleep
 import multiprocessing
-import paho.mqtt.publish as publish
 from coapthon.server.coap import CoAP
 from coapthon.resources.resource import Resource
 import logging
 
+from workstation_io import ModbusConnection
+from workstation_io import RetryPolicy
+from workstation_io import circuit_breaker_for
+from workstation_io import DeviceLock
+from workstation_io import default_lock_manager
+from telemetry import MqttTelemetryPublisher
+
 # Configure logging for CoAP server
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -16,7 +22,8 @@ class WorkstationModule:
     DIGITAL_INPUT_STARTING_ADDRESS = 8001
     DIGITAL_OUTPUT_STARTING_ADDRESS = 8003
 
-    def __init__(self, ip_addr, sem_output=None, sem_self_turning=None, sem_opposite_turning=None, read_write_sem=None):
+    def __init__(self, ip_addr, sem_output=None, sem_self_turning=None, sem_opposite_turning=None, read_write_sem=None,
+                 persistent_connection=True, modbus_timeout=2.0, retry_policy=None):
         """
         Constructor of the WorkstationModules.
 
@@ -24,12 +31,18 @@ class WorkstationModule:
         :param sem_output: Semaphore for checking if the exit is currently free (optional)
         :param sem_self_turning: Semaphore to indicate if the station's table is turning (optional)
         :param sem_opposite_turning: Semaphore to indicate if the opposite station's table is turning (optional)
-        :param read_write_sem: Semaphore to ensure mutual exclusion for read/write operations (optional)
+        :param read_write_sem: DeviceLock or semaphore to ensure mutual exclusion for read/write operations
+                               (optional, defaults to the lock of the Modbus node from default_lock_manager)
+        :param persistent_connection: Keep the TCP session to the Modbus open between requests (optional)
+        :param modbus_timeout: Timeout in seconds for every Modbus request (optional)
+        :param retry_policy: RetryPolicy for all register accesses (optional)
         """
 
         try:
-            # Establish connection to Modbus with the provided IP address
-            self.client = ModbusClient(host=ip_addr, auto_open=True, auto_close=True)
+            # Establish connection to Modbus with the provided IP address. The session stays open and is
+            # shared between the CoAP handler and the work loop, requests are serialized by the connection.
+            self.client = ModbusConnection(ip_addr, timeout=modbus_timeout, persistent=persistent_connection,
+                                           probe_address=self.DIGITAL_INPUT_STARTING_ADDRESS)
         except ValueError:
             print("Error with host param")
 
@@ -40,9 +53,32 @@ class WorkstationModule:
         self.sem_self_turning = sem_self_turning
         self.sem_opposite_turning = sem_opposite_turning
 
-        # Semaphore for internal synchronization
-        self.sem = multiprocessing.BoundedSemaphore(value=1)
-        self.read_write_sem = read_write_sem
+        # One lock per Modbus node. Its exclusive side is reentrant per thread, so the checker commands
+        # take a single lock for the read-modify-write instead of two.
+        if isinstance(read_write_sem, DeviceLock):
+            self.device_lock = read_write_sem
+        elif read_write_sem is not None:
+            self.device_lock = DeviceLock(ip_addr, semaphore=read_write_sem)
+        else:
+            self.device_lock = default_lock_manager.lock_for(ip_addr)
+        self.sem = self.device_lock.exclusive
+        self.read_write_sem = self.device_lock.exclusive
+
+        # Long-lived MQTT connection, created on the first publish
+        self.publisher = None
+
+        # Bounded retries with backoff and a circuit breaker per Modbus node
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.breaker = circuit_breaker_for(ip_addr)
+
+    def close(self):
+        """
+        Closes the connection to the Modbus and the MQTT publisher. The next register access opens the connection again.
+        """
+        self.client.close()
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
 
     # Methods to interact with Modbus registers
 
@@ -52,14 +88,11 @@ class WorkstationModule:
 
         :param offset: Offset to DIGITAL_OUTPUT_STARTING_ADDRESS
         :param amount: Amount of registers to read
-        :return: List of read registers (or None if it fails)
+        :return: List of read registers
+        :raises ModbusIOError: If the registers can not be read (see retry_policy)
         """
-        with self.read_write_sem:
-            result = None
-            while result is None:
-                result = self.client.read_holding_registers(reg_addr=self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset,
-                                                            reg_nb=amount)
-            return result
+        return self.retry_policy.call(self._locked, self.client.read_holding_registers,
+                                      self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, amount, breaker=self.breaker)
 
     def set_output_register(self, register, offset=0):
         """
@@ -67,12 +100,15 @@ class WorkstationModule:
 
         :param register: List of integers to write to the registers
         :param offset: Offset to DIGITAL_OUTPUT_STARTING_ADDRESS
+        :raises ModbusIOError: If the registers can not be written (see retry_policy)
         """
+        return self.retry_policy.call(self._locked, self.client.write_multiple_registers,
+                                      self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, register, breaker=self.breaker)
+
+    def _locked(self, function, *args):
+        # The semaphore is only held during an attempt, not while the retry policy waits
         with self.read_write_sem:
-            result = None
-            while result is None:
-                result = self.client.write_multiple_registers(self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, register)
-            return result
+            return function(*args)
 
     def checker_down(self):
         """
@@ -101,9 +137,9 @@ class WorkstationModule:
         :param damaged_blocks: Number of damaged blocks
         """
         hostname = "localhost"
-        publish.single("Total block", total_blocks, hostname=hostname)
-        publish.single("Drilled block", drilled_blocks, hostname=hostname)
-        publish.single("Damaged block", damaged_blocks, hostname=hostname)
+        if self.publisher is None:
+            self.publisher = MqttTelemetryPublisher(hostname, topics={"total": "Total block", "drilled": "Drilled block", "damaged": "Damaged block"})
+        self.publisher.publish_counters(total_blocks, drilled_blocks, damaged_blocks)
 
 # CoAP resource for controlling checker station
 class CheckerResource(Resource):